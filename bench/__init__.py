@@ -0,0 +1,7 @@
+"""
+Benchmarks and load tests for omplex.
+
+Everything in here runs on a plain Linux box: ``fakepms`` stands in for a
+Plex Media Server, ``fakeomxplayer`` for omxplayer and ``controllers`` for
+the Plex apps driving the player.
+"""
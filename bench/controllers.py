@@ -0,0 +1,173 @@
+"""
+controllers.py - Simulated Plex remote controllers
+
+Each ``Controller`` behaves like a phone running the Plex app: it starts a
+small HTTP server to receive pushed timelines, subscribes to omplex, then
+polls and sends playback commands until its run time is up.  Command
+latencies and timeline arrival times are recorded for the report.
+"""
+import random
+import re
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+_STATE_RE = re.compile(r'state="(\w+)"')
+
+# Relative weights of the commands a controller sends while running
+DEFAULT_SCRIPT = (
+    ("poll",        10),
+    ("pause",       1),
+    ("play",        1),
+    ("volume",      2),
+    ("seekTo",      1),
+    ("setStreams",  1),
+)
+
+class TimelineHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length") or 0)
+        body   = self.rfile.read(length)
+        match  = _STATE_RE.search(body)
+        self.server.record(match.group(1) if match else "unknown")
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+class TimelineReceiver(ThreadingMixIn, HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), TimelineHandler)
+        self.timelines = []
+
+    def record(self, state):
+        self.timelines.append((time.time(), state))
+
+class Controller(threading.Thread):
+    def __init__(self, index, player_url, pms, duration, interval=0.5,
+                 script=DEFAULT_SCRIPT, leader=False, rating_key=1):
+        threading.Thread.__init__(self, name="Controller %d" % index)
+        self.daemon     = True
+        self.index      = index
+        self.player_url = player_url
+        self.pms        = pms
+        self.duration   = duration
+        self.interval   = interval
+        self.script     = script
+        self.leader     = leader
+        self.rating_key = rating_key
+        self.uuid       = str(uuid.uuid4())
+        self.name       = "bench-controller-%d" % index
+        self.command_id = 0
+        self.latencies  = {}
+        self.errors     = {}
+        self.receiver   = TimelineReceiver()
+        self._random    = random.Random(index)
+
+    def request(self, command, path, args=None):
+        self.command_id += 1
+        args = dict(args or {})
+        args["commandID"] = self.command_id
+        url = "%s%s?%s" % (self.player_url, path, urllib.urlencode(args))
+        req = urllib2.Request(url, headers={
+            "X-Plex-Client-Identifier": self.uuid,
+            "X-Plex-Device-Name":       self.name
+        })
+
+        started = time.time()
+        try:
+            urllib2.urlopen(req, timeout=30).read()
+        except Exception:
+            self.errors[command] = self.errors.get(command, 0) + 1
+            return False
+        finally:
+            self.latencies.setdefault(command, []).append(time.time()-started)
+        return True
+
+    def subscribe(self):
+        return self.request("subscribe", "/player/timeline/subscribe", {
+            "port":     self.receiver.server_address[1],
+            "protocol": "http"
+        })
+
+    def play_media(self):
+        return self.request("playMedia", "/player/playback/playMedia", {
+            "address":  "127.0.0.1",
+            "port":     self.pms.port,
+            "protocol": "http",
+            "key":      "/library/metadata/%s" % self.rating_key,
+            "offset":   0
+        })
+
+    def send(self, command):
+        if command == "poll":
+            self.request(command, "/player/timeline/poll", {"wait": 0})
+        elif command == "pause":
+            self.request(command, "/player/playback/pause")
+        elif command == "play":
+            self.request(command, "/player/playback/play")
+        elif command == "volume":
+            self.request(command, "/player/playback/setParameters",
+                         {"volume": self._random.randint(0, 100)})
+        elif command == "seekTo":
+            self.request(command, "/player/playback/seekTo",
+                         {"offset": self._random.randint(0, 600)*1000})
+        elif command == "setStreams":
+            # Stream ids as served by the fake PMS
+            self.request(command, "/player/playback/setStreams", {
+                "audioStreamID":    "%s%d" % (self.rating_key, self._random.choice((2, 3))),
+                "subtitleStreamID": self._random.choice(("0", "%s4" % self.rating_key))
+            })
+        elif command == "stop":
+            self.request(command, "/player/playback/stop")
+
+    def pick(self):
+        total = sum([weight for name, weight in self.script])
+        point = self._random.uniform(0, total)
+        for name, weight in self.script:
+            point -= weight
+            if point <= 0:
+                return name
+        return self.script[-1][0]
+
+    def run(self):
+        receiver = threading.Thread(target=self.receiver.serve_forever, name="%s timelines" % self.name)
+        receiver.daemon = True
+        receiver.start()
+
+        deadline = time.time() + self.duration
+        self.subscribe()
+        if self.leader:
+            self.play_media()
+
+        while time.time() < deadline:
+            self.send(self.pick())
+            time.sleep(self.interval * self._random.uniform(0.5, 1.5))
+
+        self.request("unsubscribe", "/player/timeline/unsubscribe")
+        self.receiver.shutdown()
+        self.receiver.server_close()
+
+    def timeline_intervals(self, state="playing"):
+        """
+        Returns the gaps between consecutive pushed timelines that both
+        reported ``state``.
+        """
+        gaps = []
+        last = None
+        for at, s in self.receiver.timelines:
+            if s == state and last is not None:
+                gaps.append(at-last)
+            last = at if s == state else None
+        return gaps
@@ -0,0 +1,280 @@
+"""
+e2e.py - End-to-end load and latency harness for omplex
+
+Launches omplex against a local fake Plex Media Server and a fake omxplayer,
+then lets a number of simulated controllers subscribe, poll and send
+commands.  Reports command latency percentiles, timeline cadence jitter and
+the CPU, memory and thread usage of the omplex process.  Where the time
+went in each ``playMedia``, up to omxplayer's first status line, is taken
+from omplex's ``/debug/trace`` route.  No Raspberry Pi or network access is
+required.
+
+Run from the top of the source tree:
+
+    python -m bench.e2e --controllers 4 --duration 30
+"""
+import cPickle as pickle
+import json
+import optparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+from controllers import Controller
+from fakepms import FakePlexServer
+from stats import ProcessSampler, summarize
+
+BENCH_DIR   = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR  = os.path.dirname(BENCH_DIR)
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def write_fake_omxplayer(workdir):
+    """
+    Writes an executable wrapper that runs ``fakeomxplayer.py`` with this
+    interpreter and returns its path.
+    """
+    path = os.path.join(workdir, "omxplayer")
+    with open(path, "w") as fh:
+        fh.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable,
+                                                      os.path.join(BENCH_DIR, "fakeomxplayer.py")))
+    os.chmod(path, 0755)
+    return path
+
+def write_settings(workdir, port, backend="omxplayer"):
+    with open(os.path.join(workdir, "settings.dat"), "wb") as fh:
+        pickle.dump({
+            "myplex_token":     "fake-token",
+            "player_name":      "omplex-bench",
+            "http_port":        str(port),
+            "audio_output":     "local",
+            "player_backend":   backend
+        }, fh)
+
+def start_session_bus():
+    """
+    Starts a private session bus, returns the process and its address.
+    """
+    process = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+                               stdout=subprocess.PIPE)
+    return process, process.stdout.readline().strip()
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return True
+        except socket.error:
+            time.sleep(0.01)
+    return False
+
+class Harness(object):
+    def __init__(self, options):
+        self.options    = options
+        self.workdir    = tempfile.mkdtemp(prefix="omplex-bench-")
+        self.port       = free_port()
+        self.pms        = FakePlexServer(duration=options.media_duration,
+                                         response_delay=options.pms_delay)
+        self.process    = None
+        self.bus        = None
+        self.sampler    = None
+        self.startup    = None
+        self.trace      = None
+
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            "PYTHONPATH":               SOURCE_DIR + os.pathsep + env.get("PYTHONPATH", ""),
+            "OMPLEX_OMXPLAYER":         write_fake_omxplayer(self.workdir),
+            "FAKE_OMX_DURATION":        str(self.options.media_duration),
+            "FAKE_OMX_STATUS_RATE":     str(self.options.status_rate),
+            "FAKE_OMX_HEADER_DELAY":    str(self.options.header_delay),
+            "OMPLEX_NULL_DURATION":     str(self.options.media_duration),
+        })
+        if self.bus:
+            env["OMPLEX_OMXPLAYER_DBUS"] = env["FAKE_OMX_DBUS"] = self.bus_address
+        return env
+
+    def start(self):
+        self.pms.start()
+        if self.options.dbus:
+            self.bus, self.bus_address = start_session_bus()
+        write_settings(self.workdir, self.port, self.options.backend)
+
+        started      = time.time()
+        self.log     = open(os.path.join(self.workdir, "omplex.log"), "w")
+        self.process = subprocess.Popen([sys.executable, "-c", "from omplex.cmdline import main; main()"],
+                                        cwd=self.workdir, env=self.env(),
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        if not wait_for_port(self.port):
+            raise RuntimeError("omplex did not start listening on port %d" % self.port)
+        self.startup = time.time()-started
+
+        self.sampler = ProcessSampler(self.process.pid)
+        self.sampler.start()
+
+    def stop(self):
+        if self.sampler:
+            self.sampler.stop()
+
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            deadline = time.time() + 10
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+
+        self.log.close()
+        self.pms.stop()
+        if self.bus:
+            self.bus.terminate()
+            self.bus.wait()
+
+    def run(self):
+        player_url  = "http://127.0.0.1:%d" % self.port
+        controllers = [Controller(i, player_url, self.pms, self.options.duration,
+                                  interval=self.options.interval, leader=(i == 0))
+                       for i in range(self.options.controllers)]
+        for c in controllers:
+            c.start()
+        for c in controllers:
+            c.join()
+
+        try:
+            self.trace = json.load(urllib2.urlopen("%s/debug/trace" % player_url, timeout=10))
+        except Exception, e:
+            print "Couldn't fetch the playback trace: %s" % e
+        return controllers
+
+    def playback_starts(self):
+        """
+        Returns the duration of each traced span, by name, and the time from
+        ``playMedia`` to the first status line of every traced start.
+        """
+        spans  = {}
+        starts = []
+        begun  = {}
+        for event in (self.trace or {}).get("traceEvents", []):
+            if event["ph"] == "X":
+                spans.setdefault(event["name"], []).append(event["dur"]*1e-6)
+                if event["name"] == "playMedia":
+                    begun[event["pid"]] = event["ts"]
+        for event in (self.trace or {}).get("traceEvents", []):
+            # omxplayer's mark, the other backends mark their first position
+            if event["name"] in ("first status line", "first position") and event["pid"] in begun:
+                starts.append((event["ts"]-begun[event["pid"]])*1e-6)
+        return starts, spans
+
+    def report(self, controllers):
+        starts, spans = self.playback_starts()
+        latencies = {}
+        errors    = {}
+        gaps      = []
+        for c in controllers:
+            for command, values in c.latencies.items():
+                latencies.setdefault(command, []).extend(values)
+            for command, count in c.errors.items():
+                errors[command] = errors.get(command, 0) + count
+            gaps.extend(c.timeline_intervals())
+
+        return {
+            "startup_seconds":  self.startup,
+            "commands":         dict([(k, summarize(v)) for k, v in latencies.items()]),
+            "errors":           errors,
+            "timeline_gaps":    summarize(gaps),
+            "timeline_jitter":  summarize([abs(g-1.0) for g in gaps]),
+            "pms_requests":     dict([(k, len(v)) for k, v in self.pms.requests.items()]),
+            "pms_connections":  self.pms.connections,
+            "playback_start":   summarize(starts),
+            "playback_spans":   dict([(k, summarize(v)) for k, v in spans.items()]),
+            "process":          self.sampler.summary()
+        }
+
+def print_report(report, out=sys.stdout):
+    out.write("omplex end-to-end benchmark\n")
+    out.write("  HTTP ready after %.3fs\n\n" % report["startup_seconds"])
+
+    out.write("  %-12s %6s %9s %9s %9s %9s %6s\n" % ("command", "count", "p50 ms", "p90 ms", "p99 ms", "max ms", "errors"))
+    for command, s in sorted(report["commands"].items()):
+        out.write("  %-12s %6d %9.2f %9.2f %9.2f %9.2f %6d\n" % (
+                  command, s["count"], s["p50"]*1e3, s["p90"]*1e3, s["p99"]*1e3, s["max"]*1e3,
+                  report["errors"].get(command, 0)))
+
+    gaps   = report["timeline_gaps"]
+    jitter = report["timeline_jitter"]
+    out.write("\n  timeline pushes while playing: %d\n" % gaps["count"])
+    if gaps["count"]:
+        out.write("    interval mean %.3fs stdev %.3fs, jitter p50 %.1fms p99 %.1fms max %.1fms\n" % (
+                  gaps["mean"], gaps["stdev"], jitter["p50"]*1e3, jitter["p99"]*1e3, jitter["max"]*1e3))
+
+    start = report["playback_start"]
+    if start["count"]:
+        out.write("\n  playMedia to first status line: p50 %.1fms max %.1fms over %d starts\n" % (
+                  start["p50"]*1e3, start["max"]*1e3, start["count"]))
+        out.write("    %-26s %6s %9s %9s\n" % ("span", "count", "p50 ms", "max ms"))
+        for name, s in sorted(report["playback_spans"].items(), key=lambda i: -i[1]["p50"]):
+            out.write("    %-26s %6d %9.2f %9.2f\n" % (name, s["count"], s["p50"]*1e3, s["max"]*1e3))
+
+    p = report["process"]
+    if p:
+        out.write("\n  omplex process: cpu %.1f%%, rss max %.1fMB, threads max %d (last %d)\n" % (
+                  p["cpu_percent"], p["rss_max_mb"], p["threads_max"], p["threads_last"]))
+
+    out.write("\n  fake PMS requests: %s\n" % ", ".join(["%s=%d" % i for i in sorted(report["pms_requests"].items())]))
+    out.write("  fake PMS connections: %d\n" % report["pms_connections"])
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="python -m bench.e2e [options]")
+    parser.add_option("-c", "--controllers", type="int", default=4, help="number of simulated controllers")
+    parser.add_option("-d", "--duration", type="float", default=30, help="seconds each controller runs for")
+    parser.add_option("-i", "--interval", type="float", default=0.5, help="mean seconds between controller commands")
+    parser.add_option("--media-duration", type="int", default=1800, help="length of the fake media in seconds")
+    parser.add_option("--status-rate", type="float", default=3, help="fake omxplayer status lines per second")
+    parser.add_option("--header-delay", type="float", default=0.2, help="fake omxplayer startup delay in seconds")
+    parser.add_option("--pms-delay", type="float", default=0, help="fake PMS response delay in seconds")
+    parser.add_option("--backend", default="omxplayer", help="player backend omplex uses [%default]")
+    parser.add_option("--dbus", action="store_true", help="control the fake omxplayer over D-Bus")
+    parser.add_option("--json", metavar="PATH", help="also write the report as JSON to PATH")
+    parser.add_option("--trace", metavar="PATH", help="write omplex's playback traces (Chrome trace JSON) to PATH")
+    parser.add_option("--keep", action="store_true", help="keep the work directory (with omplex.log)")
+    options, args = parser.parse_args(argv)
+
+    harness = Harness(options)
+    try:
+        harness.start()
+        controllers = harness.run()
+    finally:
+        harness.stop()
+
+    report = harness.report(controllers)
+    print_report(report)
+
+    if options.json:
+        with open(options.json, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+
+    if options.trace and harness.trace:
+        with open(options.trace, "w") as fh:
+            json.dump(harness.trace, fh)
+
+    if options.keep:
+        print "\n  work directory: %s" % harness.workdir
+    else:
+        shutil.rmtree(harness.workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
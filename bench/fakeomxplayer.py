@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+fakeomxplayer.py - A scriptable stand-in for omxplayer
+
+Accepts the same command line as omxplayer (only ``-l``/``--pos`` is acted
+upon), prints omxplayer-style stream headers and ``-s`` status lines, and
+reacts to the keystrokes omplex sends on stdin.  Timing is controlled with
+environment variables so benchmarks can model slow or fast hardware:
+
+    FAKE_OMX_DURATION       length of the fake media in seconds (1800)
+    FAKE_OMX_STATUS_RATE    status lines per second (3)
+    FAKE_OMX_HEADER_DELAY   seconds before the stream headers are printed (0.2)
+    FAKE_OMX_ACK_DELAY      seconds before a keystroke takes effect (0)
+    FAKE_OMX_EXIT_DELAY     seconds between quitting and exiting (0.05)
+    FAKE_OMX_LOG            file to append received keystrokes to
+    FAKE_OMX_DBUS           address of a bus to serve omxplayer's MPRIS
+                            interface on, like omxplayer's own bus
+
+Works with both Python 2 and 3 and needs nothing but the standard library.
+The D-Bus service reuses ``omplex.mpris`` and so needs Python 2.
+"""
+import math
+import os
+import select
+import sys
+import threading
+import time
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = tty = None
+
+KEYS = {
+    "p":        "pause",
+    " ":        "pause",
+    "q":        "quit",
+    "+":        "volume_up",
+    "=":        "volume_up",
+    "-":        "volume_down",
+    "s":        "subtitles",
+    "1":        "speed_down",
+    "2":        "speed_up",
+    "\x1b[D":   "seek_-30",
+    "\x1b[C":   "seek_30",
+    "\x1b[B":   "seek_-600",
+    "\x1b[A":   "seek_600",
+}
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+class FakeOMXPlayer(object):
+    def __init__(self, argv):
+        self.duration       = env_float("FAKE_OMX_DURATION", 1800)
+        self.status_rate    = env_float("FAKE_OMX_STATUS_RATE", 3)
+        self.header_delay   = env_float("FAKE_OMX_HEADER_DELAY", 0.2)
+        self.ack_delay      = env_float("FAKE_OMX_ACK_DELAY", 0)
+        self.exit_delay     = env_float("FAKE_OMX_EXIT_DELAY", 0.05)
+        self.log_path       = os.environ.get("FAKE_OMX_LOG")
+        self.dbus_address   = os.environ.get("FAKE_OMX_DBUS")
+
+        self.offset         = 0.0
+        self.paused         = False
+        self.audio          = 0
+        self.subtitle       = -1
+        self.volume         = 0
+        self.running        = True
+        self.started        = None
+        self.media          = None
+        self.info           = False
+
+        self.parse_args(argv)
+
+    def parse_args(self, argv):
+        args = list(argv)
+        while args:
+            arg = args.pop(0)
+            if arg in ("-l", "--pos"):
+                value = args.pop(0)
+                if ":" in value:
+                    seconds = 0
+                    for part in value.split(":"):
+                        seconds = seconds*60 + float(part)
+                    self.offset = seconds
+                else:
+                    self.offset = float(value)
+            elif arg in ("-o", "--adev", "-n", "--aidx", "-t", "--sid", "--subtitles",
+                         "--dbus_name", "--vol"):
+                args.pop(0)
+            elif arg in ("-i", "--info"):
+                self.info = True
+            elif not arg.startswith("-"):
+                self.media = arg
+
+    def log(self, message):
+        if self.log_path:
+            with open(self.log_path, "a") as fh:
+                fh.write("%.6f %s\n" % (time.time(), message))
+
+    def write(self, data):
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+    @property
+    def position(self):
+        if self.paused or self.started is None:
+            return self.offset
+        return self.offset + (time.time()-self.started)
+
+    def set_position(self, position):
+        self.offset  = max(0.0, min(position, self.duration))
+        self.started = time.time()
+
+    def handle(self, action):
+        self.log(action)
+        if self.ack_delay:
+            time.sleep(self.ack_delay)
+
+        if action == "pause":
+            if self.paused:
+                self.started = time.time()
+            else:
+                self.offset = self.position
+            self.paused = not self.paused
+        elif action == "quit":
+            self.running = False
+        elif action == "volume_up":
+            self.volume += 300
+            self.write("Current Volume: %.2fdB\n" % (self.volume/100.0))
+        elif action == "volume_down":
+            self.volume -= 300
+            self.write("Current Volume: %.2fdB\n" % (self.volume/100.0))
+        elif action.startswith("seek_"):
+            self.set_position(self.position + int(action[5:]))
+            if self.paused:
+                self.started = None
+
+    def serve_dbus(self):
+        """
+        Serves the subset of omxplayer's MPRIS interface that omplex uses,
+        on a thread of its own.
+        """
+        sys.path.insert(0, SOURCE_DIR)
+        from omplex.mpris import Connection, DBusError, MPRIS_NAME
+
+        def handle(interface, member, args):
+            self.log("dbus %s %s" % (member, ",".join([str(a) for a in args])))
+            if self.ack_delay:
+                time.sleep(self.ack_delay)
+
+            if member == "Position":
+                return "x", (int(self.position*1e6),)
+            elif member == "Duration":
+                return "x", (int(self.duration*1e6),)
+            elif member == "Volume":
+                if args:
+                    self.volume = int(round(2000*math.log10(args[0])))
+                return "d", (10 ** (self.volume/2000.0),)
+            elif member == "SetPosition":
+                self.set_position(args[1]/1e6)
+                if self.paused:
+                    self.started = None
+                return "x", (args[1],)
+            elif member == "SelectAudio":
+                self.audio = args[0]
+                return "b", (True,)
+            elif member == "SelectSubtitle":
+                self.subtitle = args[0]
+                return "b", (True,)
+            elif member in ("ShowSubtitles", "HideSubtitles"):
+                return "", ()
+            raise DBusError("org.freedesktop.DBus.Error.UnknownMethod", member)
+
+        connection = Connection(self.dbus_address)
+        # Take the name over from a player that hasn't quite exited yet
+        connection.request_name(MPRIS_NAME, 0x3)
+        thread = threading.Thread(target=connection.serve, args=(handle,))
+        thread.daemon = True
+        thread.start()
+
+    def print_headers(self):
+        time.sleep(self.header_delay)
+        self.write("Video codec omx-h264 width 1920 height 1080 profile 100 fps 23.976024\n")
+        self.write("Audio codec aac channels 2 samplerate 48000 bitspersample 16\n")
+        self.write("Subtitle count: 0, state: off, index: 1, delay: 0\n")
+
+    def print_status(self):
+        stamp = self.position * 1e6
+        self.write("M:%8.0f V:%6.2fs %6.2fs/%6.2fs A:%6.2f %6.2fs/%6.2fs Cv:%6dk Ca:%6dk\r" % (
+                   stamp, 0.95, 4.8, 8.0, 0.9, 0.2, 0.9, 1024, 256))
+
+    def print_info(self):
+        minutes, seconds = divmod(self.duration, 60)
+        hours, minutes   = divmod(int(minutes), 60)
+        self.write("Input #0, matroska,webm, from '%s':\n" % self.media)
+        self.write("  Duration: %02d:%02d:%05.2f, start: 0.000000, bitrate: 8000 kb/s\n" % (hours, minutes, seconds))
+
+    def run(self):
+        if self.info:
+            self.print_info()
+            return
+
+        fd      = sys.stdin.fileno()
+        saved   = None
+        if termios and os.isatty(fd):
+            saved = termios.tcgetattr(fd)
+            tty.setcbreak(fd)
+
+        try:
+            self.print_headers()
+            self.set_position(self.offset)
+            if self.dbus_address:
+                self.serve_dbus()
+
+            interval    = 1.0/self.status_rate if self.status_rate > 0 else None
+            next_status = time.time()
+            buf         = ""
+            while self.running:
+                if self.position >= self.duration:
+                    break
+
+                timeout = None
+                if interval:
+                    timeout = max(0, next_status-time.time())
+
+                readable = select.select([fd], [], [], timeout)[0]
+                if readable:
+                    data = os.read(fd, 64)
+                    if not data:
+                        break
+                    if not isinstance(data, str):
+                        data = data.decode("latin-1")
+                    buf += data
+                    while buf:
+                        for key, action in KEYS.items():
+                            if buf.startswith(key):
+                                buf = buf[len(key):]
+                                self.handle(action)
+                                break
+                        else:
+                            if buf.startswith("\x1b") and len(buf) < 3:
+                                # Wait for the rest of the escape sequence
+                                break
+                            buf = buf[1:]
+
+                if interval and time.time() >= next_status:
+                    self.print_status()
+                    next_status += interval
+                    if next_status < time.time():
+                        next_status = time.time() + interval
+
+            time.sleep(self.exit_delay)
+            self.write("\nhave a nice day ;)\n")
+        finally:
+            if saved is not None:
+                termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+
+if __name__ == "__main__":
+    FakeOMXPlayer(sys.argv[1:]).run()
@@ -0,0 +1,160 @@
+"""
+fakepms.py - A minimal fake Plex Media Server
+
+Serves just enough of the Plex API for omplex to play media: server
+identity, library metadata, the universal transcoder's ``start.m3u8`` and the
+progress/scrobble/timeline endpoints.  Every request is counted and timed so
+a benchmark can report what omplex asked the server for.
+"""
+import threading
+import time
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+MACHINE_IDENTIFIER = "fake-pms-0000"
+
+SERVER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<MediaContainer size="0" friendlyName="Fake PMS" machineIdentifier="%s" version="0.9.9.0" />
+""" % MACHINE_IDENTIFIER
+
+# Even rating keys are served as "mov" so omplex takes the transcoder path
+METADATA_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<MediaContainer size="1" identifier="com.plexapp.plugins.library" librarySectionID="1" machineIdentifier="%(machine)s">
+  <Video ratingKey="%(key)s" key="/library/metadata/%(key)s" guid="com.plexapp.agents.none://%(key)s" type="movie" title="Fake Movie %(key)s" year="2014" duration="%(duration)d" thumb="/library/metadata/%(key)s/thumb/1" art="/library/metadata/%(key)s/art/1" updatedAt="1400000000">
+    <Media videoResolution="1080" id="%(key)s" duration="%(duration)d" bitrate="8000" width="1920" height="1080" container="%(container)s" videoCodec="h264" audioCodec="aac">
+      <Part id="%(key)s" key="/library/parts/%(key)s/file.%(container)s" duration="%(duration)d" file="/media/fake%(key)s.%(container)s" size="1000000000" container="%(container)s">
+        <Stream id="%(key)s1" streamType="1" codec="h264" index="0" />
+        <Stream id="%(key)s2" streamType="2" codec="aac" index="1" channels="2" language="English" languageCode="eng" selected="1" />
+        <Stream id="%(key)s3" streamType="2" codec="ac3" index="2" channels="6" language="Deutsch" languageCode="ger" />
+        <Stream id="%(key)s4" streamType="3" codec="srt" index="3" language="English" languageCode="eng" />
+      </Part>
+    </Media>
+  </Video>
+</MediaContainer>
+"""
+
+START_M3U8 = """#EXTM3U
+#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=8000000,RESOLUTION=1920x1080
+session/fake-session/base/index.m3u8
+"""
+
+INDEX_M3U8 = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:0
+#EXTINF:4.000000,
+00000.ts
+#EXT-X-ENDLIST
+"""
+
+OK_XML = '<?xml version="1.0" encoding="UTF-8"?>\n<Response code="200" status="OK" />\n'
+
+class FakePlexHandler(BaseHTTPRequestHandler):
+    # Like a real server, keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type="text/xml"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        path     = urlparse.urlparse(self.path).path
+        delay    = self.server.response_delay
+        if delay:
+            time.sleep(delay)
+
+        if path in ("/", "/identity"):
+            return "identity", SERVER_XML, "text/xml"
+
+        if path.startswith("/library/metadata/"):
+            key       = path.split("/")[3]
+            container = "mov" if key.isdigit() and int(key) % 2 == 0 else "mkv"
+            return "metadata", METADATA_XML % {
+                "machine":      MACHINE_IDENTIFIER,
+                "key":          key,
+                "duration":     self.server.duration*1000,
+                "container":    container
+            }, "text/xml"
+
+        if path == "/video/:/transcode/universal/start.m3u8":
+            return "transcode", START_M3U8, "application/vnd.apple.mpegurl"
+
+        if path.startswith("/video/:/transcode/universal/session/"):
+            return "segments", INDEX_M3U8, "application/vnd.apple.mpegurl"
+
+        if path.startswith("/library/parts/"):
+            if self.command == "PUT":
+                return "streams", OK_XML, "text/xml"
+            return "parts", "\0" * 1024, "application/octet-stream"
+
+        if path in ("/:/progress", "/:/scrobble", "/:/timeline"):
+            return path[2:], OK_XML, "text/xml"
+
+        if path == "/clients":
+            return "clients", '<MediaContainer size="0" />', "text/xml"
+
+        if path.startswith("/photo/:/transcode"):
+            return "photo", "\xff\xd8\xff\xd9", "image/jpeg"
+
+        return None, None, None
+
+    def handle_any(self):
+        started = time.time()
+        name, body, content_type = self.route()
+        if name is None:
+            self.send_error(404)
+            name = "404"
+        else:
+            self.reply(body, content_type)
+        self.server.record(name, time.time()-started)
+
+    do_GET  = handle_any
+    do_POST = handle_any
+    do_PUT  = handle_any
+
+class FakePlexServer(ThreadingMixIn, HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, duration=1800, response_delay=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakePlexHandler)
+        self.duration       = duration
+        self.response_delay = response_delay
+        self.requests       = {}
+        self.connections    = 0
+        self._lock          = threading.Lock()
+        self._thread        = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.port
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def record(self, name, elapsed):
+        with self._lock:
+            self.requests.setdefault(name, []).append(elapsed)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="Fake PMS")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
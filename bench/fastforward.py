@@ -0,0 +1,385 @@
+"""
+fastforward.py - Time driven behaviour on a virtual clock
+
+Runs omplex's timers against a ``VirtualClock`` and steps it forward a
+second at a time, so minutes of player time pass in a fraction of a second.
+Checks that subscribers expire after 90 seconds, that the display is put to
+sleep after ``display_sleep`` seconds, that playback positions are reported
+every scrobble interval, that a transcode that keeps stalling is
+restarted at a lower quality, that a player stalled for ``stall_timeout``
+seconds is restarted where it was, that one slow to start gets
+``start_timeout`` instead, that playback reaching the end stops rather than
+being restarted, that an omxplayer that exits before playing fails
+the start cleanly and that the OSD shown by a seek ticks
+along with playback until it hides itself, then prints when each happened
+and how long the run took:
+
+    python -m bench.fastforward
+"""
+import logging
+import optparse
+import sys
+import time
+
+from omplex.clock import clock, VirtualClock
+
+virtual = VirtualClock()
+clock.use(virtual)
+
+from omplex.bandwidth import QUALITIES
+from omplex.conf import settings
+from omplex.display import display
+from omplex.loop import loop
+from omplex.nullplayer import NullPlayer, DURATION
+from omplex.osd import osd, SHOW_SECONDS
+from omplex.player import Player, PlayerManager, SCROBBLE_INTERVAL
+from omplex.subscribers import remoteSubscriberManager, RemoteSubscriber, SUBSCRIBER_REMOVE_INTERVAL
+from omplex.timeline import timelineManager
+from omplex.watchdog import STALL_GRACE
+
+def wait_for(predicate, timeout=5, interval=0.001):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+def fast_forward(seconds, until=None, step=1.0):
+    """
+    Advances the virtual clock ``step`` seconds at a time, letting the loop
+    catch up after each step.  Returns the virtual time at which ``until``
+    first held, or None.
+    """
+    end = virtual.now() + seconds
+    while virtual.now() < end:
+        virtual.advance(step)
+        # Twice, for what the timers handed to call_soon
+        loop.sync()
+        loop.sync()
+        if until and until():
+            return virtual.now()
+
+class FakeMedia(object):
+    server_url = "http://127.0.0.1:32400"
+
+class FakeVideo(object):
+    """
+    Records the virtual time of every position update.
+    """
+    def __init__(self):
+        self.parent  = FakeMedia()
+        self.played  = False
+        self.updates = []
+        self._part   = 0
+
+    def get_duration(self):
+        return DURATION * 1e3
+
+    def get_video_attr(self, attr, default=None):
+        if attr == "duration":
+            return str(int(self.get_duration()))
+        return default
+
+    def get_audio_idx(self):
+        return None
+
+    def get_subtitle_idx(self):
+        return None
+
+    def get_proper_title(self):
+        return "Fast Forward"
+
+    def update_position(self, ms):
+        self.updates.append(virtual.now())
+
+    def set_played(self):
+        self.played = True
+        self.updates.append(virtual.now())
+
+class FakeTranscode(FakeVideo):
+    """
+    Records the bitrate of every transcode started.
+    """
+    def __init__(self):
+        super(FakeTranscode, self).__init__()
+        self.bitrates = []
+
+    def is_multipart(self):
+        return False
+
+    def is_transcode_suggested(self):
+        return True
+
+    def get_playback_url(self, direct_play=None, video_bitrate=None, **kwargs):
+        self.bitrates.append(video_bitrate)
+        return "null://fastforward/%s" % video_bitrate
+
+class StallingPlayer(NullPlayer):
+    """
+    A null player whose position can be held still, like omxplayer's when
+    segments don't arrive in time.
+    """
+    stalled = False
+
+    @property
+    def position(self):
+        if self.stalled:
+            return self._offset
+        return super(StallingPlayer, self).position
+
+    def stall(self, stalled):
+        self._set_position(self.position)
+        self.stalled = stalled
+
+class FakeOSDLibrary(object):
+    """
+    Stands in for libosd, recording the virtual time of every call.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args: self.calls.append((virtual.now(), name, args))
+
+def check_subscriber_expiry(results):
+    started = virtual.now()
+    remoteSubscriberManager.addSubscriber(RemoteSubscriber("fastforward", 0, "127.0.0.1"))
+    gone = fast_forward(SUBSCRIBER_REMOVE_INTERVAL*2,
+                        until=lambda: "fastforward" not in remoteSubscriberManager.subscribers)
+    results.append(("subscriber expired after", gone and gone-started, SUBSCRIBER_REMOVE_INTERVAL,
+                    gone is not None and SUBSCRIBER_REMOVE_INTERVAL < gone-started <= SUBSCRIBER_REMOVE_INTERVAL+2))
+
+def check_display_sleep(results, delay):
+    settings.display_sleep = delay
+    display.is_on = True
+    timelineManager.start()
+    loop.sync()
+
+    started = virtual.now()
+    asleep  = None
+    while virtual.now()-started < delay*2:
+        # Keep the cached state fresh, as if tvservice kept saying the TV is on
+        display.is_on = True
+        fast_forward(1)
+        if timelineManager._sleep_handle is None:
+            # The sleep timer fired, the display is powered off on a worker
+            if wait_for(lambda: not display.is_on):
+                asleep = virtual.now()
+            break
+
+    timelineManager.stop()
+    results.append(("display slept after", asleep and asleep-started, delay,
+                    asleep is not None and delay <= asleep-started <= delay+1))
+
+def check_scrobble(results, duration):
+    manager = PlayerManager()
+    manager._player = NullPlayer("null://fastforward")
+    manager._video  = FakeVideo()
+    display.is_on   = True
+
+    handle = loop.call_every(1, manager.update)
+    fast_forward(duration)
+    handle.cancel()
+
+    updates   = manager._video.updates
+    intervals = [b-a for a, b in zip(updates, updates[1:])]
+    expected  = SCROBBLE_INTERVAL + 1
+    results.append(("scrobble interval", intervals and max(intervals), expected,
+                    bool(intervals) and all(i == expected for i in intervals)))
+
+def check_stalls(results):
+    settings.player_backend = "null"
+    manager = PlayerManager()
+    manager._backend = lambda: StallingPlayer
+    video   = FakeTranscode()
+    display.is_on = True
+
+    manager.play(video)
+    handle = loop.call_every(1, manager.update)
+    lowered = None
+    for i in range(2):
+        fast_forward(10)
+        manager._player.stall(True)
+        started = virtual.now()
+        lowered = fast_forward(STALL_GRACE+3, until=lambda: len(video.bitrates) > 1)
+        manager._player.stall(False)
+    handle.cancel()
+    manager.stop()
+
+    # Restarted during the second stall, once it lasted long enough to count
+    expected = STALL_GRACE+1
+    results.append(("quality lowered after", lowered and lowered-started, expected,
+                    lowered is not None and lowered-started <= expected and
+                    video.bitrates == [QUALITIES[0][0], QUALITIES[1][0]]))
+
+def check_respawn(results):
+    settings.player_backend = "null"
+    manager = PlayerManager()
+    manager._backend = lambda: StallingPlayer
+    video   = FakeVideo()
+    video.is_multipart           = lambda: False
+    video.is_transcode_suggested = lambda: False
+    video.get_playback_url       = lambda direct_play=None: "null://fastforward"
+    display.is_on = True
+
+    manager.play(video)
+    handle = loop.call_every(1, manager.update)
+    fast_forward(10)
+    stalled = manager._player
+    stalled.stall(True)
+    position = stalled.position
+    started  = virtual.now()
+    fast_forward(STALL_GRACE+1)
+    buffering = manager.state.state
+    respawned = fast_forward(settings.stall_timeout+5, until=lambda: manager._player is not stalled)
+    handle.cancel()
+    offset = manager._player._offset
+    manager.stop()
+
+    # Still from the first update after the stall, restarted once it's been
+    # still for the timeout
+    expected = settings.stall_timeout+1
+    results.append(("player respawned after", respawned and respawned-started, expected,
+                    respawned is not None and respawned-started <= expected and
+                    buffering == "buffering" and offset == int(position)))
+
+def check_slow_start(results):
+    manager = PlayerManager()
+    manager._backend = lambda: StallingPlayer
+    video   = FakeVideo()
+    video.is_multipart           = lambda: False
+    video.is_transcode_suggested = lambda: False
+    video.get_playback_url       = lambda direct_play=None: "null://fastforward"
+    display.is_on = True
+
+    manager.play(video, 120)
+    starting = manager._player
+    starting.stall(True)
+    handle  = loop.call_every(1, manager.update)
+    started = virtual.now()
+    respawned = fast_forward(settings.start_timeout+5, until=lambda: manager._player is not starting)
+    handle.cancel()
+    offset = manager._player._offset
+    manager.stop()
+
+    # Never moved, so it's given start_timeout rather than stall_timeout,
+    # counted from the second update as the first only sees where it starts
+    expected = settings.start_timeout+2
+    results.append(("slow start respawned after", respawned and respawned-started, expected,
+                    respawned is not None and respawned-started <= expected and
+                    respawned-started > settings.stall_timeout+1 and offset == 120))
+
+def check_finished(results):
+    manager = PlayerManager()
+    players = []
+    def backend():
+        players.append(virtual.now())
+        return StallingPlayer
+    manager._backend = backend
+    video   = FakeVideo()
+    video.is_multipart           = lambda: False
+    video.is_transcode_suggested = lambda: False
+    video.get_playback_url       = lambda direct_play=None: "null://fastforward"
+    display.is_on = True
+
+    manager.play(video, DURATION-10)
+    player   = manager._player
+    handle   = loop.call_every(1, manager.update)
+    started  = virtual.now()
+    finished = fast_forward(15, until=lambda: player.finished)
+    # The manager stops on a worker
+    stopped  = wait_for(lambda: manager.state.state == "stopped")
+    fast_forward(settings.start_timeout+settings.stall_timeout+5)
+    handle.cancel()
+    manager.stop()
+
+    # Stopped at the end rather than taken for a stall and restarted
+    results.append(("playback finished after", finished and finished-started, 10,
+                    finished is not None and finished-started == 10 and stopped and
+                    len(players) == 1 and manager.state.state == "stopped"))
+
+def check_failed_launch(results):
+    manager = PlayerManager()
+    manager._backend = lambda: Player
+    video   = FakeVideo()
+    video.is_multipart           = lambda: False
+    video.is_transcode_suggested = lambda: False
+    video.get_playback_url       = lambda direct_play=None: "http://127.0.0.1/fake.mkv"
+    display.is_on = True
+
+    # Exits straight away without printing any headers
+    launch_cmd, Player._LAUNCH_CMD = Player._LAUNCH_CMD, "/bin/true %s \"%s\""
+    started = time.time()
+    try:
+        manager.play(video)
+        failed = manager._player is None and manager.state.state == "stopped"
+    except Exception:
+        failed = False
+    finally:
+        Player._LAUNCH_CMD = launch_cmd
+    elapsed = time.time()-started
+
+    results.append(("failed launch reported in", elapsed, "<1", failed and elapsed < 1))
+
+def check_osd(results):
+    library = FakeOSDLibrary()
+    osd._OSD__lib = library
+    osd.halt      = False
+
+    manager = PlayerManager()
+    manager._player = NullPlayer("null://fastforward")
+    manager._video  = FakeVideo()
+
+    started = virtual.now()
+    manager.seek(60)
+    loop.sync()
+    hidden  = fast_forward(SHOW_SECONDS*2, until=lambda: library.calls[-1][1] == "hide_osd")
+    manager.stop()
+    osd.halt = True
+
+    # Redrawn every second of playback it was up for, never labelled paused
+    ticks  = [args[0] for when, name, args in library.calls if name == "update_osd"]
+    paused = [args[-1] for when, name, args in library.calls if name in ("show_osd", "update_osd")]
+    results.append(("OSD hid itself after", hidden and hidden-started, SHOW_SECONDS,
+                    hidden is not None and hidden-started == SHOW_SECONDS and
+                    ticks == range(61, 61+SHOW_SECONDS) and not any(paused)))
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="python -m bench.fastforward [options]")
+    parser.add_option("--display-sleep", type="int", default=600, help="display sleep delay in seconds [%default]")
+    parser.add_option("--playback", type="int", default=1800, help="seconds of playback to scrobble [%default]")
+    options, args = parser.parse_args(argv)
+
+    # The checks make omplex warn about stalls and log the failed launch
+    logging.basicConfig(level=logging.CRITICAL)
+
+    loop.start()
+    started = time.time()
+    results = []
+    try:
+        check_subscriber_expiry(results)
+        check_display_sleep(results, options.display_sleep)
+        check_scrobble(results, options.playback)
+        check_stalls(results)
+        check_respawn(results)
+        check_slow_start(results)
+        check_finished(results)
+        check_failed_launch(results)
+        check_osd(results)
+    finally:
+        loop.stop()
+    elapsed = time.time()-started
+
+    print "Fast-forward (%.0f virtual seconds in %.2fs)" % (virtual.now(), elapsed)
+    failed = False
+    for name, value, expected, ok in results:
+        print "  %-26s %8s   expected %s   %s" % (name, value is None and "never" or "%.0fs" % value,
+                                                   expected, ok and "ok" or "FAILED")
+        failed = failed or not ok
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+"""
+playerbench.py - Micro-benchmarks for ``Player`` against a fake omxplayer
+
+Measures how long ``Player`` takes to start, to get the first status line
+after a seek, to step the volume and to stop. It also measures how much CPU
+the event loop spends reading each status line. The fake omxplayer's timing is
+configurable, so slow hardware can be modelled without a Pi.  With
+``--dbus`` the fake also serves omxplayer's D-Bus interface on a private
+session bus, so the D-Bus control path is measured instead of keystrokes.
+
+Results are compared against stored baselines and the run fails when a
+metric regresses beyond its threshold:
+
+    python -m bench.playerbench                     # compare with baselines
+    python -m bench.playerbench --save-baseline     # record new baselines
+"""
+import json
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from e2e import start_session_bus, write_fake_omxplayer
+from stats import summarize
+
+BENCH_DIR       = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE   = os.path.join(BENCH_DIR, "baselines.json")
+
+# name: (description, higher_is_better)
+METRICS = {
+    "startup_ms":               ("spawn until headers are parsed", False),
+    "first_status_ms":          ("spawn until the first status line", False),
+    "seek_first_status_ms":     ("seek until the first status line", False),
+    "volume_sweep_ms":          ("volume 0% to 100%", False),
+    "stop_ms":                  ("stop until omxplayer has exited", False),
+    "reader_cpu_us_per_line":   ("CPU per parsed status line", False),
+    "parse_ratio":              ("status lines parsed / lines emitted", True),
+    "threads":                  ("threads while playing", False),
+}
+
+# Relative slack allowed before a metric counts as a regression, plus an
+# absolute floor so tiny values don't trip on noise
+DEFAULT_TOLERANCE   = 0.25
+ABSOLUTE_SLACK      = {
+    "startup_ms":               20,
+    "first_status_ms":          20,
+    "seek_first_status_ms":     20,
+    "volume_sweep_ms":          20,
+    "stop_ms":                  20,
+    "reader_cpu_us_per_line":   50,
+    "parse_ratio":              0.05,
+    "threads":                  0,
+}
+
+def wait_for(predicate, timeout=10, interval=0.001):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class PlayerBenchmark(object):
+    def __init__(self, options):
+        self.options = options
+
+    def launch(self):
+        from omplex.player import Player
+        return Player(mediafile="http://127.0.0.1/fake.mkv", args=[], start_playback=True)
+
+    def bench_startup(self, results):
+        startup, first_status, stop = [], [], []
+        for i in range(self.options.iterations):
+            started = time.time()
+            player  = self.launch()
+            startup.append(time.time()-started)
+
+            wait_for(lambda: player.status_lines > 0)
+            first_status.append(time.time()-started)
+
+            started = time.time()
+            player.stop()
+            player.wait(10)
+            stop.append(time.time()-started)
+
+        results["startup_ms"]       = summarize(startup)["p50"]*1e3
+        results["first_status_ms"]  = summarize(first_status)["p50"]*1e3
+        results["stop_ms"]          = summarize(stop)["p50"]*1e3
+
+    def bench_seek_and_volume(self, results):
+        player  = self.launch()
+        wait_for(lambda: player.status_lines > 0)
+
+        seeks, sweeps = [], []
+        for i in range(self.options.iterations):
+            started = time.time()
+            player.seek(60*(i+1))
+            wait_for(lambda: player.status_lines > 0)
+            seeks.append(time.time()-started)
+
+            player.set_volume(0)
+            started = time.time()
+            player.set_volume(1)
+            sweeps.append(time.time()-started)
+
+        player.stop()
+        results["seek_first_status_ms"] = summarize(seeks)["p50"]*1e3
+        results["volume_sweep_ms"]      = summarize(sweeps)["p50"]*1e3
+
+    def bench_reader(self, results):
+        player = self.launch()
+        wait_for(lambda: player.status_lines > 0)
+
+        lines   = player.status_lines
+        cpu     = cpu_time()
+        started = time.time()
+        time.sleep(self.options.window)
+        elapsed = time.time()-started
+        cpu     = cpu_time()-cpu
+        lines   = player.status_lines-lines
+
+        results["threads"] = threading.active_count()
+        player.stop()
+
+        emitted = elapsed * self.options.status_rate
+        results["parse_ratio"]              = lines/emitted if emitted else 0
+        results["reader_cpu_us_per_line"]   = cpu*1e6/lines if lines else 0
+
+    def run(self):
+        results = {}
+        self.bench_startup(results)
+        self.bench_seek_and_volume(results)
+        self.bench_reader(results)
+        return results
+
+def scenario_name(options):
+    name = "rate%g-header%g-ack%g-exit%g" % (options.status_rate, options.header_delay,
+                                             options.ack_delay, options.exit_delay)
+    if options.dbus:
+        name += "-dbus"
+    return name
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of ``(metric, value, baseline, limit)`` tuples for every
+    metric that regressed.
+    """
+    regressions = []
+    for name, (description, higher_is_better) in sorted(METRICS.items()):
+        if name not in baseline or name not in results:
+            continue
+        base  = baseline[name]
+        slack = max(abs(base)*tolerance, ABSOLUTE_SLACK.get(name, 0))
+        if higher_is_better:
+            limit = base - slack
+            if results[name] < limit:
+                regressions.append((name, results[name], base, limit))
+        else:
+            limit = base + slack
+            if results[name] > limit:
+                regressions.append((name, results[name], base, limit))
+    return regressions
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="python -m bench.playerbench [options]")
+    parser.add_option("-n", "--iterations", type="int", default=5, help="repetitions of each timed operation")
+    parser.add_option("--status-rate", type="float", default=8, help="fake omxplayer status lines per second")
+    parser.add_option("--header-delay", type="float", default=0.2, help="delay before omxplayer prints its headers")
+    parser.add_option("--ack-delay", type="float", default=0, help="delay before omxplayer acts on a keystroke")
+    parser.add_option("--exit-delay", type="float", default=0.05, help="delay between quit and exit")
+    parser.add_option("--window", type="float", default=5, help="seconds to measure the status reader for")
+    parser.add_option("--dbus", action="store_true", help="control the fake omxplayer over D-Bus")
+    parser.add_option("--baselines", default=BASELINE_FILE, help="baseline file [%default]")
+    parser.add_option("--tolerance", type="float", default=DEFAULT_TOLERANCE, help="allowed relative regression [%default]")
+    parser.add_option("--save-baseline", action="store_true", help="store the results as the new baseline")
+    options, args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="omplex-playerbench-")
+    os.environ.update({
+        "OMPLEX_OMXPLAYER":         write_fake_omxplayer(workdir),
+        "FAKE_OMX_STATUS_RATE":     str(options.status_rate),
+        "FAKE_OMX_HEADER_DELAY":    str(options.header_delay),
+        "FAKE_OMX_ACK_DELAY":       str(options.ack_delay),
+        "FAKE_OMX_EXIT_DELAY":      str(options.exit_delay),
+    })
+
+    bus = None
+    if options.dbus:
+        bus, address = start_session_bus()
+        os.environ["OMPLEX_OMXPLAYER_DBUS"] = address
+        os.environ["FAKE_OMX_DBUS"]         = address
+
+    from omplex.loop import loop
+    loop.start()
+    try:
+        results = PlayerBenchmark(options).run()
+    finally:
+        loop.stop()
+        if bus:
+            bus.terminate()
+            bus.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    scenario = scenario_name(options)
+
+    print "Player benchmark (%s)" % scenario
+    for name, (description, higher_is_better) in sorted(METRICS.items()):
+        print "  %-24s %10.2f   %s" % (name, results[name], description)
+
+    baselines = load_baselines(options.baselines)
+    if options.save_baseline:
+        baselines[scenario] = results
+        with open(options.baselines, "w") as fh:
+            json.dump(baselines, fh, indent=2, sort_keys=True)
+        print "\nSaved baseline to %s" % options.baselines
+        return 0
+
+    if scenario not in baselines:
+        print "\nNo baseline stored for this scenario, run with --save-baseline"
+        return 0
+
+    regressions = compare(results, baselines[scenario], options.tolerance)
+    if not regressions:
+        print "\nNo regressions against the baseline"
+        return 0
+
+    print "\nRegressions:"
+    for name, value, base, limit in regressions:
+        print "  %-24s %10.2f   baseline %.2f, limit %.2f" % (name, value, base, limit)
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
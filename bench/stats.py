@@ -0,0 +1,92 @@
+"""
+stats.py - Helpers for summarizing benchmark samples
+"""
+import math
+import os
+import threading
+import time
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE   = os.sysconf("SC_PAGE_SIZE")
+
+def percentile(values, pct):
+    """
+    Returns the ``pct`` percentile (0-100) of ``values`` using linear
+    interpolation between the closest ranks.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank   = (len(values)-1) * pct / 100.0
+    low    = int(math.floor(rank))
+    high   = int(math.ceil(rank))
+    if low == high:
+        return values[low]
+    return values[low] + (values[high]-values[low]) * (rank-low)
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    mean = sum(values)/float(len(values))
+    return {
+        "count":    len(values),
+        "mean":     mean,
+        "stdev":    math.sqrt(sum([(v-mean)**2 for v in values])/len(values)),
+        "min":      min(values),
+        "p50":      percentile(values, 50),
+        "p90":      percentile(values, 90),
+        "p99":      percentile(values, 99),
+        "max":      max(values)
+    }
+
+def read_proc_stats(pid):
+    """
+    Returns ``(cpu_seconds, rss_bytes, threads)`` for ``pid`` from ``/proc``.
+    """
+    with open("/proc/%d/stat" % pid) as fh:
+        # The command name may contain spaces, so split after it
+        fields = fh.read().rsplit(")", 1)[1].split()
+    cpu     = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    threads = int(fields[17])
+    rss     = int(fields[21]) * PAGE_SIZE
+    return cpu, rss, threads
+
+class ProcessSampler(threading.Thread):
+    """
+    Samples CPU time, resident memory and thread count of a process at a
+    fixed interval until stopped.
+    """
+    def __init__(self, pid, interval=0.5):
+        threading.Thread.__init__(self, name="Process sampler")
+        self.daemon     = True
+        self.pid        = pid
+        self.interval   = interval
+        self.samples    = []
+        self._halt      = threading.Event()
+
+    def run(self):
+        while not self._halt.is_set():
+            try:
+                cpu, rss, threads = read_proc_stats(self.pid)
+            except (IOError, OSError, IndexError):
+                break
+            self.samples.append((time.time(), cpu, rss, threads))
+            self._halt.wait(self.interval)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+    def summary(self):
+        if len(self.samples) < 2:
+            return {}
+        t0, cpu0 = self.samples[0][:2]
+        t1, cpu1 = self.samples[-1][:2]
+        return {
+            "cpu_percent":  100.0 * (cpu1-cpu0) / (t1-t0),
+            "cpu_seconds":  cpu1-cpu0,
+            "rss_max_mb":   max([s[2] for s in self.samples]) / 1048576.0,
+            "rss_last_mb":  self.samples[-1][2] / 1048576.0,
+            "threads_max":  max([s[3] for s in self.samples]),
+            "threads_last": self.samples[-1][3]
+        }
@@ -1 +1,4 @@
-__version__ = "0.2.0"
\ No newline at end of file
+__version__ = "0.2.0"
+
+# Imported first so that the startup profile sees every other import
+import startup
\ No newline at end of file
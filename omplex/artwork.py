@@ -0,0 +1,192 @@
+"""
+artwork.py - Posters for the OSD
+
+The OSD shows the poster of what's playing next to its title.  Posters are
+fetched through the Plex photo transcoder, already resized to the size the
+OSD draws them at, so the Pi only ever decodes a small JPEG.
+
+Fetched posters are kept in a directory, one file per video, size and
+``updatedAt``, so a changed poster is fetched again.  Once the directory
+holds more than ``MAX_BYTES`` the least recently used posters are removed.
+Nothing here blocks except ``fetch``, the OSD only shows a poster that's
+already on disk and ``prefetch`` fetches on a worker:
+
+    artworkCache.load("artwork")
+    artworkCache.prefetch(video, (120, 180))
+    artworkCache.get(video, (120, 180))     # The poster's path, once fetched
+"""
+import collections
+import logging
+import os
+import threading
+
+from loop import loop
+from metrics import registry
+from utils import plex_urlopen
+
+# Bytes of posters kept on disk
+MAX_BYTES       = 20*1024*1024
+
+log = logging.getLogger("artwork")
+
+ARTWORK_LOOKUPS = registry.counter("omplex_artwork_lookups_total",
+                                   "Posters asked for by the OSD, by whether they were cached", ("result",))
+ARTWORK_FETCHES = registry.counter("omplex_artwork_fetches_total",
+                                   "Posters fetched from a Plex server", ("result",))
+
+class ArtworkCache(object):
+    """
+    Resized posters on disk, least recently used first.
+    """
+    def __init__(self):
+        self._dir       = None
+        self._files     = collections.OrderedDict()
+        self._bytes     = 0
+        self._fetching  = set()
+        self._lock      = threading.Lock()
+
+    def load(self, directory):
+        """
+        Uses ``directory`` for posters, picking up those already in it.
+        """
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            names = os.listdir(directory)
+        except OSError, e:
+            log.error("ArtworkCache::load unable to use %s: %s" % (directory, e))
+            return False
+
+        files = []
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if not name.endswith(".jpg"):
+                    # Left over from an interrupted fetch
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        with self._lock:
+            self._dir = directory
+            # Used posters are touched, so the oldest were used longest ago
+            for mtime, name, size in sorted(files):
+                self._files[name] = size
+                self._bytes      += size
+            self._evict()
+        log.debug("ArtworkCache::load %d posters, %d bytes" % (len(files), self._bytes))
+        return True
+
+    def _filename(self, video, size):
+        rating_key = video.get_video_attr("ratingKey")
+        if not rating_key:
+            return
+        return "%s-%dx%d-%s.jpg" % (rating_key, size[0], size[1], video.get_video_attr("updatedAt", "0"))
+
+    def get(self, video, size):
+        """
+        Returns the path of ``video``'s poster at ``size`` if it's been
+        fetched, otherwise None.  Only looks at what's in memory.
+        """
+        name = self._filename(video, size)
+        with self._lock:
+            if self._dir is None or name not in self._files:
+                ARTWORK_LOOKUPS.inc(result="miss")
+                return
+            self._files[name] = self._files.pop(name)
+            path = os.path.join(self._dir, name)
+        ARTWORK_LOOKUPS.inc(result="hit")
+
+        # Keeps the order across restarts, and a removed file is fetched
+        # again by the next prefetch
+        loop.run_in_worker(self._touch, name)
+        return path
+
+    def _touch(self, name):
+        try:
+            os.utime(os.path.join(self._dir, name), None)
+        except OSError:
+            with self._lock:
+                self._bytes -= self._files.pop(name, 0)
+
+    def prefetch(self, video, size):
+        """
+        Fetches ``video``'s poster at ``size`` on a worker, unless it's
+        cached or already being fetched.
+        """
+        name = self._filename(video, size)
+        with self._lock:
+            if self._dir is None or not name or name in self._files or name in self._fetching:
+                return
+            self._fetching.add(name)
+        loop.run_in_worker(self._fetch, video, size, name)
+
+    def fetch(self, video, size):
+        """
+        Fetches ``video``'s poster at ``size`` now and returns its path, or
+        None if it has none or it couldn't be fetched.
+        """
+        name = self._filename(video, size)
+        with self._lock:
+            if self._dir is None or not name:
+                return
+            self._fetching.add(name)
+        return self._fetch(video, size, name)
+
+    def _fetch(self, video, size, name):
+        try:
+            url = video.get_artwork_url(*size)
+            if not url:
+                return
+
+            try:
+                response = plex_urlopen(url, "artwork")
+            except Exception, e:
+                log.error("ArtworkCache::fetch error fetching %s: %s" % (name, e))
+                ARTWORK_FETCHES.inc(result="error")
+                return
+            if response.status_code != 200 or not response.content:
+                log.warning("ArtworkCache::fetch no poster for %s, server returned %d" % (name, response.status_code))
+                ARTWORK_FETCHES.inc(result="error")
+                return
+
+            path     = os.path.join(self._dir, name)
+            tmp_path = "%s.tmp" % path
+            try:
+                fh = open(tmp_path, "wb")
+                try:
+                    fh.write(response.content)
+                finally:
+                    fh.close()
+                os.rename(tmp_path, path)
+            except Exception, e:
+                log.error("ArtworkCache::fetch error saving %s: %s" % (path, e))
+                ARTWORK_FETCHES.inc(result="error")
+                return
+
+            ARTWORK_FETCHES.inc(result="ok")
+            with self._lock:
+                self._bytes     -= self._files.pop(name, 0)
+                self._files[name] = len(response.content)
+                self._bytes     += len(response.content)
+                self._evict()
+            log.debug("ArtworkCache::fetch saved %s" % name)
+            return path
+        finally:
+            with self._lock:
+                self._fetching.discard(name)
+
+    def _evict(self):
+        # Never removes the newest, even if it's over the limit on its own
+        while self._bytes > MAX_BYTES and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(os.path.join(self._dir, name))
+            except OSError, e:
+                log.warning("ArtworkCache::_evict unable to remove %s: %s" % (name, e))
+
+artworkCache = ArtworkCache()
@@ -0,0 +1,155 @@
+"""
+backend.py - Playback engines
+
+``PlayerManager`` plays each part through a backend, picked by the
+``player_backend`` setting:
+
+    omxplayer   omxplayer on a Raspberry Pi (``player.Player``)
+    mpv         mpv, controlled over its JSON IPC socket (``mpv.MPVPlayer``)
+    null        plays nothing and keeps time against omplex's clock, for
+                running and load-testing omplex anywhere (``nullplayer.NullPlayer``)
+
+A backend is a ``PlayerBackend`` subclass.  Each instance plays one media
+file, starting as soon as it's created, and is thrown away once stopped.
+
+Example usage:
+
+    backend = get_backend(settings.player_backend)
+    player  = backend(url, offset=60, audio_idx=2, finished_callback=done)
+    player.seek(120)
+    player.stop()
+"""
+import logging
+
+from loop import loop
+
+DEFAULT_BACKEND = "omxplayer"
+
+# name: (module, class), imported when first used
+BACKENDS = {
+    "omxplayer":    ("player",      "Player"),
+    "mpv":          ("mpv",         "MPVPlayer"),
+    "null":         ("nullplayer",  "NullPlayer"),
+}
+
+log = logging.getLogger("backend")
+
+def get_backend(name):
+    """
+    Returns the backend class called ``name``.
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown player backend '%s', expected one of %s" % (name, ", ".join(sorted(BACKENDS))))
+    module, cls = BACKENDS[name]
+    return getattr(__import__(module, globals(), locals(), [cls]), cls)
+
+class PlayerBackend(object):
+    """
+    Plays ``mediafile`` from ``offset`` seconds.  ``audio_idx`` and
+    ``subtitle_idx`` pick streams counting from 1, no ``subtitle_idx``
+    means no subtitles.  ``finished_callback`` is called on a worker, with
+    no arguments, when playback reaches the end by itself but not after
+    ``stop``.
+
+    Subclasses keep ``position``, in seconds, up to date as playback goes.
+    Those that can also keep ``last_status``, the ``clock`` time the engine
+    last reported in, and ``buffered``, the seconds of media it has ready to
+    play, so the ``Watchdog`` can tell why playback stalled.
+    """
+    name        = None
+    last_status = None
+    buffered    = None
+
+    def __init__(self, mediafile, offset=0, audio_idx=None, subtitle_idx=None, finished_callback=None):
+        self.mediafile         = mediafile
+        self.finished_callback = finished_callback
+        self.finished          = False
+        self.stopped           = False
+        self._paused           = False
+
+    @classmethod
+    def available(cls):
+        """
+        Returns whether the backend can be used on this machine.
+        """
+        return True
+
+    @classmethod
+    def probe_duration(cls, url):
+        """
+        Returns the duration of ``url`` in seconds, or None if the backend
+        can't tell.  May be slow, don't call it on the event loop thread.
+        """
+        return None
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def _ended(self):
+        """
+        To be called once playback has stopped, for whatever reason.
+        """
+        if self.stopped:
+            return
+
+        log.debug("PlayerBackend::_ended %s reached end of video" % self.name)
+        self.finished = True
+        if callable(self.finished_callback):
+            loop.run_in_worker(self.finished_callback)
+
+    def query_position(self):
+        """
+        Returns the position in seconds.  Backends that can ask the engine
+        for a fresher position than ``position`` do so here.
+        """
+        return self.position
+
+    def play(self):
+        if self._paused:
+            self.toggle_pause()
+
+    def pause(self):
+        if not self._paused:
+            self.toggle_pause()
+
+    def toggle_pause(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def wait(self, timeout=None):
+        """
+        Blocks until playback has stopped.  Returns ``False`` if it was
+        still going after ``timeout`` seconds.
+        """
+        raise NotImplementedError
+
+    def seek(self, offset):
+        raise NotImplementedError
+
+    def get_volume(self):
+        """
+        Returns the volume between 0 and 1.
+        """
+        raise NotImplementedError
+
+    def set_volume(self, pct):
+        """
+        Sets the volume to ``pct``, between 0 and 1.
+        """
+        raise NotImplementedError
+
+    def set_audiochannel(self, audio_idx):
+        """
+        Switches to another audio stream without restarting, returns whether
+        it worked.  Raises ``NotImplementedError`` if the backend can't.
+        """
+        raise NotImplementedError
+
+    def set_subtitles(self, subtitle_idx):
+        """
+        Like ``set_audiochannel`` for subtitles, None hides them.
+        """
+        raise NotImplementedError
@@ -0,0 +1,280 @@
+"""
+bandwidth.py - Transcode quality from measured throughput
+
+omxplayer downloads transcoded segments itself, so the throughput of the
+playback path is measured from the bytes received on the network interface
+while a video plays.  Segments are fetched in bursts at whatever speed the
+link allows, then nothing until the player wants more, so only the seconds
+in which something was downloading count towards a server's estimate.
+
+The quality of a transcode is picked from ``QUALITIES`` to fit the server's
+estimate, or failing that, the quality last used on the same network.  When
+playback keeps stalling the manager steps down the list and remembers the
+lower quality for the network, which is told apart by its default gateway.
+Estimates change with every sample, so to spare the SD card they're only
+written when playback stops, or along with a change of quality:
+
+    qualityManager.load("quality.dat")
+
+    quality = qualityManager.initial(server_url)    # An index into QUALITIES
+    bitrate, width, height = QUALITIES[quality]
+    quality = qualityManager.lower(server_url, quality)
+    qualityManager.playback_stopped()               # Saves the new estimates
+"""
+import logging
+import socket
+import struct
+import threading
+
+from clock import monotonic
+from metrics import registry
+from picklefile import PickleFile
+
+# Transcode qualities as (kbps, width, height), best first
+QUALITIES = [
+    (20000, 1920, 1080),
+    (12000, 1920, 1080),
+    (8000,  1920, 1080),
+    (4000,  1280, 720),
+    (3000,  1280, 720),
+    (2000,  1280, 720),
+    (1500,  720,  480),
+    (720,   576,  320),
+]
+
+# Fraction of the estimated throughput a transcode may use
+HEADROOM        = 0.7
+
+# Smoothing factor of the throughput estimates
+ALPHA           = 0.3
+
+# Seconds receiving less than this many bits per second were idle
+IDLE_BPS        = 256*1000
+
+log = logging.getLogger("bandwidth")
+
+THROUGHPUT      = registry.gauge("omplex_throughput_bits_per_second",
+                                 "Estimated download throughput from each server", ("server",))
+QUALITY_CHANGES = registry.counter("omplex_transcode_quality_changes_total",
+                                   "Times the transcode quality was lowered because playback stalled")
+
+def default_route():
+    """
+    Returns the interface and gateway address of the default route, or
+    (None, None) if there isn't one or it can't be read.
+    """
+    try:
+        fh = open("/proc/net/route")
+        try:
+            lines = fh.readlines()[1:]
+        finally:
+            fh.close()
+    except IOError:
+        return None, None
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 2 and fields[1] == "00000000":
+            gateway = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+            return fields[0], gateway
+    return None, None
+
+def current_network():
+    """
+    Names the network we're on after the default gateway's hardware
+    address, which tells apart home networks that all use 192.168.1.1.
+    """
+    interface, gateway = default_route()
+    if interface is None:
+        return "unknown"
+
+    try:
+        fh = open("/proc/net/arp")
+        try:
+            for line in fh.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 5 and fields[0] == gateway and fields[5] == interface:
+                    return "%s %s" % (interface, fields[3])
+        finally:
+            fh.close()
+    except IOError:
+        pass
+    return "%s %s" % (interface, gateway)
+
+def received_bytes(interface):
+    """
+    Returns the bytes received so far on ``interface``, or None.
+    """
+    try:
+        fh = open("/proc/net/dev")
+        try:
+            for line in fh.readlines()[2:]:
+                name, sep, counters = line.partition(":")
+                if name.strip() == interface:
+                    return int(counters.split()[0])
+        finally:
+            fh.close()
+    except (IOError, ValueError):
+        pass
+
+class QualityManager(object):
+    """
+    Throughput estimates per network and server, and the transcode quality
+    last picked on each network.  Both are kept on disk between runs.
+    """
+    def __init__(self):
+        self._estimates     = {}
+        self._qualities     = {}
+        self._lock          = threading.RLock()
+        self._file          = PickleFile(self._snapshot)
+
+        self._network       = None
+        self._interface     = None
+        self._last_sample   = None
+
+        # Whether the estimates changed since they were last saved
+        self._measured      = False
+
+    def _snapshot(self):
+        with self._lock:
+            return {"estimates": dict(self._estimates), "qualities": dict(self._qualities)}
+
+    def load(self, path):
+        try:
+            data = self._file.load(path)
+        except Exception, e:
+            log.error("QualityManager::load error loading %s: %s" % (path, e))
+            return False
+        if data is None:
+            return True
+
+        with self._lock:
+            self._estimates.update(data.get("estimates", {}))
+            self._qualities.update(data.get("qualities", {}))
+        return True
+
+    def flush(self):
+        """
+        Writes the estimates and qualities now, instead of once the changes
+        have settled.
+        """
+        return self._file.flush()
+
+    def network(self):
+        """
+        The network we're on, looked up again whenever playback starts.
+        """
+        if self._network is None:
+            self._network = current_network()
+        return self._network
+
+    def playback_started(self):
+        """
+        Starts measuring afresh, the network may have changed since.
+        """
+        with self._lock:
+            self._network           = current_network()
+            self._interface, unused = default_route()
+            self._last_sample       = None
+        log.debug("QualityManager::playback_started on network %s" % self._network)
+
+    def playback_stopped(self):
+        """
+        Saves the estimates, if playback changed them.
+        """
+        with self._lock:
+            if self._measured:
+                self._measured = False
+                self._file.save()
+
+    def measure(self, server):
+        """
+        Samples the bytes received since the last call, once a second or so
+        while ``server`` is streaming to us.
+        """
+        with self._lock:
+            if self._interface is None:
+                return
+            received = received_bytes(self._interface)
+            now      = monotonic()
+            last, self._last_sample = self._last_sample, (now, received)
+
+        if received is None or last is None or last[1] is None or now <= last[0]:
+            return
+        bps = (received-last[1])*8/(now-last[0])
+        if bps >= IDLE_BPS:
+            self.record(server, bps)
+
+    def record(self, server, bps):
+        key = (self.network(), server)
+        with self._lock:
+            estimate = self._estimates.get(key)
+            if estimate is None:
+                self._estimates[key] = bps
+            else:
+                self._estimates[key] = estimate + ALPHA*(bps-estimate)
+            self._measured = True
+
+    def estimates(self):
+        """
+        Returns the estimates on this network keyed by server.
+        """
+        network = self.network()
+        with self._lock:
+            return dict([(server, bps) for (net, server), bps in self._estimates.items() if net == network])
+
+    def estimate(self, server):
+        """
+        Returns the estimated throughput from ``server`` in bits per
+        second, or None if nothing was measured on this network yet.
+        """
+        with self._lock:
+            return self._estimates.get((self.network(), server))
+
+    def initial(self, server):
+        """
+        Returns the quality to start a transcode from ``server`` at.
+        """
+        estimate = self.estimate(server)
+        if estimate is not None:
+            for quality, (kbps, width, height) in enumerate(QUALITIES):
+                if kbps*1000 <= estimate*HEADROOM:
+                    break
+            log.debug("QualityManager::initial %s estimated at %d kbps, picked %d kbps" %
+                      (server, estimate/1000, QUALITIES[quality][0]))
+        else:
+            with self._lock:
+                quality = self._qualities.get(self.network(), 0)
+
+        with self._lock:
+            if self._qualities.get(self.network()) != quality:
+                self._qualities[self.network()] = quality
+                self._file.save()
+        return quality
+
+    def lower(self, server, quality):
+        """
+        Returns the quality below ``quality`` for when playback keeps
+        stalling, or None if it's already the lowest.  The new quality is
+        remembered for the network and caps the server's estimate, so the
+        next video doesn't start where this one stalled.
+        """
+        if quality >= len(QUALITIES)-1:
+            return None
+
+        quality += 1
+        QUALITY_CHANGES.inc()
+        log.info("QualityManager::lower lowering %s to %d kbps" % (server, QUALITIES[quality][0]))
+        with self._lock:
+            key = (self.network(), server)
+            cap = QUALITIES[quality][0]*1000/HEADROOM + 1
+            if key in self._estimates:
+                self._estimates[key] = min(self._estimates[key], cap)
+            self._qualities[self.network()] = quality
+            self._measured = False
+            self._file.save()
+        return quality
+
+qualityManager = QualityManager()
+
+THROUGHPUT.set_function(lambda: dict([((server,), bps) for server, bps in qualityManager.estimates().items()]))
@@ -1,11 +1,9 @@
 import cgi
-import datetime
 import json
 import logging
 import os
 import posixpath
-import threading
-import requests
+import Queue
 import urllib
 import urlparse
 
@@ -13,29 +11,37 @@ from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 from SocketServer import ThreadingMixIn
 
-try:
-    from xml.etree import cElementTree as et
-except:
-    from xml.etree import ElementTree as et
-
-try:
-    from cStringIO import cStringIO
-except:
-    from StringIO import StringIO
-
+from artwork import artworkCache
+from clock import monotonic
 from conf import settings
+from loop import WorkerPool, loop
 from media import Media
+from metrics import registry
+from osd import ARTWORK_SIZE
 from player import playerManager
+from responses import http_date, serialize, standard_response
+from servers import serverTracker
 from subscribers import remoteSubscriberManager, RemoteSubscriber
 from timeline import timelineManager
+from trace import tracer
 
 log = logging.getLogger("client")
 
 STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
+# Threads serving HTTP requests, and requests that may wait for one before
+# new ones are turned away
+HTTP_THREADS = 8
+HTTP_BACKLOG = 32
+
+HTTP_REQUEST_SECONDS = registry.histogram("omplex_http_request_seconds",
+                                          "Time spent handling HTTP requests", ("route",))
+
 class HttpHandler(SimpleHTTPRequestHandler):
-    xmlOutput   = None
-    completed   = False
+    xmlOutput       = None
+    completed       = False
+    route           = None
+    extra_headers   = None
     
     handlers    = (
         (("/resources",),                       "resources"),
@@ -63,18 +69,29 @@ class HttpHandler(SimpleHTTPRequestHandler):
           "/player/playback/bigStepBack",),     "stepFunction"),
     )
 
+    # Don't let a client that never finishes its request hold on to one of
+    # the server's threads for long
+    timeout = 10
+
     def log_request(self, *args, **kwargs):
         pass
 
-    def setStandardResponse(self, code=200, status="OK"):
-        el = et.Element("Response")
-        el.set("code",      str(code))
-        el.set("status",    str(status))
+    def handle_one_request(self):
+        self.route = None
+        started    = monotonic()
 
-        if self.xmlOutput:
-            self.xmlOutput.append(el)
-        else:
-            self.xmlOutput = el
+        SimpleHTTPRequestHandler.handle_one_request(self)
+
+        if self.route:
+            HTTP_REQUEST_SECONDS.observe(monotonic()-started, route=self.route)
+
+    def date_time_string(self, timestamp=None):
+        if timestamp is None:
+            return http_date()
+        return SimpleHTTPRequestHandler.date_time_string(self, timestamp)
+
+    def setStandardResponse(self, code=200, status="OK"):
+        self.xmlOutput = standard_response(code, status)
 
     def getSubFromRequest(self, arguments):
         uuid = self.headers.get("X-Plex-Client-Identifier", None)
@@ -135,14 +152,15 @@ class HttpHandler(SimpleHTTPRequestHandler):
         path  = urlparse.urlparse(self.path)
         query = self.get_querydict(path.query)
 
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("X-Plex-Client-Identifier",    settings.client_uuid)
+        self.extra_headers = [
+            ("Access-Control-Allow-Origin", "*"),
+            ("X-Plex-Client-Identifier",    settings.client_uuid)
+        ]
 
         if method == "OPTIONS" and self.headers.has_key("Access-Control-Request-Method"):
-            # TODO: This isn't working...
-
-            #self.protocol_version = "HTTP/1.1"
-
+            self.send_response(200)
+            for key, value in self.extra_headers:
+                self.send_header(key, value)
             self.send_header("Content-Type", "text/plain")
             self.send_header("Access-Control-Allow-Methods", "POST, GET, OPTIONS, DELETE, PUT, HEAD")
             self.send_header("Access-Control-Max-Age", "1209600")
@@ -152,12 +170,11 @@ class HttpHandler(SimpleHTTPRequestHandler):
                 self.send_header("Access-Control-Allow-Headers", self.headers["Access-Control-Request-Headers"])
 
             self.end_headers()
-            self.send_response(200)
             self.wfile.flush()
 
             return
 
-        self.send_header("Content-type", "text/xml")
+        self.extra_headers.append(("Content-type", "text/xml"))
         self.setStandardResponse()
 
         self.updateCommandID(query)
@@ -166,13 +183,16 @@ class HttpHandler(SimpleHTTPRequestHandler):
         for paths, handler in self.handlers:
             if path.path in paths:
                 match = True
+                self.route = handler
                 getattr(self, handler)(path, query)
                 break
 
         if not match:
             if path.path.startswith("/player/navigation"):
+                self.route = "navigation"
                 navigation(path, query)
             else:
+                self.route = "unknown"
                 self.setStandardResponse(500, "Nope, not implemented, sorry!")
 
         self.send_end()
@@ -198,6 +218,7 @@ class HttpHandler(SimpleHTTPRequestHandler):
             postvars = {}
 
         if self.path == "/data/settings/":
+            self.route = "settings"
             response = {
                 "success": True,
                 "message": ""
@@ -221,10 +242,10 @@ class HttpHandler(SimpleHTTPRequestHandler):
                     })
 
             if response["success"]:
-                settings.myplex_username = myplex_username
-                settings.myplex_password = myplex_password
-                settings.player_name     = player_name
-                settings.audio_output    = audio_output
+                settings.update(myplex_username=myplex_username,
+                                myplex_password=myplex_password,
+                                player_name=player_name,
+                                audio_output=audio_output)
 
             data = json.dumps(response)
 
@@ -236,12 +257,14 @@ class HttpHandler(SimpleHTTPRequestHandler):
             self.wfile.write(data)
 
     def do_GET(self):
-        if self.path == "/":           
+        if self.path == "/":
+            self.route = "static"
             f = self.send_head()
             if f:
                 self.copyfile(f, self.wfile)
                 f.close()
         elif self.path == "/data/settings/":
+            self.route = "settings"
             data = json.dumps(settings._data)
             
             self.send_response(200)
@@ -249,6 +272,26 @@ class HttpHandler(SimpleHTTPRequestHandler):
             self.send_header("Content-Length", str(len(data)))
             self.end_headers()
             
+            self.wfile.write(data)
+        elif self.path == "/debug/trace":
+            self.route = "trace"
+            data = tracer.export()
+
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+
+            self.wfile.write(data)
+        elif self.path == "/metrics":
+            self.route = "metrics"
+            data = registry.render()
+
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+
             self.wfile.write(data)
         else:
             self.handle_request("GET")
@@ -257,22 +300,21 @@ class HttpHandler(SimpleHTTPRequestHandler):
         if self.completed:
             return
 
-        response = StringIO()
-        tree     = et.ElementTree(self.xmlOutput)
-        tree.write(response, encoding="utf-8", xml_declaration=True)
-        response.seek(0)
-
-        xmlData = response.read()
-
-        self.send_response(200)
-
-        self.send_header("Date", datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"))
-        self.send_header("Content-Length", str(len(xmlData)))
-        #self.send_header("Connection", 'Close')
-        
-        self.end_headers()
-
-        self.wfile.write(xmlData)
+        if isinstance(self.xmlOutput, str):
+            xmlData = self.xmlOutput
+        else:
+            xmlData = serialize(self.xmlOutput)
+
+        # Status line, headers and body go out in a single write
+        head = [
+            "%s 200 OK" % self.protocol_version,
+            "Server: %s" % self.version_string(),
+            "Date: %s" % http_date()
+        ]
+        head.extend(["%s: %s" % header for header in self.extra_headers or []])
+        head.append("Content-Length: %d" % len(xmlData))
+
+        self.wfile.write("%s\r\n\r\n%s" % ("\r\n".join(head), xmlData))
         self.wfile.flush()
         self.wfile.close()
 
@@ -285,10 +327,11 @@ class HttpHandler(SimpleHTTPRequestHandler):
         sub = self.getSubFromRequest(arguments)
         if sub:
             remoteSubscriberManager.addSubscriber(sub)
+            serverTracker.warm()
             
             self.send_end()
 
-            timelineManager.SendTimelineToSubscriber(sub)
+            loop.run_in_worker(timelineManager.SendTimelineToSubscriber, sub)
 
     def unsubscribe(self, path, arguments):
         remoteSubscriberManager.removeSubscriber(self.getSubFromRequest(arguments))
@@ -310,13 +353,14 @@ class HttpHandler(SimpleHTTPRequestHandler):
 
         pollSubscriber = RemoteSubscriber(uuid, commandID, name=name)
         remoteSubscriberManager.addSubscriber(pollSubscriber)
+        serverTracker.warm()
 
         if arguments.has_key("wait") and arguments["wait"] in ("1", "true"):
             self.xmlOutput = timelineManager.WaitForTimeline(pollSubscriber)
         else:
             self.xmlOutput = timelineManager.GetCurrentTimeLinesXML(pollSubscriber)
 
-        self.send_header("Access-Control-Expose-Headers", "X-Plex-Client-Identifier")
+        self.extra_headers.append(("Access-Control-Expose-Headers", "X-Plex-Client-Identifier"))
 
     def resources(self, path, arguments):
         pass
@@ -328,15 +372,25 @@ class HttpHandler(SimpleHTTPRequestHandler):
         key         = arguments.get("key",          None)
         offset      = int(int(arguments.get("offset",   0))/1e3)
         url         = urlparse.urljoin("%s://%s:%s" % (protocol, address, port), key)
-        media       = Media(url)
 
-        log.debug("HttpHandler::playMedia %s" % media)
+        # Traced up to omxplayer's first status line, see /debug/trace
+        with tracer.session("playMedia", key=key, offset=offset) as trace:
+            media = Media(url)
+
+            log.debug("HttpHandler::playMedia %s" % media)
+
+            # TODO: Select video, media and part here based off user settings
+            video = media.get_video(0)
+            if not video:
+                trace.finish("no video")
+                return
+
+            # Fetched while the player starts, ready for when it's paused
+            artworkCache.prefetch(video, ARTWORK_SIZE)
 
-        # TODO: Select video, media and part here based off user settings
-        video = media.get_video(0)
-        if video:
             playerManager.play(video, offset)
-            timelineManager.SendTimelineToSubscribers()
+            with tracer.span("send timelines"):
+                timelineManager.SendTimelineToSubscribers()
 
     def stop(self, path, arguments):
         playerManager.stop()
@@ -354,6 +408,14 @@ class HttpHandler(SimpleHTTPRequestHandler):
         log.debug("HttpHandler::seekTo offset %ss" % offset)
         playerManager.seek(offset)
 
+    def setStreams(self, path, arguments):
+        audio_id    = arguments.get("audioStreamID",    None)
+        subtitle_id = arguments.get("subtitleStreamID", None)
+        log.debug("HttpHandler::setStreams audio %s subtitles %s" % (audio_id, subtitle_id))
+        playerManager.set_streams(audio_id, subtitle_id)
+
+        timelineManager.SendTimelineToSubscribers()
+
     def set(self, path, arguments):
         if arguments.has_key("volume"):
             volume = arguments["volume"]
@@ -364,20 +426,76 @@ class HttpHandler(SimpleHTTPRequestHandler):
 class HttpSocketServer(ThreadingMixIn, HTTPServer):
     allow_reuse_address = True
 
-class HttpServer(threading.Thread):
-    def __init__(self, queue, port):
-        super(HttpServer, self).__init__(name="HTTP Server")
+    pool = None
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+
+        # Connections whose request hasn't arrived yet, by file descriptor
+        self._waiting = {}
+
+    def process_request(self, request, client_address):
+        """
+        Waits on the event loop until the client sends its request, so idle
+        connections don't tie up a thread.  Runs on the loop thread.
+        """
+        handle = loop.call_later(HttpHandler.timeout, self._drop, request)
+        self._waiting[request.fileno()] = (request, handle)
+        loop.add_reader(request, self._on_request, request, client_address)
+
+    def _on_request(self, request, client_address):
+        """
+        Serves the connection on one of the server's own threads, slow
+        clients can't hold up the event loop's workers this way.
+        """
+        loop.remove_reader(request)
+        self._waiting.pop(request.fileno())[1].cancel()
+        try:
+            self.pool.submit(self.process_request_thread, request, client_address)
+        except Queue.Full:
+            log.warning("HttpSocketServer::_on_request too many requests, dropping %s" % client_address[0])
+            self.shutdown_request(request)
 
-        self.daemon         = True
+    def _drop(self, request):
+        if self._waiting.pop(request.fileno(), None) is None:
+            return
+        loop.remove_reader(request)
+        self.shutdown_request(request)
+
+    def server_close(self):
+        for request, handle in self._waiting.values():
+            handle.cancel()
+            self._drop(request)
+        HTTPServer.server_close(self)
+
+class HttpServer(object):
+    """
+    Accepts connections from the event loop thread, requests are handled by
+    a pool of ``HTTP_THREADS`` threads.
+    """
+    def __init__(self, queue, port=None):
         self.port           = port
         self.queue          = queue
+        self.server         = None
+
+    def start(self, port=None):
+        """
+        Binds the listening socket, on ``port`` if given.
+        """
+        if port is not None:
+            self.port = port
         self.server         = HttpSocketServer(("", self.port), HttpHandler)
-        self.server.queue   = queue
-
-    def run(self):
+        self.server.queue   = self.queue
+        self.server.pool    = WorkerPool("http", HTTP_THREADS, HTTP_BACKLOG)
+        self.server.pool.start()
+        loop.add_reader(self.server, self.server._handle_request_noblock)
         log.info("Started HTTP server")
-        self.server.serve_forever()
 
     def stop(self):
+        if self.server is None:
+            return
         log.info("Stopping HTTP server...")
-        self.server.shutdown()
+        loop.remove_reader(self.server)
+        self.server.server_close()
+        self.server.pool.stop()
+        self.server = None
@@ -0,0 +1,143 @@
+"""
+clock.py - The clock omplex schedules against
+
+``monotonic()`` reads ``CLOCK_MONOTONIC``, which never jumps when NTP or the
+user corrects the wall clock.  Use it for anything that measures an
+interval, such as request latencies or select deadlines.
+
+``clock`` is the time source of the event loop and of every ``Timer``, so
+display sleep, subscriber expiry and scrobble intervals all follow it.  It
+uses the monotonic clock unless a ``VirtualClock`` is swapped in, in which
+case time only moves when it's advanced.  That lets time driven behaviour
+be tested and benchmarked in fast-forward:
+
+    from clock import clock, VirtualClock
+    from loop import loop
+
+    virtual = VirtualClock()
+    clock.use(virtual)          # before anything is scheduled
+
+    virtual.advance(90)
+    loop.sync()                 # timers due by now have run
+
+Example usage:
+
+    from clock import Timer
+
+    timer = Timer()
+    ...
+    if timer.elapsed() > SCROBBLE_INTERVAL:
+        timer.restart()
+"""
+import ctypes
+import logging
+import os
+import threading
+import time
+
+# From <time.h> on Linux
+CLOCK_MONOTONIC = 1
+
+log = logging.getLogger("clock")
+
+def _load_clock_gettime():
+    for name in ("librt.so.1", None):
+        try:
+            return ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+
+_clock_gettime = _load_clock_gettime()
+
+if _clock_gettime is not None:
+    _timespec = ctypes.c_long * 2
+
+    def monotonic(clock_gettime=_clock_gettime, timespec=_timespec, byref=ctypes.byref):
+        """
+        Seconds since an arbitrary point, unaffected by wall clock changes.
+        """
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, byref(ts)) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return ts[0] + ts[1] * 1e-9
+else:
+    log.warning("clock_gettime isn't available, falling back to the wall clock")
+    monotonic = time.time
+
+class MonotonicClock(object):
+    virtual = False
+
+    def now(self):
+        return monotonic()
+
+class VirtualClock(object):
+    """
+    A clock that stands still until ``advance`` is called.
+    """
+    virtual = True
+
+    def __init__(self, start=0.0):
+        self._now       = start
+        self._lock      = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """
+        Registers ``callback`` to be called, with no arguments, every time
+        the clock moves.
+        """
+        self._listeners.append(callback)
+
+    def now(self):
+        return self._now
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += seconds
+        for callback in self._listeners:
+            callback()
+
+class Clock(object):
+    """
+    Forwards to the clock source in use.  Listeners are called whenever
+    time jumps, i.e. when the source is switched or a virtual clock is
+    advanced, so sleepers can recompute their deadlines.
+    """
+    def __init__(self):
+        self._listeners = []
+        self.use(MonotonicClock())
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def use(self, source):
+        """
+        Switches to ``source``.  Deadlines already handed out were taken
+        from the old source, so do this before anything is scheduled.
+        """
+        self.source  = source
+        self.now     = source.now
+        self.virtual = source.virtual
+        if hasattr(source, "add_listener"):
+            source.add_listener(self._changed)
+        self._changed()
+
+    def _changed(self):
+        for callback in self._listeners:
+            callback()
+
+class Timer(object):
+    def __init__(self):
+        self.restart()
+
+    def restart(self):
+        self.started = clock.now()
+
+    def elapsedMs(self):
+        return self.elapsed() * 1e3
+
+    def elapsed(self):
+        return clock.now()-self.started
+
+clock = Clock()
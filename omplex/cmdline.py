@@ -4,11 +4,18 @@ import logging
 import sys
 import time
 
+from artwork import artworkCache
+from bandwidth import qualityManager
 from client import HttpServer
 from conf import settings
+from display import display
 from gdm import gdm
+from loop import loop
 from osd import osd
+from parts import durationCache
 from player import playerManager
+from stages import StartupPipeline
+from startup import profile
 from timeline import timelineManager
 
 __author__ = "Weston Nielson <wnielson@github>"
@@ -21,45 +28,64 @@ log = logging.getLogger('')
 
 logging.getLogger('requests').setLevel(logging.CRITICAL)
 
-def update_gdm_settings(name=None, value=None):
+def update_gdm_settings(changes=None):
     gdm.clientDetails(settings.client_uuid, settings.player_name,
         settings.http_port, "RaspberryPi", __version__)
 
-def main():
-    logging.basicConfig(level=logging.DEBUG, stream=sys.stdout, format="%(asctime)s [%(levelname)8s] %(message)s")
+def login():
+    if settings.myplex_token:
+        return
 
-    settings.load("settings.dat")
-    if not settings.myplex_token:
-        while True:
-            username = raw_input("MyPlex Username: ")
-            password = getpass.getpass("MyPlex Password: ")
-            if settings.login_myplex(username, password):
-                print "Logged in!"
-                break
-            print "Error logging in..."
+    while True:
+        username = raw_input("MyPlex Username: ")
+        password = getpass.getpass("MyPlex Password: ")
+        if settings.login_myplex(username, password):
+            print "Logged in!"
+            break
+        print "Error logging in..."
 
+def start_gdm_registration():
     settings.add_listener(update_gdm_settings)
-    
     update_gdm_settings()
-    gdm.start_all()
-
+    gdm.start_registration()
     log.info("Started GDM service")
 
-    queue = Queue.Queue()
+def build_pipeline(server):
+    """
+    Startup order.  The HTTP server and GDM registration make omplex
+    controllable, so they come first.  The login prompt doesn't hold that
+    up, and discovery and the OSD wait until omplex is ready.
+    """
+    pipeline = StartupPipeline()
+    pipeline.add("settings",         lambda: settings.load("settings.dat"))
+    pipeline.add("login",            login, requires=("settings",), required=False, thread=True)
+    pipeline.add("http",             lambda: server.start(int(settings.http_port)), requires=("settings",))
+    pipeline.add("gdm registration", start_gdm_registration, requires=("settings",))
+    pipeline.add("display",          display.start)
+    pipeline.add("part durations",   lambda: durationCache.load("parts.dat"), required=False)
+    pipeline.add("qualities",        lambda: qualityManager.load("quality.dat"), required=False)
+    pipeline.add("artwork",          lambda: artworkCache.load("artwork"), required=False)
+    pipeline.add("timeline",         timelineManager.start, requires=("settings",))
+    pipeline.add("gdm discovery",    gdm.start_discovery, defer=True)
+    pipeline.add("osd",              osd.start, defer=True)
+    return pipeline
 
-    while not gdm.discovery_complete:
-        time.sleep(1)
+def main():
+    logging.basicConfig(level=logging.DEBUG, stream=sys.stdout, format="%(asctime)s [%(levelname)8s] %(message)s")
 
-    gdm.discover()
+    with profile.measure("start loop"):
+        loop.start()
 
-    osd.start()
+    server = HttpServer(Queue.Queue())
 
-    server = HttpServer(queue, int(settings.http_port))
-    server.start()
+    try:
+        build_pipeline(server).run()
 
-    timelineManager.start()
+        if profile.enabled:
+            profile.uninstall()
+            for line in profile.report():
+                log.info(line)
 
-    try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
@@ -71,6 +97,10 @@ def main():
         server.stop()
         timelineManager.stop()
         gdm.stop_all()
+        loop.stop()
+        settings.flush()
+        durationCache.flush()
+        qualityManager.flush()
 
 if __name__ == "__main__":
     main()
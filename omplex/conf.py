@@ -1,18 +1,19 @@
 import logging
-import os
-import requests
+import threading
 import uuid
 import xml.etree.ElementTree as ET
-import cPickle as pickle
+
+from contextlib import contextmanager
 
 from __init__ import __version__
+from loop import loop
+from picklefile import PickleFile
 
 log = logging.getLogger('conf')
 
 class Settings(object):
     _listeners = []
 
-    _path = None
     _data = {
         "myplex_username":      "",
         "myplex_password":      "",
@@ -25,73 +26,117 @@ class Settings(object):
         "audio_dtspassthrough": False,
         "client_uuid":          str(uuid.uuid4()),
         "display_sleep":        0,
-        "display_mode":         ""
+        "display_mode":         "",
+        "player_backend":       "omxplayer",
+        "stall_timeout":        20,
+        "start_timeout":        60
     }
 
+    _lock        = threading.RLock()
+    _batch_depth = 0
+    _changes     = {}
+
+    def __init__(self):
+        self._file = PickleFile(self._snapshot)
+
+    def _snapshot(self):
+        with self._lock:
+            return dict(self._data)
+
     def __getattr__(self, name):
         return self._data[name]
 
     def __setattr__(self, name, value):
         if name in self._data:
-            self._data[name] = value
-            self.save()
-
-            for callback in self._listeners:
-                try:
-                    callback(name, value)
-                except:
-                    pass
+            self.update(**{name: value})
         else:
             super(Settings, self).__setattr__(name, value)
 
-    def __get_file(self, path, mode="rb+", create=True):
-        created = False
+    @contextmanager
+    def batch(self):
+        """
+        Group several setting changes into one transaction.  The settings
+        file is written and listeners are notified once, when the outermost
+        batch exits:
 
-        if not os.path.exists(path):
-            try:
-                fh = open(path, mode)
-            except IOError, e:
-                if e.errno == 2 and create:
-                    fh = open(path, 'wb+')
-                    pickle.dump(self._data, fh)
-                    fh.close()
-                    created = True
-                else:
-                    raise e
-            except Exception, e:
-                log.error("Error opening settings from path: %s" % path)
-                return None
+            with settings.batch():
+                settings.player_name  = "living room"
+                settings.audio_output = "local"
 
-        # This should work now
-        return open(path, mode), created
+        """
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0 and self._changes:
+                    changes       = self._changes
+                    self._changes = {}
+                    self.save()
+                    self._notify(changes)
+
+    def update(self, **values):
+        """
+        Set several settings at once.  Only values that actually changed are
+        reported to listeners.
+        """
+        with self.batch():
+            for name, value in values.items():
+                if name not in self._data:
+                    raise AttributeError("Unknown setting '%s'" % name)
+                if self._data[name] != value:
+                    self._data[name]    = value
+                    self._changes[name] = value
 
     def load(self, path, create=True):
-        fh, created = self.__get_file(path, "rb+", create)
-        if not created:
-            try:
-                data = pickle.load(fh)
-                self._data.update(data)
-            except Exception, e:
-                log.error("Error loading settings from pickle: %s" % e)
-                fh.close()
+        try:
+            data = self._file.load(path)
+        except Exception, e:
+            log.error("Error loading settings from pickle: %s" % e)
+            return False
+
+        if data is None:
+            if not create:
+                log.error("Settings file doesn't exist: %s" % path)
                 return False
+            return self.flush()
 
-        self._path = path
-        fh.close()
+        with self._lock:
+            self._data.update(data)
         return True
 
     def save(self):
-        fh, created = self.__get_file(self._path, "wb+", True)
+        """
+        Schedule a write of the settings file.  Writes are debounced so a
+        burst of changes only touches the disk once; use ``flush`` to write
+        immediately.
+        """
+        self._file.save()
+        return True
 
-        try:
-            pickle.dump(self._data, fh)
-            fh.flush()
-            fh.close()
-        except Exception, e:
-            log.error("Error saving settings to pickle: %s" % e)
-            return False
+    def flush(self):
+        """
+        Write the settings file now.  The data is written to a temporary file
+        which is then renamed over the old one, so a crash mid-write never
+        leaves a truncated ``settings.dat`` behind.
+        """
+        return self._file.flush()
 
-        return True
+    def _notify(self, changes):
+        """
+        Hand ``changes`` off to the event loop so that callers setting values
+        never wait on listeners.
+        """
+        if self._listeners:
+            loop.call_soon(self._dispatch, changes)
+
+    def _dispatch(self, changes):
+        for callback in list(self._listeners):
+            try:
+                callback(changes)
+            except Exception, e:
+                log.error("Settings::_dispatch listener error: %s" % e)
 
     def login_myplex(self, username, password, test=False):
         url     = "https://my.plexapp.com/users/sign_in.xml"
@@ -106,6 +151,9 @@ class Settings(object):
             "X-Plex-Platform":          "Raspberry Pi"
         }
 
+        # requests is slow to import and only needed here and once playing
+        import requests
+
         try:
             response = requests.post(url, auth=auth, headers=headers)
             root     = ET.fromstring(response.text)
@@ -115,24 +163,22 @@ class Settings(object):
         except Exception, e:
             log.error("Error logging into MyPlex: %s" % e)
 
-        if not test and token:
-            self.myplex_token = token
-
         if token is not None:
-            self.myplex_token    = token
-            self.myplex_username = username
-            self.myplex_password = password
+            self.update(myplex_token=token, myplex_username=username,
+                        myplex_password=password)
             return True
 
         return False
 
     def add_listener(self, callback):
         """
-        Register a callback to be called anytime a setting value changes.
+        Register a callback to be called anytime setting values change.
+        Callbacks run on the event loop thread, once per batch of changes,
+        and are passed a dict of the changed settings.  They must not block.
         An example callback function:
 
-            def my_callback(key, value):
-                # Do something with the new setting ``value``...
+            def my_callback(changes):
+                # Do something with the new values in ``changes``...
 
         """
         if callback not in self._listeners:
@@ -4,12 +4,27 @@ import logging
 import os
 import re
 import subprocess
+import threading
 
 log = logging.getLogger("display")
 
+from clock import clock, monotonic
 from conf import settings
+from lazy import Lazy
+from loop import loop
+from metrics import registry
+from trace import tracer
 from utils import find_exe
 
+# Seconds the display state is trusted before ``tvservice`` is asked again.
+# Changes we make ourselves update it straight away.
+STATE_TTL = 30
+
+DISPLAY_COMMAND_SECONDS = registry.histogram("omplex_display_command_seconds",
+                                             "Time taken by display control commands", ("command",))
+DISPLAY_POWER_ON_SECONDS = registry.histogram("omplex_display_power_on_seconds",
+                                              "Time taken to power the display on")
+
 class Display(object):
     _STATUS_RE = re.compile(r"state [\d\w]+ \[(?P<interface>[\w]+) (?P<mode>[\w]+) \((?P<code>[\d]+)\) [\w]+ [\w]+ (?P<aspect>[\d]+:[\d]+)\], (?P<resolution>[\d]+x[\d]+) @ (?P<rate>[\d]+)Hz, (?P<scan>[\w]+)")
     _AUDIO_RE  = (
@@ -29,7 +44,12 @@ class Display(object):
         self.scan       = "unknown"
         self.aspect     = "unknown"
         self.interface  = "unknown"
-        self.is_on      = False
+        self.powering_on = False
+
+        self._is_on         = False
+        self._state_at      = 0
+        self._refreshing    = False
+        self._power_lock    = threading.Lock()
 
         self.modes  = {
             "DMT": [],
@@ -42,7 +62,11 @@ class Display(object):
         self.__chvt_bin      = find_exe("chvt")
         self.__fbset_bin     = find_exe("fbset")
 
-        self.update(full=True)
+    def start(self):
+        """
+        Reads the display's state, name and modes in the background.
+        """
+        loop.run_in_worker(self.update, True, True, True)   # state, name, modes
 
     def __str__(self):
         return "%s (%sx%s @ %sHz %s)" % (self.name, self.width, self.height, self.rate, self.interface)
@@ -50,10 +74,42 @@ class Display(object):
     def __repr__(self):
         return "<Display: %s>" % str(self)
 
+    @property
+    def is_on(self):
+        """
+        The cached display state.  Once it's older than ``STATE_TTL`` a
+        refresh is started in the background and the cached value is
+        returned meanwhile, so callers never wait on ``tvservice``.
+        """
+        if clock.now()-self._state_at > STATE_TTL and not self._refreshing:
+            self._refreshing = True
+            loop.run_in_worker(self.__refresh_state)
+        return self._is_on
+
+    @is_on.setter
+    def is_on(self, value):
+        self._is_on     = value
+        self._state_at  = clock.now()
+
+    def __refresh_state(self):
+        try:
+            self.update(state=True)
+        finally:
+            # Don't retry straight away if the state couldn't be read
+            self._state_at   = clock.now()
+            self._refreshing = False
+
     def __call(self, exe, args):
+        command = "%s %s" % (os.path.basename(exe), args[0] if args else "")
+        started = monotonic()
+
         args.insert(0, exe)
         p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         p.wait()
+
+        elapsed = monotonic()-started
+        DISPLAY_COMMAND_SECONDS.observe(elapsed, command=command)
+        log.debug("Display::__call %s took %.3fs" % (command, elapsed))
         return p
 
 
@@ -99,7 +155,26 @@ class Display(object):
             return
 
         self.__tvservice(['--off'])
-        self.update(state=True)
+        self.is_on = False
+
+    def power_on_async(self, mode=None, code=None):
+        """
+        Powers the display on from a worker thread, unless that's already
+        under way, so playback can start at the same time.
+        """
+        with self._power_lock:
+            if self.powering_on:
+                return
+            self.powering_on = True
+        loop.run_in_worker(self.__power_on_worker, mode, code, tracer.current())
+
+    def __power_on_worker(self, mode, code, trace):
+        try:
+            with tracer.activate(trace), tracer.span("display power on"):
+                with DISPLAY_POWER_ON_SECONDS.time():
+                    self.power_on(mode, code)
+        finally:
+            self.powering_on = False
 
     def power_on(self, mode=None, code=None):
         if mode in ["DMT", "CEA"] and code:
@@ -152,6 +227,12 @@ class Display(object):
             state 0x12001a [HDMI CEA (4) RGB lim 16:9], 1280x720 @ 60Hz, progressive
             state 0x120002 [TV is off]
         """
+        if self.__tvservice_bin is None:
+            # Without tvservice there is no way to tell, so assume there is
+            # a display and that it's on
+            self.is_on = True
+            return
+
         p = self.__tvservice(['-s'])
         if not p:
             return
@@ -199,4 +280,4 @@ class Display(object):
                 self.audio[name] = data
 
 
-display = Display()
+display = Lazy(Display)
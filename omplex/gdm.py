@@ -24,13 +24,36 @@ MA 02110-1301, USA.
 
 __author__ = 'DHJ (hippojay) <plex@h-jay.com>'
 
+import random
+import select
 import socket
 import struct
 import sys
 import re
-import threading
-import time
-import urllib2
+
+from clock import monotonic
+from lazy import Lazy
+from loop import loop
+from metrics import registry
+from servers import parse_gdm_response, serverRegistry, serverTracker
+
+DISCOVERY_RTT_SECONDS = registry.histogram("omplex_gdm_discovery_rtt_seconds",
+                                           "Round-trip time of GDM discovery responses")
+DISCOVERED_SERVERS    = registry.gauge("omplex_gdm_servers", "Number of servers found by GDM discovery")
+DISCOVERED_SERVERS.set_function(lambda: len(serverRegistry))
+
+# Seconds after the start of a discovery round at which M-SEARCH is sent,
+# each offset by up to DISCOVERY_JITTER seconds
+DISCOVERY_RETRANSMITS = (0, 0.15, 0.4)
+DISCOVERY_JITTER      = 0.05
+
+# A round ends once nothing has arrived for DISCOVERY_QUIET seconds after the
+# last send, and never takes longer than DISCOVERY_TIMEOUT
+DISCOVERY_QUIET       = 0.25
+DISCOVERY_TIMEOUT     = 1.5
+
+# First retry delay when no servers were found, doubles up to the interval
+DISCOVERY_RETRY       = 5
 
 class PlexGDM:
 
@@ -40,6 +63,16 @@ class PlexGDM:
         self.client_header = '* HTTP/1.0'
         self.client_data = None
         self.client_id = None
+
+        # Pre-encoded registration messages, rebuilt by clientDetails()
+        self._hello_message = None
+        self._reply_message = None
+        self._bye_message = None
+
+        # Registration socket watched by the event loop and the timer
+        # handle of the next discovery round
+        self._update_sock = None
+        self._discovery_handle = None
         
         self._multicast_address = '239.0.0.250'
         self.discover_group = (self._multicast_address, 32414)
@@ -80,7 +113,18 @@ class PlexGDM:
         self.client_data = self.client_data.strip()
         
         self.client_id = c_id
-        
+
+        self._hello_message = "HELLO %s\n%s" % (self.client_header, self.client_data)
+        self._reply_message = "HTTP/1.0 200 OK\n%s" % self.client_data
+        self._bye_message = "BYE %s\n%s" % (self.client_header, self.client_data)
+
+        # Re-announce ourselves with the new details
+        loop.call_soon(self.__reannounce)
+
+    def __reannounce(self):
+        if self._update_sock is not None:
+            self.__announce(self._update_sock, self._hello_message)
+
     def getClientDetails(self):
         if not self.client_data:
             self.__printDebug("Client data has not been initialised.  Please use PlexGDM.clientDetails()")
@@ -88,6 +132,11 @@ class PlexGDM:
         return self.client_data
 
     def client_update (self):
+        """
+        Binds the registration socket, announces the client and hands the
+        socket to the event loop, which answers discovery requests from
+        ``__on_update_data``.  Returns False if the socket can't be bound.
+        """
         update_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         
         #Set socket reuse, may not work on all OSs.
@@ -101,156 +150,163 @@ class PlexGDM:
             update_sock.bind(('0.0.0.0',self.client_update_port))
         except:
             self.__printDebug( "Error: Unable to bind to port [%s] - client will not be registered" % self.client_update_port, 0)
-            return    
+            update_sock.close()
+            return False
         
         update_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
         status = update_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self._multicast_address) + socket.inet_aton('0.0.0.0'))
         update_sock.setblocking(0)
-        self.__printDebug("Sending registration data: HELLO %s\n%s" % (self.client_header, self.client_data), 3)
-        
+
         #Send initial client registration
+        self.__announce(update_sock, self._hello_message)
+
+        #Now wait for client discovery requests
+        self._update_sock = update_sock
+        loop.add_reader(update_sock, self.__on_update_data, update_sock)
+        return True
+
+    def __on_update_data(self, update_sock):
         try:
-            update_sock.sendto("HELLO %s\n%s" % (self.client_header, self.client_data), self.client_register_group)
-        except:
-            self.__printDebug( "Error: Unable to send registeration message" , 0)
-        
-        #Now, listen for client discovery reguests and respond.
-        while self._registration_is_running:
+            data, addr = update_sock.recvfrom(1024)
+            self.__printDebug("Recieved UDP packet from [%s] containing [%s]" % (addr, data.strip()), 3)
+        except socket.error, e:
+            return
+
+        if "M-SEARCH * HTTP/1." in data:
+            self.__printDebug("Detected client discovery request from %s.  Replying" % ( addr ,) , 2)
             try:
-                data, addr = update_sock.recvfrom(1024)
-                self.__printDebug("Recieved UDP packet from [%s] containing [%s]" % (addr, data.strip()), 3)
-            except socket.error, e:
-                pass
-            else:
-                if "M-SEARCH * HTTP/1." in data:
-                    self.__printDebug("Detected client discovery request from %s.  Replying" % ( addr ,) , 2)
-                    try:
-                        update_sock.sendto("HTTP/1.0 200 OK\n%s" % self.client_data, addr)
-                    except:
-                        self.__printDebug( "Error: Unable to send client update message",0)
-                    
-                    self.__printDebug("Sending registration data: HTTP/1.0 200 OK\n%s" % (self.client_data), 3)
-                    self.client_registered = True
-            time.sleep(0.5)        
-
-        self.__printDebug("Client Update loop stopped",1)
-        
-        #When we are finished, then send a final goodbye message to deregister cleanly.
-        self.__printDebug("Sending registration data: BYE %s\n%s" % (self.client_header, self.client_data), 3)
+                update_sock.sendto(self._reply_message, addr)
+            except:
+                self.__printDebug( "Error: Unable to send client update message",0)
+
+            self.__printDebug("Sending registration data: %s" % self._reply_message, 3)
+            self.client_registered = True
+
+    def __announce(self, sock, message):
+        self.__printDebug("Sending registration data: %s" % message, 3)
         try:
-            update_sock.sendto("BYE %s\n%s" % (self.client_header, self.client_data), self.client_register_group)
+            sock.sendto(message, self.client_register_group)
         except:
-            self.__printDebug( "Error: Unable to send client update message" ,0)
-                       
-        self.client_registered = False
+            self.__printDebug( "Error: Unable to send registration message" , 0)
                            
     def check_client_registration(self):
-        
+        """
+        Asks the servers, fastest first, whether they know about this client
+        and returns True as soon as one does.
+        """
         if self.client_registered and self.discovery_complete:
         
             if not self.server_list:
                 self.__printDebug("Server list is empty. Unable to check",2)
                 return False
 
-            try:
-                media_server=self.server_list[0]['server']
-                media_port=self.server_list[0]['port']
-
-                self.__printDebug("Checking server [%s] on port [%s]" % (media_server, media_port) ,2)                    
-                f = urllib2.urlopen('http://%s:%s/clients' % (media_server, media_port))
-                client_result = f.read()
-                if self.client_id in client_result:
-                    self.__printDebug("Client registration successful",1)
-                    self.__printDebug("Client data is: %s" % client_result, 3)
-                    return True
-                else:
-                    self.__printDebug("Client registration not found",1)
-                    self.__printDebug("Client data is: %s" % client_result, 3)
-                   
-            except:
-                self.__printDebug("Unable to check status")
-                pass
+            for server in serverTracker.ranked():
+                if not server.info:
+                    # Not found by discovery
+                    continue
+
+                try:
+                    self.__printDebug("Checking server [%s] on port [%s]" % (server.host, server.port) ,2)
+                    client_result = serverTracker.request('%s/clients' % server.url).content
+                    if self.client_id in client_result:
+                        self.__printDebug("Client registration successful",1)
+                        self.__printDebug("Client data is: %s" % client_result, 3)
+                        return True
+                    else:
+                        self.__printDebug("Client registration not found",1)
+                        self.__printDebug("Client data is: %s" % client_result, 3)
+                       
+                except:
+                    self.__printDebug("Unable to check status")
         
         return False
             
     def getServerList (self):
         return self.server_list
         
+    def parse_response(self, data, addr):
+        """
+        Turns a GDM discovery response into a server dict, or returns None
+        if it wasn't a positive response.
+        """
+        return parse_gdm_response(data, addr[0])
+
     def discover(self):
+        """
+        Sends a few M-SEARCH requests, spaced out with a little jitter so a
+        single lost packet doesn't hide the servers, and collects responses
+        until the network goes quiet.  Each response is handed to
+        ``serverRegistry`` as it arrives, which works out what changed.
+        """
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-        # Set a timeout so the socket does not block indefinitely
-        sock.settimeout(0.6)
-
         # Set the time-to-live for messages to 1 for local network
         ttl = struct.pack('b', 1)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
 
-        returnData = []
+        seen      = set()
+        started   = monotonic()
+        schedule  = [started + delay + random.uniform(0, DISCOVERY_JITTER) for delay in DISCOVERY_RETRANSMITS]
+        sent_at   = []
+        last_seen = started
         try:
-            # Send data to the multicast group
-            self.__printDebug("Sending discovery messages: %s" % self.discover_message, 2)
-            sent = sock.sendto(self.discover_message, self.discover_group)
-
-            # Look for responses from all recipients
             while True:
-                try:
-                    data, server = sock.recvfrom(1024)
-                    self.__printDebug("Received data from %s, %s" % server, 3)
-                    self.__printDebug("Data received is:\n %s" % data, 3)
-                    returnData.append( { 'from' : server,
-                                         'data' : data } )
-                except socket.timeout:
+                now = monotonic()
+                if schedule and now >= schedule[0]:
+                    schedule.pop(0)
+                    self.__printDebug("Sending discovery messages: %s" % self.discover_message, 2)
+                    sock.sendto(self.discover_message, self.discover_group)
+                    sent_at.append(now)
+
+                if schedule:
+                    deadline = schedule[0]
+                else:
+                    # Done once nothing has arrived for a while after the last send
+                    deadline = max(sent_at[-1], last_seen) + DISCOVERY_QUIET
+                deadline = min(deadline, started + DISCOVERY_TIMEOUT)
+
+                if now >= deadline and not schedule:
                     break
+
+                readable = select.select([sock], [], [], max(0, deadline-now))[0]
+                if not readable:
+                    if now >= started + DISCOVERY_TIMEOUT:
+                        break
+                    continue
+
+                data, server = sock.recvfrom(1024)
+                last_seen = monotonic()
+                DISCOVERY_RTT_SECONDS.observe(last_seen-sent_at[-1])
+                self.__printDebug("Received data from %s, %s" % server, 3)
+                self.__printDebug("Data received is:\n %s" % data, 3)
+
+                update = self.parse_response(data, server)
+                if update is None:
+                    continue
+
+                key = serverRegistry.key(update)
+                if key in seen:
+                    # A reply to one of the retransmits
+                    continue
+                seen.add(key)
+
+                serverRegistry.seen(update)
+                self.server_list = serverRegistry.servers()
+                self.discovery_complete = True
+                self.__printDebug("Server Discovered: %s" % update.get('serverName'), 2)
+        except socket.error, e:
+            self.__printDebug("Unable to send discovery message: %s" % e, 0)
         finally:
             sock.close()
 
+        serverRegistry.end_round(seen)
+        self.server_list = serverRegistry.servers()
         self.discovery_complete = True
 
-        discovered_servers = []
-
-        if returnData:
-
-            for response in returnData:
-                update = { 'server' : response.get('from')[0] }
-
-                #Check if we had a positive HTTP response                        
-                if "200 OK" in response.get('data'):
-            
-                    for each in response.get('data').split('\n'):
-
-                        update['discovery'] = "auto"
-                        update['owned']='1'
-                        update['master']= 1
-                        update['role']='master'
-                        update['class']=None
-                    
-                        if "Content-Type:" in each:
-                            update['content-type'] = each.split(':')[1].strip()
-                        elif "Resource-Identifier:" in each:
-                            update['uuid'] = each.split(':')[1].strip()
-                        elif "Name:" in each:
-                            update['serverName'] = each.split(':')[1].strip()
-                        elif "Port:" in each:
-                            update['port'] = each.split(':')[1].strip()
-                        elif "Updated-At:" in each:
-                            update['updated'] = each.split(':')[1].strip()
-                        elif "Version:" in each:
-                            update['version'] = each.split(':')[1].strip()
-                        elif "Server-Class:" in each:
-                            update['class'] = each.split(':')[1].strip()
-
-                discovered_servers.append(update)                    
-
-        self.server_list = discovered_servers
-        
         if not self.server_list:
             self.__printDebug("No servers have been discovered",1)
         else:
             self.__printDebug("Number of servers Discovered: %s" % len(self.server_list),1)
-            for items in self.server_list:
-                self.__printDebug("Server Discovered: %s" % items['serverName'] ,2)
-                
 
     def setInterval(self, interval):
         self.discovery_interval = interval
@@ -263,8 +319,8 @@ class PlexGDM:
         if self._discovery_is_running:
             self.__printDebug("Discovery shutting down", 1)
             self._discovery_is_running = False
-            self.discover_t.join()
-            del self.discover_t
+            self._discovery_handle.cancel()
+            self._discovery_handle = None
         else:
             self.__printDebug("Discovery not running", 1)
 
@@ -272,40 +328,51 @@ class PlexGDM:
         if self._registration_is_running:
             self.__printDebug("Registration shutting down", 1)
             self._registration_is_running = False
-            self.register_t.join()
-            del self.register_t
+
+            update_sock, self._update_sock = self._update_sock, None
+            if update_sock is not None:
+                loop.remove_reader(update_sock)
+
+                #Send a final goodbye message to deregister cleanly.
+                self.__announce(update_sock, self._bye_message)
+                update_sock.close()
+
+            self.client_registered = False
+            self.__printDebug("Client Update loop stopped",1)
         else:
             self.__printDebug("Registration not running", 1)
 
-    def run_discovery_loop(self):
-        #Run initial discovery
+    def __discovery_round(self, retry):
+        """
+        Runs one discovery round on a worker thread and schedules the next
+        one, retrying quickly while no servers are found and backing off to
+        the normal interval.
+        """
         self.discover()
 
-        discovery_count=0
-        while self._discovery_is_running:
-            discovery_count+=1
-            if discovery_count > self.discovery_interval:
-                self.discover()
-                discovery_count=0
-            time.sleep(1)
+        if not self._discovery_is_running:
+            return
+
+        if self.server_list:
+            delay, retry = self.discovery_interval, DISCOVERY_RETRY
+        else:
+            delay, retry = retry, min(retry*2, self.discovery_interval)
+        self._discovery_handle = loop.call_later(delay, loop.run_in_worker,
+                                                 self.__discovery_round, retry)
 
     def start_discovery(self, daemon = False):
         if not self._discovery_is_running:
             self.__printDebug("Discovery starting up", 1)
             self._discovery_is_running = True
-            self.discover_t = threading.Thread(target=self.run_discovery_loop)
-            self.discover_t.setDaemon(daemon)
-            self.discover_t.start()
+            self._discovery_handle = loop.call_soon(loop.run_in_worker,
+                                                    self.__discovery_round, DISCOVERY_RETRY)
         else:
             self.__printDebug("Discovery already running", 1)
         
     def start_registration(self, daemon = False):
         if not self._registration_is_running:
             self.__printDebug("Registration starting up", 1)
-            self._registration_is_running = True
-            self.register_t = threading.Thread(target=self.client_update)
-            self.register_t.setDaemon(daemon)
-            self.register_t.start()
+            self._registration_is_running = self.client_update()
         else:
             self.__printDebug("Registration already running", 1)
              
@@ -313,4 +380,4 @@ class PlexGDM:
         self.start_discovery(daemon)
         self.start_registration(daemon)
 
-gdm = PlexGDM()
\ No newline at end of file
+gdm = Lazy(PlexGDM)
\ No newline at end of file
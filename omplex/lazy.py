@@ -0,0 +1,47 @@
+"""
+lazy.py - Lazily created module singletons
+
+Module singletons are wrapped in ``Lazy`` so importing a module does no
+work.  The object is created the first time one of its attributes is used,
+and services with background work have an explicit ``start`` method that
+``cmdline`` calls.
+
+Example usage:
+
+    display = Lazy(Display)
+
+    display.is_on       # Display() is created here
+"""
+import threading
+
+from startup import profile
+
+class Lazy(object):
+    __slots__ = ("__factory", "__name", "__instance", "__lock")
+
+    def __init__(self, factory, name=None):
+        object.__setattr__(self, "_Lazy__factory", factory)
+        object.__setattr__(self, "_Lazy__name", name or factory.__name__)
+        object.__setattr__(self, "_Lazy__instance", None)
+        object.__setattr__(self, "_Lazy__lock", threading.Lock())
+
+    def _get_instance(self):
+        instance = self.__instance
+        if instance is None:
+            with self.__lock:
+                if self.__instance is None:
+                    with profile.measure("create %s" % self.__name):
+                        object.__setattr__(self, "_Lazy__instance", self.__factory())
+                instance = self.__instance
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self._get_instance(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_instance(), name, value)
+
+    def __repr__(self):
+        if self.__instance is None:
+            return "<Lazy %s (not created)>" % self.__name
+        return repr(self.__instance)
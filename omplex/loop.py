@@ -0,0 +1,320 @@
+"""
+loop.py - The omplex event loop
+
+A single thread runs every timer and waits on every file descriptor the
+background services care about (GDM sockets, omxplayer's output, the HTTP
+listening socket).  When nothing is due the thread sleeps in ``select``, so
+an idle player doesn't wake up at all.
+
+Callbacks run on the loop thread and must not block.  Anything that does,
+such as network requests or spawning omxplayer, is handed to a small fixed
+pool of worker threads with ``run_in_worker``.  Services whose work may
+block for long, like serving HTTP connections, get a ``WorkerPool`` of their
+own so they can't starve the loop's workers.
+
+Timers follow ``clock.clock``, which is monotonic unless a virtual clock
+is swapped in for fast-forward testing.
+
+Example usage:
+
+    from loop import loop
+
+    handle = loop.call_every(1, tick)
+    loop.call_later(90, expire, subscriber)
+    loop.add_reader(sock, on_readable)
+    loop.run_in_worker(fetch, url)
+
+    handle.cancel()
+"""
+import errno
+import heapq
+import itertools
+import logging
+import os
+import Queue
+import select
+import threading
+
+from clock import clock
+from metrics import registry, watch_queue
+
+# Number of threads used to run blocking work
+WORKER_THREADS = 4
+
+log = logging.getLogger("loop")
+
+class Handle(object):
+    """
+    Returned by the ``call_*`` methods; use ``cancel`` to stop the callback
+    from running (again).
+    """
+    __slots__ = ("when", "interval", "callback", "args", "cancelled")
+
+    def __init__(self, when, interval, callback, args):
+        self.when       = when
+        self.interval   = interval
+        self.callback   = callback
+        self.args       = args
+        self.cancelled  = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class WorkerPool(object):
+    """
+    A fixed number of threads running the callbacks handed to ``submit``.
+    With ``maxsize`` at most that many callbacks wait for a thread, beyond
+    that ``submit`` raises ``Queue.Full``.
+    """
+    def __init__(self, name, threads, maxsize=0):
+        self.name       = name
+        self.queue      = Queue.Queue(maxsize)
+        self._nthreads  = threads
+        self._threads   = []
+
+        watch_queue(name, self.queue)
+
+    def submit(self, callback, *args):
+        self.queue.put_nowait((callback, args))
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self._nthreads):
+            thread = threading.Thread(target=self._run, name="%s %d" % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        # Waits for the callbacks already queued
+        for thread in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            callback, args = task
+            try:
+                callback(*args)
+            except Exception, e:
+                log.exception("WorkerPool::_run error in %r: %s" % (callback, e))
+
+class EventLoop(object):
+    def __init__(self, workers=WORKER_THREADS):
+        self._lock      = threading.Lock()
+        self._timers    = []
+        self._sequence  = itertools.count()
+        self._soon      = []
+        self._readers   = {}
+        self._thread    = None
+        self._running   = False
+
+        self._workers   = WorkerPool("workers", workers)
+
+        self._wake_r, self._wake_w = os.pipe()
+
+        clock.add_listener(self._wake)
+
+    def time(self):
+        return clock.now()
+
+    #--------------------------------------------------------------------------
+    #   Scheduling
+    #--------------------------------------------------------------------------
+    def _wake(self):
+        if threading.current_thread() is self._thread:
+            return
+        try:
+            os.write(self._wake_w, "x")
+        except OSError:
+            pass
+
+    def _schedule(self, handle):
+        with self._lock:
+            heapq.heappush(self._timers, (handle.when, next(self._sequence), handle))
+        self._wake()
+        return handle
+
+    def call_soon(self, callback, *args):
+        """
+        Run ``callback(*args)`` on the loop thread as soon as possible.  Safe
+        to call from any thread.
+        """
+        handle = Handle(None, None, callback, args)
+        with self._lock:
+            self._soon.append(handle)
+        self._wake()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run ``callback(*args)`` on the loop thread after ``delay`` seconds.
+        """
+        return self._schedule(Handle(self.time()+delay, None, callback, args))
+
+    def call_every(self, interval, callback, *args):
+        """
+        Run ``callback(*args)`` on the loop thread every ``interval`` seconds
+        until the returned handle is cancelled.
+        """
+        return self._schedule(Handle(self.time()+interval, interval, callback, args))
+
+    def add_reader(self, fd, callback, *args):
+        """
+        Run ``callback(*args)`` on the loop thread whenever ``fd`` (a file
+        descriptor or an object with a ``fileno`` method) is readable.
+        """
+        if hasattr(fd, "fileno"):
+            fd = fd.fileno()
+        with self._lock:
+            self._readers[fd] = (callback, args)
+        self._wake()
+
+    def remove_reader(self, fd):
+        if hasattr(fd, "fileno"):
+            fd = fd.fileno()
+        with self._lock:
+            removed = self._readers.pop(fd, None) is not None
+        self._wake()
+        return removed
+
+    def run_in_worker(self, callback, *args):
+        """
+        Run ``callback(*args)`` on one of the worker threads.  Use this for
+        anything that may block.
+        """
+        self._workers.submit(callback, *args)
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self._thread
+
+    def sync(self, timeout=None):
+        """
+        Waits until the loop thread has run every callback that's due, such
+        as the timers a virtual clock was just advanced past.  Returns False
+        if that took longer than ``timeout`` seconds.
+        """
+        done = threading.Event()
+        self.call_soon(done.set)
+        return done.wait(timeout)
+
+    #--------------------------------------------------------------------------
+    #   Running
+    #--------------------------------------------------------------------------
+    def start(self):
+        if self._running:
+            return
+
+        self._running = True
+        self._workers.start()
+
+        self._thread = threading.Thread(target=self._run, name="Event loop")
+        self._thread.daemon = True
+        self._thread.start()
+        log.debug("EventLoop::start started with %d workers" % self._workers._nthreads)
+
+    def stop(self):
+        if not self._running:
+            return
+
+        self._running = False
+        self._wake()
+        self._thread.join()
+
+        self._workers.stop()
+        self._thread = None
+
+    def _invoke(self, callback, args):
+        try:
+            callback(*args)
+        except Exception, e:
+            log.exception("EventLoop::_invoke error in %r: %s" % (callback, e))
+
+    def _next_timeout(self):
+        with self._lock:
+            if self._soon:
+                return 0
+            if not self._timers:
+                return None
+            delay = max(0, self._timers[0][0]-self.time())
+        if clock.virtual and delay > 0:
+            # Virtual time doesn't pass while we sleep, wait to be advanced
+            return None
+        return delay
+
+    def _run(self):
+        while self._running:
+            with self._lock:
+                readers = self._readers.items()
+
+            fds = [fd for fd, entry in readers] + [self._wake_r]
+            try:
+                readable = select.select(fds, [], [], self._next_timeout())[0]
+            except (select.error, OSError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] == errno.EBADF:
+                    # A reader was closed without being removed
+                    self._drop_bad_readers()
+                    continue
+                raise
+
+            if self._wake_r in readable:
+                os.read(self._wake_r, 4096)
+
+            for fd, (callback, args) in readers:
+                if fd in readable and self._readers.get(fd) == (callback, args):
+                    self._invoke(callback, args)
+
+            self._run_timers()
+
+            with self._lock:
+                soon, self._soon = self._soon, []
+            for handle in soon:
+                if not handle.cancelled:
+                    self._invoke(handle.callback, handle.args)
+
+    def _run_timers(self):
+        now = self.time()
+        while True:
+            with self._lock:
+                if not self._timers or self._timers[0][0] > now:
+                    return
+                when, seq, handle = heapq.heappop(self._timers)
+
+            if handle.cancelled:
+                continue
+
+            if handle.interval is not None:
+                # Reschedule before running so the callback may cancel it.
+                # If we fell behind, skip the missed runs.
+                handle.when += handle.interval
+                if handle.when <= now:
+                    handle.when = now + handle.interval
+                with self._lock:
+                    heapq.heappush(self._timers, (handle.when, next(self._sequence), handle))
+
+            self._invoke(handle.callback, handle.args)
+
+    def _drop_bad_readers(self):
+        with self._lock:
+            for fd in self._readers.keys():
+                try:
+                    os.fstat(fd)
+                except OSError:
+                    log.error("EventLoop::_drop_bad_readers dropping closed fd %s" % fd)
+                    self._readers.pop(fd)
+
+loop = EventLoop()
+
+TIMERS = registry.gauge("omplex_loop_timers", "Number of timers scheduled on the event loop")
+TIMERS.set_function(lambda: len([t for t in loop._timers if not t[2].cancelled]))
+
+READERS = registry.gauge("omplex_loop_readers", "Number of file descriptors watched by the event loop")
+READERS.set_function(lambda: len(loop._readers))
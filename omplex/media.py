@@ -1,5 +1,4 @@
 import logging
-import urllib
 import urlparse
 
 from __init__ import __version__
@@ -10,12 +9,12 @@ except:
     import xml.etree.ElementTree as et
 
 from conf import settings
-from utils import get_plex_url, safe_urlopen
+from parts import PartIndex, durationCache
+from trace import traced
+from utils import get_plex_url, plex_urlopen, safe_urlopen
 
 log = logging.getLogger('media')
 
-# http://192.168.0.12:32400/photo/:/transcode?url=http%3A%2F%2F127.0.0.1%3A32400%2F%3A%2Fresources%2Fvideo.png&width=75&height=75
-
 class MediaItem(object):
     pass
 
@@ -32,7 +31,7 @@ class Video(object):
         if media:
             self.select_media(media, part)
 
-        if not self._media_node:
+        if self._media_node is None:
             self.select_best_media(part)
 
     def select_best_media(self, part=0):
@@ -55,7 +54,7 @@ class Video(object):
 
     def select_media(self, media, part=0):
         node = self.node.find('./Media[%s]' % (media+1))
-        if node:
+        if node is not None:
             self._media      = media
             self._media_node = node
             if self.select_part(part):
@@ -70,7 +69,7 @@ class Video(object):
             return False
 
         node = self._media_node.find('./Part[%s]' % (part+1))
-        if node:
+        if node is not None:
             self._part      = part
             self._part_node = node
             return True
@@ -79,10 +78,50 @@ class Video(object):
         return False
 
     def is_multipart(self):
-        if not self._media_node:
+        if self._media_node is None:
             return False
         return len(self._media_node.findall("./Part",[])) > 1
 
+    def _part_cache_key(self, node):
+        return self.parent.server_url + node.get("key", "")
+
+    def get_part_index(self):
+        """
+        Returns a ``PartIndex`` of the selected media's parts, with the
+        durations given by the server or probed before.
+        """
+        durations = []
+        if self._media_node is not None:
+            for node in self._media_node.findall("./Part"):
+                duration = node.get("duration")
+                if duration:
+                    durations.append(int(duration)/1e3)
+                else:
+                    durations.append(durationCache.get(self._part_cache_key(node)))
+        return PartIndex(durations)
+
+    def probe_part_durations(self, probe):
+        """
+        Finds the durations of the parts that aren't known yet with
+        ``probe(url)``, a backend's ``probe_duration``, and caches them.
+        Returns the number found, this takes a while for each part.
+        """
+        if self._media_node is None:
+            return 0
+
+        found = 0
+        for node in self._media_node.findall("./Part"):
+            key = self._part_cache_key(node)
+            if node.get("duration") or durationCache.get(key) is not None:
+                continue
+            url      = get_plex_url(urlparse.urljoin(self.parent.server_url, node.get("key", "")))
+            duration = probe(url)
+            if duration:
+                log.debug("Video::probe_part_durations %s is %.1fs" % (node.get("key"), duration))
+                durationCache.set(key, duration)
+                found += 1
+        return found
+
     def get_proper_title(self):
         if not hasattr(self, "_title"):
             media_type = self.node.get('type')
@@ -112,13 +151,28 @@ class Video(object):
             setattr(self, "_title", title)
         return getattr(self, "_title")
 
+    def get_artwork_url(self, width, height):
+        """
+        Returns the URL of the video's poster, resized by the server's photo
+        transcoder to fit ``width`` by ``height``, or None if it has none.
+        Episodes use their show's poster.
+        """
+        thumb = self.node.get("grandparentThumb") or self.node.get("thumb")
+        if not thumb:
+            return
+
+        # e.g. /photo/:/transcode?url=%2Flibrary%2Fmetadata%2F1%2Fthumb%2F1400000000&width=120&height=180
+        url = urlparse.urljoin(self.parent.server_url, "/photo/:/transcode")
+        return get_plex_url(url, {"url": thumb, "width": width, "height": height})
+
     def is_transcode_suggested(self):
-        if self._part_node:
+        if self._part_node is not None:
             if self._part_node.get("container") == "mov":
                 log.info("Video::is_transcode_suggested part container is mov, suggesting transcode")
                 return True
         return False
 
+    @traced("Video.get_playback_url")
     def get_playback_url(self, direct_play=None, offset=0,
                          video_height=1080,      video_width=1920,
                          video_bitrate=20000,    video_quality=100):
@@ -130,7 +184,7 @@ class Video(object):
             direct_play = not self.is_transcode_suggested()
 
         if direct_play:
-            if not self._part_node:
+            if self._part_node is None:
                 return
             url  = urlparse.urljoin(self.parent.server_url, self._part_node.get("key", ""))
             return get_plex_url(url)
@@ -168,9 +222,9 @@ class Video(object):
 
         # OMXPlayer seems to have an issue playing the "start.m3u8" file
         # directly, so we need to extract the index file
-        r = urllib.urlopen(get_plex_url(urlparse.urljoin(self.parent.server_url, url), args))
+        r = plex_urlopen(get_plex_url(urlparse.urljoin(self.parent.server_url, url), args), "transcode")
         try:
-            for line in r.readlines():
+            for line in r.content.splitlines():
                 line = line.strip()
                 if line and line[0] != "#" and line.find("m3u8") > 0:
                     base = urlparse.urljoin(self.parent.server_url, "/video/:/transcode/universal/")
@@ -184,7 +238,7 @@ class Video(object):
         """
         Returns the index of the selected stream
         """
-        if not self._part_node:
+        if self._part_node is None:
             return
 
         match = False
@@ -197,7 +251,7 @@ class Video(object):
             return index+1
 
     def get_subtitle_idx(self):
-        if not self._part_node:
+        if self._part_node is None:
             return
 
         match = False
@@ -209,6 +263,52 @@ class Video(object):
         if match:
             return index+1
 
+    def get_part_id(self):
+        if self._part_node is None:
+            return
+        return self._part_node.get("id")
+
+    def select_stream(self, stream_type, stream_id):
+        """
+        Marks the stream of ``stream_type`` with the id ``stream_id`` as the
+        selected one, as the server would once it's saved.  An id of "0"
+        deselects them all, which is how subtitles are turned off.  Returns
+        False if the part has no such stream.
+        """
+        if self._part_node is None:
+            return False
+
+        stream_id = str(stream_id)
+        streams   = self._part_node.findall("./Stream[@streamType='%s']" % stream_type)
+        if stream_id != "0" and stream_id not in [s.get("id") for s in streams]:
+            log.error("Video::select_stream no stream %s of type %s" % (stream_id, stream_type))
+            return False
+
+        for stream in streams:
+            if stream.get("id") == stream_id:
+                stream.set("selected", "1")
+            elif "selected" in stream.attrib:
+                del stream.attrib["selected"]
+        return True
+
+    def save_streams(self, audio_id=None, subtitle_id=None):
+        """
+        Saves the selected audio and subtitle streams to the server, so
+        they're used the next time this part is played.
+        """
+        part_id = self.get_part_id()
+        if part_id is None:
+            return False
+
+        data = {}
+        if audio_id is not None:
+            data["audioStreamID"] = audio_id
+        if subtitle_id is not None:
+            data["subtitleStreamID"] = subtitle_id
+
+        url = urlparse.urljoin(self.parent.server_url, "/library/parts/%s" % part_id)
+        return safe_urlopen(url, data, "streams", "PUT")
+
     def get_duration(self):
         return self.node.get("duration")
 
@@ -236,7 +336,7 @@ class Video(object):
             "state":        "playing"
         }
         
-        return safe_urlopen(url, data)
+        return safe_urlopen(url, data, "progress")
 
     def set_played(self):
         rating_key = self.get_rating_key()
@@ -251,7 +351,7 @@ class Video(object):
             "identifier":   "com.plexapp.plugins.library"
         }
 
-        self.played = safe_urlopen(url, data)
+        self.played = safe_urlopen(url, data, "scrobble")
         return self.played
 
 class Media(object):
@@ -261,7 +361,8 @@ class Media(object):
         """
         self.path       = urlparse.urlparse(url)
         self.server_url = self.path.scheme + "://" + self.path.netloc
-        self.tree       = et.parse(urllib.urlopen(get_plex_url(url)))
+
+        self.tree       = et.ElementTree(et.fromstring(plex_urlopen(get_plex_url(url), "metadata").content))
 
     def __str__(self):
         return self.path.path
@@ -275,7 +376,6 @@ class Media(object):
 
     def get_machine_identifier(self):
         if not hasattr(self, "_machine_identifier"):
-            doc = urllib.urlopen(get_plex_url(self.server_url))
-            tree = et.parse(doc)
+            tree = et.fromstring(plex_urlopen(get_plex_url(self.server_url), "identity").content)
             setattr(self, "_machine_identifier", tree.find('.').get("machineIdentifier"))
         return getattr(self, "_machine_identifier", None)
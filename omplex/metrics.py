@@ -0,0 +1,213 @@
+"""
+metrics.py - Lightweight Prometheus-style metrics
+
+Counters, gauges and histograms are registered on the module level
+``registry`` and exported in the Prometheus text format from the ``/metrics``
+HTTP route.  Recording a value is a dict lookup and an addition under a lock,
+so instrumentation can be left on permanently.
+
+Example usage:
+
+    from metrics import registry
+
+    REQUESTS = registry.counter("omplex_requests_total", "Requests handled", ("route",))
+    REQUESTS.inc(route="poll")
+
+    LATENCY = registry.histogram("omplex_request_seconds", "Request latency")
+    with LATENCY.time():
+        do_something()
+"""
+import bisect
+import threading
+
+from clock import monotonic
+from contextlib import contextmanager
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs])
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, help="", labels=()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self._lock  = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("%s expects labels %s" % (self.name, self.labels))
+        return tuple([labels[name] for name in self.labels])
+
+    def _samples(self):
+        with self._lock:
+            items = self._values.items()
+        for key, value in sorted(items):
+            yield self.name, _format_labels(self.labels, key), value
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.kind)
+        ]
+        for name, labels, value in self._samples():
+            lines.append("%s%s %s" % (name, labels, _format_value(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help="", labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """
+        Compute the value when the metrics are collected instead of on every
+        change.  ``function`` is called without arguments and should return a
+        number, or a dict of label-value tuples to numbers for labelled gauges.
+        """
+        self._function = function
+
+    def _samples(self):
+        if self._function is None:
+            for sample in super(Gauge, self)._samples():
+                yield sample
+            return
+
+        try:
+            value = self._function()
+        except Exception:
+            return
+
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                yield self.name, _format_labels(self.labels, key), v
+        else:
+            yield self.name, "", value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help="", labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key   = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # Per-bucket counts (plus +Inf), sum, count
+                data = self._values[key] = [[0]*(len(self.buckets)+1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic()-started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+
+        bounds = self.buckets + (float("inf"),)
+        for key, (counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                yield ("%s_bucket" % self.name,
+                       _format_labels(self.labels, key, ("le", _format_value(bound))),
+                       cumulative)
+            yield "%s_sum" % self.name, _format_labels(self.labels, key), total
+            yield "%s_count" % self.name, _format_labels(self.labels, key), count
+
+class Registry(object):
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s already registered as a %s" % (name, metric.kind))
+            return metric
+
+    def counter(self, name, help="", labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help="", labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return "\n".join([m.render() for name, m in metrics]) + "\n"
+
+registry = Registry()
+
+# Process wide gauges
+THREADS = registry.gauge("omplex_threads", "Number of live threads")
+THREADS.set_function(threading.active_count)
+
+QUEUE_SIZE = registry.gauge("omplex_queue_size", "Number of items waiting in internal queues", ("queue",))
+_queues = {}
+
+def watch_queue(name, queue):
+    """
+    Export the size of ``queue`` as ``omplex_queue_size{queue="name"}``.
+    """
+    _queues[(name,)] = queue
+
+QUEUE_SIZE.set_function(lambda: dict([(key, q.qsize()) for key, q in _queues.items()]))
@@ -0,0 +1,446 @@
+"""
+mpris.py - Controls omxplayer over D-Bus
+
+Newer omxplayer builds implement the MPRIS D-Bus interface.  It takes
+absolute positions, volumes and stream indexes and reports the position
+back, where the keyboard only has relative steps.  ``Control`` talks to it
+over a private connection to omxplayer's bus.  Only the little of D-Bus
+that's needed for that is implemented here, so nothing beyond the standard
+library is required.
+
+omxplayer's launcher starts its own session bus and writes its address to
+``/tmp/omxplayerdbus.<user>``.  ``OMPLEX_OMXPLAYER_DBUS`` overrides that,
+e.g. to point at a test bus.
+
+Example usage:
+
+    control = Control.connect()
+    if control:
+        control.set_position(600)
+        control.position()          # 600.0
+"""
+import itertools
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import urllib
+
+from clock import monotonic
+
+# Message types
+METHOD_CALL     = 1
+METHOD_RETURN   = 2
+ERROR           = 3
+SIGNAL          = 4
+
+# Header fields
+PATH            = 1
+INTERFACE       = 2
+MEMBER          = 3
+ERROR_NAME      = 4
+REPLY_SERIAL    = 5
+DESTINATION     = 6
+SENDER          = 7
+SIGNATURE       = 8
+
+BUS_NAME        = "org.freedesktop.DBus"
+BUS_PATH        = "/org/freedesktop/DBus"
+
+MPRIS_NAME      = "org.mpris.MediaPlayer2.omxplayer"
+MPRIS_PATH      = "/org/mpris/MediaPlayer2"
+PLAYER          = "org.mpris.MediaPlayer2.Player"
+PROPERTIES      = "org.freedesktop.DBus.Properties"
+
+# Seconds to wait for a reply, and for omxplayer to show up on its bus
+CALL_TIMEOUT    = 2
+CONNECT_TIMEOUT = 3
+CONNECT_RETRY   = 0.05
+
+_ALIGNMENT = {"y": 1, "b": 4, "n": 2, "q": 2, "i": 4, "u": 4, "x": 8, "t": 8, "d": 8,
+              "h": 4, "s": 4, "o": 4, "g": 1, "a": 4, "(": 8, "{": 8, "v": 1}
+_FORMATS   = {"y": "B", "b": "I", "n": "h", "q": "H", "i": "i", "u": "I", "x": "q", "t": "Q",
+              "d": "d", "h": "I"}
+
+log = logging.getLogger("mpris")
+
+class DBusError(Exception):
+    def __init__(self, name, message=""):
+        Exception.__init__(self, "%s: %s" % (name, message))
+        self.name = name
+
+def _type_end(signature, start):
+    code = signature[start]
+    if code == "a":
+        return _type_end(signature, start+1)
+    if code in "({":
+        close = ")" if code == "(" else "}"
+        index = start+1
+        while signature[index] != close:
+            index = _type_end(signature, index)
+        return index+1
+    return start+1
+
+def split_signature(signature):
+    """
+    Splits ``signature`` into its complete types, e.g. "sa{sv}i" into
+    ["s", "a{sv}", "i"].
+    """
+    types = []
+    index = 0
+    while index < len(signature):
+        end = _type_end(signature, index)
+        types.append(signature[index:end])
+        index = end
+    return types
+
+class _Writer(object):
+    def __init__(self):
+        self.parts  = []
+        self.offset = 0
+
+    def pad(self, alignment):
+        padding = -self.offset % alignment
+        if padding:
+            self.raw("\0" * padding)
+
+    def raw(self, data):
+        self.parts.append(data)
+        self.offset += len(data)
+
+    def write(self, signature, value):
+        code = signature[0]
+        self.pad(_ALIGNMENT[code])
+        if code in _FORMATS:
+            if code == "b":
+                value = 1 if value else 0
+            self.raw(struct.pack("<" + _FORMATS[code], value))
+        elif code in "so":
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            self.raw(struct.pack("<I", len(value)) + value + "\0")
+        elif code == "g":
+            self.raw(struct.pack("<B", len(value)) + value + "\0")
+        elif code == "v":
+            # Variants are passed as (signature, value)
+            self.write("g", value[0])
+            self.write(value[0], value[1])
+        elif code == "a":
+            element = signature[1:]
+            index   = len(self.parts)
+            self.raw("\0\0\0\0")
+            self.pad(_ALIGNMENT[element[0]])
+            start   = self.offset
+            for item in (value.items() if element[0] == "{" else value):
+                self.write(element, item)
+            self.parts[index] = struct.pack("<I", self.offset-start)
+        else:
+            for member, item in zip(split_signature(signature[1:-1]), value):
+                self.write(member, item)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+class _Reader(object):
+    def __init__(self, data, offset=0):
+        self.data   = data
+        self.offset = offset
+
+    def read(self, signature):
+        code = signature[0]
+        self.offset += -self.offset % _ALIGNMENT[code]
+        if code in _FORMATS:
+            format = "<" + _FORMATS[code]
+            value  = struct.unpack_from(format, self.data, self.offset)[0]
+            self.offset += struct.calcsize(format)
+            return bool(value) if code == "b" else value
+        elif code in "sog":
+            if code == "g":
+                length, start = ord(self.data[self.offset]), self.offset+1
+            else:
+                length, start = struct.unpack_from("<I", self.data, self.offset)[0], self.offset+4
+            self.offset = start+length+1
+            return self.data[start:start+length]
+        elif code == "v":
+            return self.read(self.read("g"))
+        elif code == "a":
+            length  = self.read("u")
+            element = signature[1:]
+            self.offset += -self.offset % _ALIGNMENT[element[0]]
+            end     = self.offset+length
+            items   = []
+            while self.offset < end:
+                items.append(self.read(element))
+            return dict(items) if element[0] == "{" else items
+        else:
+            return tuple([self.read(member) for member in split_signature(signature[1:-1])])
+
+class Message(object):
+    def __init__(self, type, serial, fields, body, flags=0):
+        self.type   = type
+        self.serial = serial
+        self.fields = fields
+        self.body   = body
+        self.flags  = flags
+
+    def encode(self):
+        signature = self.fields.get(SIGNATURE, ("g", ""))[1]
+        body      = _Writer()
+        for member, value in zip(split_signature(signature), self.body):
+            body.write(member, value)
+        body      = body.getvalue()
+
+        header = _Writer()
+        header.raw(struct.pack("<cBBBII", "l", self.type, self.flags, 1, len(body), self.serial))
+        header.write("a(yv)", sorted(self.fields.items()))
+        header.pad(8)
+        return header.getvalue() + body
+
+    @classmethod
+    def read_from(cls, sock):
+        head = _recv_exactly(sock, 16)
+        endian, type, flags, version, body_length, serial, fields_length = struct.unpack("<cBBBIII", head)
+        if endian != "l":
+            raise DBusError("omplex.Error.Endianness", "big-endian messages aren't supported")
+
+        header_length  = 16 + fields_length
+        header_length += -header_length % 8
+        data   = head + _recv_exactly(sock, header_length-16+body_length)
+        fields = dict(_Reader(data, 12).read("a(yv)"))
+
+        reader = _Reader(data, header_length)
+        body   = [reader.read(member) for member in split_signature(fields.get(SIGNATURE, ""))]
+        return cls(type, serial, fields, body, flags)
+
+def _recv_exactly(sock, length):
+    parts = []
+    while length > 0:
+        data = sock.recv(length)
+        if not data:
+            raise DBusError("org.freedesktop.DBus.Error.Disconnected", "connection closed")
+        parts.append(data)
+        length -= len(data)
+    return "".join(parts)
+
+def _connect_socket(address):
+    """
+    Connects to the first usable ``unix:`` transport in a D-Bus address.
+    """
+    for transport in address.split(";"):
+        kind, _, params = transport.partition(":")
+        if kind != "unix":
+            continue
+        params = dict([param.split("=", 1) for param in params.split(",") if "=" in param])
+        if "path" in params:
+            path = urllib.unquote(params["path"])
+        elif "abstract" in params:
+            path = "\0" + urllib.unquote(params["abstract"])
+        else:
+            continue
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return sock
+    raise DBusError("org.freedesktop.DBus.Error.BadAddress", "no usable transport in %r" % address)
+
+class Connection(object):
+    """
+    A connection to a message bus.  Calls may be made from any thread, they
+    take turns on the socket.
+    """
+    def __init__(self, address, timeout=CALL_TIMEOUT):
+        self._lock      = threading.Lock()
+        self._serials   = itertools.count(1)
+        self._queued    = []
+        try:
+            self._sock = _connect_socket(address)
+            self._sock.settimeout(timeout)
+            self._authenticate()
+        except socket.error, e:
+            raise DBusError("org.freedesktop.DBus.Error.NoServer", str(e))
+        self.unique_name = self.call(BUS_NAME, BUS_PATH, BUS_NAME, "Hello")[0]
+
+    def _authenticate(self):
+        self._sock.sendall("\0AUTH EXTERNAL %s\r\n" % str(os.getuid()).encode("hex"))
+        reply = ""
+        while not reply.endswith("\r\n"):
+            data = self._sock.recv(256)
+            if not data:
+                break
+            reply += data
+        if not reply.startswith("OK"):
+            raise DBusError("org.freedesktop.DBus.Error.AuthFailed", reply.strip())
+        self._sock.sendall("BEGIN\r\n")
+
+    def close(self):
+        self._sock.close()
+
+    def _send(self, message):
+        self._sock.sendall(message.encode())
+
+    def call(self, destination, path, interface, member, signature="", args=()):
+        """
+        Calls a method and returns the values it replied with as a list.
+        """
+        fields = {PATH: ("o", path), MEMBER: ("s", member), DESTINATION: ("s", destination)}
+        if interface:
+            fields[INTERFACE] = ("s", interface)
+        if signature:
+            fields[SIGNATURE] = ("g", signature)
+
+        with self._lock:
+            serial = next(self._serials)
+            try:
+                self._send(Message(METHOD_CALL, serial, fields, list(args)))
+                while True:
+                    reply = Message.read_from(self._sock)
+                    if reply.fields.get(REPLY_SERIAL) == serial:
+                        break
+                    if reply.type == METHOD_CALL:
+                        # Somebody is calling us, keep it for ``serve``
+                        self._queued.append(reply)
+            except socket.error, e:
+                raise DBusError("org.freedesktop.DBus.Error.Disconnected", str(e))
+
+        if reply.type == ERROR:
+            raise DBusError(reply.fields.get(ERROR_NAME, "org.freedesktop.DBus.Error.Failed"),
+                            reply.body and reply.body[0] or "")
+        return reply.body
+
+    def name_has_owner(self, name):
+        return self.call(BUS_NAME, BUS_PATH, BUS_NAME, "NameHasOwner", "s", (name,))[0]
+
+    def request_name(self, name, flags=0):
+        return self.call(BUS_NAME, BUS_PATH, BUS_NAME, "RequestName", "su", (name, flags))[0]
+
+    def serve(self, handler):
+        """
+        Answers method calls until the connection drops.  ``handler`` is
+        called as ``handler(interface, member, args)`` and returns the reply
+        as ``(signature, values)`` or raises ``DBusError``.
+        """
+        self._sock.settimeout(None)
+        while True:
+            if self._queued:
+                message = self._queued.pop(0)
+            else:
+                try:
+                    message = Message.read_from(self._sock)
+                except (socket.error, DBusError):
+                    return
+            if message.type != METHOD_CALL:
+                continue
+
+            fields = {REPLY_SERIAL: ("u", message.serial)}
+            if SENDER in message.fields:
+                fields[DESTINATION] = ("s", message.fields[SENDER])
+            try:
+                signature, values = handler(message.fields.get(INTERFACE), message.fields.get(MEMBER), message.body)
+                if signature:
+                    fields[SIGNATURE] = ("g", signature)
+                reply = Message(METHOD_RETURN, next(self._serials), fields, list(values))
+            except DBusError, e:
+                fields[ERROR_NAME] = ("s", e.name)
+                fields[SIGNATURE]  = ("g", "s")
+                reply = Message(ERROR, next(self._serials), fields, [str(e)])
+            with self._lock:
+                self._send(reply)
+
+def bus_address():
+    """
+    Returns the address of omxplayer's bus, or None if it hasn't got one.
+    """
+    address = os.environ.get("OMPLEX_OMXPLAYER_DBUS")
+    if address:
+        return address
+
+    try:
+        with open("/tmp/omxplayerdbus.%s" % (os.environ.get("USER") or "root")) as fh:
+            return fh.read().strip() or None
+    except IOError:
+        return None
+
+class Control(object):
+    """
+    omxplayer's MPRIS interface.  Every method raises ``DBusError`` if
+    omxplayer can't be reached.
+    """
+    def __init__(self, connection, name=MPRIS_NAME):
+        self.connection = connection
+        self.name       = name
+
+    @classmethod
+    def connect(cls, name=MPRIS_NAME, timeout=CONNECT_TIMEOUT):
+        """
+        Waits up to ``timeout`` seconds for omxplayer to appear on its bus.
+        Returns None if there is no bus or omxplayer never showed up, i.e.
+        it doesn't support D-Bus.
+        """
+        deadline   = monotonic() + timeout
+        connection = None
+        while True:
+            try:
+                if connection is None:
+                    address = bus_address()
+                    if address is None:
+                        return None
+                    connection = Connection(address)
+                if connection.name_has_owner(name):
+                    control = cls(connection, name)
+                    control.position()
+                    return control
+            except DBusError, e:
+                log.debug("Control::connect %s" % e)
+                if connection is not None:
+                    connection.close()
+                    connection = None
+
+            if monotonic() >= deadline:
+                if connection is not None:
+                    connection.close()
+                return None
+            time.sleep(CONNECT_RETRY)
+
+    def close(self):
+        self.connection.close()
+
+    def _call(self, interface, member, signature="", args=()):
+        return self.connection.call(self.name, MPRIS_PATH, interface, member, signature, args)
+
+    def position(self):
+        """
+        The playback position in seconds.
+        """
+        return self._call(PROPERTIES, "Position")[0] / 1e6
+
+    def duration(self):
+        return self._call(PROPERTIES, "Duration")[0] / 1e6
+
+    def set_position(self, seconds):
+        self._call(PLAYER, "SetPosition", "ox", ("/not/used", int(seconds*1e6)))
+
+    def set_volume(self, db):
+        """
+        Sets the volume to ``db`` decibels, omxplayer takes it as a linear
+        factor.
+        """
+        self._call(PROPERTIES, "Volume", "d", (10 ** (db/20.0),))
+
+    def select_audio(self, index):
+        """
+        Selects the audio stream at ``index``, counting from 0.
+        """
+        return self._call(PLAYER, "SelectAudio", "i", (index,))[0]
+
+    def select_subtitle(self, index):
+        """
+        Selects and shows the subtitle stream at ``index``, counting from 0.
+        """
+        selected = self._call(PLAYER, "SelectSubtitle", "i", (index,))[0]
+        if selected:
+            self._call(PLAYER, "ShowSubtitles")
+        return selected
+
+    def hide_subtitles(self):
+        self._call(PLAYER, "HideSubtitles")
@@ -0,0 +1,298 @@
+"""
+mpv.py - mpv player backend
+
+Runs mpv with its JSON IPC server on a unix socket in place of omxplayer,
+for boxes that aren't Raspberry Pis and for comparing playback engines.
+Commands are sent over the socket, and the replies, position changes and the
+end of playback are read from it on the event loop thread:
+
+    {"command": ["set_property", "pause", true], "request_id": 3}
+
+ffplay was considered as well, but it can only be controlled through keys
+pressed in its own window, so there's no way to drive it from omplex.
+
+The mpv executable can be overridden with ``OMPLEX_MPV``.
+"""
+import errno
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import tempfile
+import threading
+
+from backend import PlayerBackend
+from clock import monotonic
+from loop import loop
+from trace import tracer
+from utils import find_exe
+
+# Seconds to wait for mpv to open its IPC socket and to answer a command
+STARTUP_TIMEOUT = 10
+COMMAND_TIMEOUT = 2
+
+_MPV_EXECUTABLE = os.environ.get("OMPLEX_MPV", "mpv")
+
+log = logging.getLogger("mpv")
+
+class MPVError(Exception):
+    pass
+
+class MPVPlayer(PlayerBackend):
+    name = "mpv"
+
+    # mpv's volume goes from 0 to 100 by default
+    _VOLUME_MAX = 100.0
+
+    _DURATION_REXP = re.compile(r"Duration: ([\d.]+)")
+
+    def __init__(self, mediafile, offset=0, audio_idx=None, subtitle_idx=None, finished_callback=None):
+        super(MPVPlayer, self).__init__(mediafile, offset, audio_idx, subtitle_idx, finished_callback)
+
+        self.position       = float(offset)
+        self.volume         = 1.0
+
+        self._lock          = threading.Lock()
+        self._exited        = threading.Event()
+        self._pending       = {}
+        self._next_id       = 1
+        self._buffer        = b""
+        self._socket        = None
+        self._trace         = tracer.current()
+
+        self._dir           = tempfile.mkdtemp(prefix="omplex-mpv-")
+        self._socket_path   = os.path.join(self._dir, "ipc")
+
+        args = [_MPV_EXECUTABLE, "--fs", "--no-terminal", "--idle=no",
+                "--input-ipc-server=%s" % self._socket_path]
+        if offset > 0:
+            args.append("--start=%s" % offset)
+        if audio_idx is not None:
+            args.append("--aid=%s" % audio_idx)
+        args.append("--sid=%s" % (subtitle_idx if subtitle_idx is not None else "no"))
+        args.extend(["--", mediafile])
+
+        log.debug("MPVPlayer::__init__ launch command: %s" % " ".join(args))
+        with tracer.span("spawn mpv"):
+            self._process = subprocess.Popen(args, stdin=open(os.devnull), stdout=open(os.devnull, "w"),
+                                             stderr=subprocess.STDOUT, close_fds=True)
+
+        with tracer.span("connect mpv"):
+            self._socket = self._connect()
+        if self._socket is None:
+            log.error("MPVPlayer::__init__ couldn't connect to mpv")
+            if self._process.poll() is None:
+                self._process.kill()
+            self._finish()
+            return
+
+        loop.add_reader(self._socket.fileno(), self._on_output)
+        self._send(["observe_property", 1, "time-pos"])
+        self._send(["observe_property", 2, "demuxer-cache-duration"])
+
+    @classmethod
+    def available(cls):
+        return bool(find_exe(_MPV_EXECUTABLE))
+
+    @classmethod
+    def probe_duration(cls, url):
+        """
+        Asks mpv for the duration of ``url``, without playing it.
+        """
+        try:
+            process = subprocess.Popen([_MPV_EXECUTABLE, "--no-config", "--vo=null", "--ao=null", "--frames=1",
+                                        "--term-playing-msg=Duration: ${=duration}", "--", url],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output  = process.communicate()[0]
+        except OSError, e:
+            log.error("MPVPlayer::probe_duration couldn't run mpv: %s" % e)
+            return
+
+        match = cls._DURATION_REXP.search(output)
+        if not match:
+            log.warning("MPVPlayer::probe_duration no duration found for %s" % url)
+            return
+        return float(match.group(1))
+
+    def _connect(self):
+        deadline = monotonic() + STARTUP_TIMEOUT
+        while monotonic() < deadline and self._process.poll() is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self._socket_path)
+                # Only read once it's readable, so this just bounds sends
+                sock.settimeout(COMMAND_TIMEOUT)
+                return sock
+            except socket.error:
+                sock.close()
+            self._exited.wait(0.02)
+
+    def _on_output(self):
+        """
+        Called on the event loop thread whenever mpv has written something.
+        """
+        try:
+            data = self._socket.recv(65536)
+        except socket.timeout:
+            return
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            data = b""
+
+        if not data:
+            # mpv closes the socket as it quits
+            self._finish()
+            return
+
+        self._buffer += data
+        lines = self._buffer.split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            if line:
+                self._handle(json.loads(line))
+
+    def _handle(self, message):
+        if "request_id" in message:
+            with self._lock:
+                pending = self._pending.pop(message["request_id"], None)
+            if pending:
+                pending[1].append(message)
+                pending[0].set()
+        elif message.get("event") == "property-change" and message.get("name") == "time-pos":
+            if message.get("data") is not None:
+                if self._trace:
+                    self._trace.finish("first position")
+                    self._trace = None
+                self.position = message["data"]
+        elif message.get("event") == "property-change" and message.get("name") == "demuxer-cache-duration":
+            # Seconds read ahead of the position, what's left to play if the
+            # network stalls
+            self.buffered = message.get("data")
+        elif message.get("event") == "end-file" and message.get("reason") == "eof":
+            self.finished = True
+
+    def _send(self, command, wait=False):
+        """
+        Sends ``command`` to mpv.  With ``wait`` it blocks for the reply and
+        returns its data, raising ``MPVError`` if the command failed.
+        """
+        sock = self._socket
+        if sock is None:
+            raise MPVError("mpv isn't running")
+
+        # Replies are read on the loop thread, so it can't wait for them
+        wait = wait and not loop.in_loop_thread()
+
+        with self._lock:
+            request_id     = self._next_id
+            self._next_id += 1
+            if wait:
+                self._pending[request_id] = (threading.Event(), [])
+                pending = self._pending[request_id]
+
+        data = json.dumps({"command": command, "request_id": request_id}) + "\n"
+        try:
+            sock.sendall(data)
+        except socket.error, e:
+            raise MPVError("mpv went away: %s" % e)
+
+        if not wait:
+            return
+
+        if not pending[0].wait(COMMAND_TIMEOUT):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise MPVError("mpv didn't answer %s" % command[0])
+
+        reply = pending[1][0]
+        if reply.get("error") != "success":
+            raise MPVError("%s failed: %s" % (command[0], reply.get("error")))
+        return reply.get("data")
+
+    def _finish(self):
+        if self._exited.is_set():
+            return
+
+        if self._socket is not None:
+            loop.remove_reader(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+        loop.run_in_worker(self._reap)
+
+        if not self.stopped and not self.finished:
+            # Gone without reaching the end, it crashed or couldn't play
+            log.error("MPVPlayer::_finish mpv quit before the end of the video")
+
+        self._ended()
+        self._exited.set()
+
+    def _reap(self):
+        self._process.wait()
+        try:
+            os.unlink(self._socket_path)
+        except OSError:
+            pass
+        os.rmdir(self._dir)
+
+    def wait(self, timeout=None):
+        self._exited.wait(timeout)
+        return self._exited.is_set()
+
+    def toggle_pause(self):
+        try:
+            self._send(["set_property", "pause", not self._paused], wait=True)
+            self._paused = not self._paused
+        except MPVError, e:
+            log.error("MPVPlayer::toggle_pause %s" % e)
+
+    def stop(self):
+        # Flag the stop first so the exit isn't mistaken for the end of the
+        # video
+        self.stopped = True
+        try:
+            self._send(["quit"])
+        except MPVError:
+            pass
+        if self._process.poll() is None:
+            loop.call_later(COMMAND_TIMEOUT, self._kill)
+
+    def _kill(self):
+        if self._process.poll() is None:
+            log.warning("MPVPlayer::_kill mpv didn't quit, killing it")
+            self._process.kill()
+
+    def seek(self, offset):
+        try:
+            self._send(["seek", offset, "absolute"], wait=True)
+            self.position = float(offset)
+        except MPVError, e:
+            log.error("MPVPlayer::seek %s" % e)
+
+    def get_volume(self):
+        return self.volume
+
+    def set_volume(self, pct):
+        try:
+            self._send(["set_property", "volume", float(pct)*self._VOLUME_MAX], wait=True)
+            self.volume = float(pct)
+        except MPVError, e:
+            log.error("MPVPlayer::set_volume %s" % e)
+
+    def set_audiochannel(self, audio_idx):
+        try:
+            self._send(["set_property", "aid", audio_idx], wait=True)
+        except MPVError, e:
+            log.warning("MPVPlayer::set_audiochannel %s" % e)
+            return False
+        return True
+
+    def set_subtitles(self, subtitle_idx):
+        try:
+            self._send(["set_property", "sid", subtitle_idx if subtitle_idx is not None else "no"], wait=True)
+        except MPVError, e:
+            log.warning("MPVPlayer::set_subtitles %s" % e)
+            return False
+        return True
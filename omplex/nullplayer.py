@@ -0,0 +1,118 @@
+"""
+nullplayer.py - A player backend that plays nothing
+
+Keeps a playback position against omplex's clock as if something were
+playing and finishes once the media's duration has gone by.  Everything
+else, from stream switches to the volume, is simply remembered.  With it
+omplex runs on any machine without a display, omxplayer or media, which is
+what load tests and profiling want, and on a ``VirtualClock`` hours of
+playback pass in no time.
+
+Select it with the ``player_backend`` setting:
+
+    settings.player_backend = "null"
+
+The length of the pretend media is ``OMPLEX_NULL_DURATION`` seconds.
+"""
+import logging
+import os
+import threading
+
+from backend import PlayerBackend
+from clock import clock
+from loop import loop
+from trace import tracer
+
+DURATION = float(os.environ.get("OMPLEX_NULL_DURATION", 1800))
+
+log = logging.getLogger("nullplayer")
+
+class NullPlayer(PlayerBackend):
+    name = "null"
+
+    def __init__(self, mediafile, offset=0, audio_idx=None, subtitle_idx=None, finished_callback=None):
+        super(NullPlayer, self).__init__(mediafile, offset, audio_idx, subtitle_idx, finished_callback)
+        log.debug("NullPlayer::__init__ playing %s from %ss" % (mediafile, offset))
+
+        self.duration       = DURATION
+        self.audio_idx      = audio_idx
+        self.subtitle_idx   = subtitle_idx
+        self.volume         = 1.0
+
+        self._lock          = threading.Lock()
+        self._exited        = threading.Event()
+        self._end_handle    = None
+        self._offset        = 0.0
+        self._started       = None
+        self._set_position(offset)
+
+        trace = tracer.current()
+        if trace:
+            trace.finish("first position", position=offset)
+
+    @classmethod
+    def probe_duration(cls, url):
+        return DURATION
+
+    @property
+    def position(self):
+        with self._lock:
+            if self._started is None:
+                return self._offset
+            return min(self._offset + clock.now()-self._started, self.duration)
+
+    def _set_position(self, offset):
+        """
+        Moves to ``offset`` and, unless paused, (re)schedules the end.
+        """
+        with self._lock:
+            self._offset = max(0.0, min(float(offset), self.duration))
+            if self._end_handle:
+                self._end_handle.cancel()
+                self._end_handle = None
+            if self._paused or self.stopped:
+                self._started = None
+                return
+            self._started    = clock.now()
+            self._end_handle = loop.call_later(self.duration-self._offset, self._end)
+
+    def _end(self):
+        with self._lock:
+            if self._exited.is_set():
+                return
+            self._end_handle = None
+            self._offset     = self.duration
+            self._started    = None
+        self._ended()
+        self._exited.set()
+
+    def toggle_pause(self):
+        position     = self.position
+        self._paused = not self._paused
+        self._set_position(position)
+
+    def stop(self):
+        self.stopped = True
+        self._set_position(self.position)
+        self._exited.set()
+
+    def wait(self, timeout=None):
+        self._exited.wait(timeout)
+        return self._exited.is_set()
+
+    def seek(self, offset):
+        self._set_position(offset)
+
+    def get_volume(self):
+        return self.volume
+
+    def set_volume(self, pct):
+        self.volume = float(pct)
+
+    def set_audiochannel(self, audio_idx):
+        self.audio_idx = audio_idx
+        return True
+
+    def set_subtitles(self, subtitle_idx):
+        self.subtitle_idx = subtitle_idx
+        return True
@@ -1,12 +1,36 @@
 import ctypes
 import logging
 import os
-import Queue
 import threading
+import time
+
+from lazy import Lazy
+from loop import loop
+from metrics import registry
+
+# Seconds between progress updates while the OSD is visible.  libosd only
+# redraws the progress bar and clocks, and only when they changed.
+UPDATE_INTERVAL = 1.0
+
+# Size in pixels the poster is drawn at, posters are fetched at this size
+ARTWORK_SIZE    = (120, 180)
+
+# Seconds the OSD stays up after a seek or resuming playback
+SHOW_SECONDS    = 5
 
 log = logging.getLogger('osd')
 
-class OSD(threading.Thread):
+OSD_RENDERS         = registry.counter("omplex_osd_renders_total", "OSD states drawn", ("state",))
+OSD_DROPPED_STATES  = registry.counter("omplex_osd_dropped_states_total",
+                                       "OSD states replaced by a newer one before they were drawn")
+
+class OSD(object):
+    """
+    Draws the on-screen display using ``libosd``.  ``show`` and ``hide`` only
+    record the state the OSD should be in, the event loop thread draws it.
+    A state that's replaced before it was drawn is dropped, so a burst of
+    pause/play presses draws once, in the latest state.
+    """
     LIB_NAME = "libosd.so"
     LIB_SEARCH_DIRS = (
         "./",
@@ -14,42 +38,134 @@ class OSD(threading.Thread):
     )
 
     def __init__(self):
-        self.halt = False
-        self.queue = Queue.Queue()
+        self.halt  = True
+        self.__lib = None
+
+        # Builds of libosd from before posters can't draw them
+        self._artwork   = False
+
+        self._position  = None
+        self._paused    = False
+        self._ticker    = None
+        self._shown     = None
+        self._hide_handle = None
+
+        # Latest requested state, ("show", args) or ("hide", None), and
+        # whether it has been drawn
+        self._lock      = threading.Lock()
+        self._desired   = ("hide", None)
+        self._pending   = False
+        self._visible   = False
+
+    def start(self):
+        """
+        Loads ``libosd``, nothing is drawn until this has been called.
+        """
         for path in self.LIB_SEARCH_DIRS:
             try:
                 self.__lib = ctypes.cdll.LoadLibrary(os.path.join(path, self.LIB_NAME))
-                log.debug("OSD::__init__ loaded libosd from %s" % path)
+                log.debug("OSD::start loaded libosd from %s" % path)
                 break
             except:
-                log.info("OSD::__init__ Unable to load libosd from %s" % path)
+                log.info("OSD::start Unable to load libosd from %s" % path)
                 self.__lib = None
+        self._artwork = self.__lib is not None and hasattr(self.__lib, "set_osd_image")
+        self.halt = False
 
-        threading.Thread.__init__(self)
-    
     def stop(self):
         self.halt = True
-        self.join()
 
-    def run(self):
-        while not self.halt:
-            try:
-                task = self.queue.get(True, 0.5)
-                getattr(self.__lib, task[0])(*task[1])
-            except Queue.Empty:
-                continue
-            except Exception, e:
-                log.error("OSD unknown error: %s" % e)
-
-    def show(self, played, duration, title):
-        if not self.__lib:
+    def _run(self, name, args):
+        try:
+            getattr(self.__lib, name)(*args)
+        except Exception, e:
+            log.error("OSD unknown error: %s" % e)
+
+    def show(self, played, duration, title, position=None, artwork=None, hide_after=None, paused=False):
+        """
+        Shows the OSD at ``played`` of ``duration`` seconds, labelled as
+        paused if ``paused`` is set.  If ``position``
+        is given it's called on the event loop thread, and must not block,
+        to keep the progress bar and clocks moving while the OSD is up.
+        ``artwork`` is the path of a JPEG poster, ``ARTWORK_SIZE`` at most.
+        With ``hide_after`` the OSD hides itself after that many seconds.
+        """
+        if not self.__lib or self.halt:
             return
-        self.queue.put(('show_osd', (played, duration, title)))
+        self._set_state("show", (played, duration, title, position, artwork, hide_after, paused))
 
     def hide(self):
         if not self.__lib:
             return
-        self.queue.put(('hide_osd', []))
+        self._set_state("hide", None)
+
+    def _set_state(self, state, args):
+        with self._lock:
+            if self._pending:
+                OSD_DROPPED_STATES.inc()
+            self._desired = (state, args)
+            wake, self._pending = not self._pending, True
+
+        if wake:
+            loop.call_soon(self._render)
+
+    def _render(self):
+        with self._lock:
+            state, args   = self._desired
+            self._pending = False
+
+        if state == "show":
+            self._show(*args)
+        elif self._visible:
+            self._hide()
+        else:
+            return
+        OSD_RENDERS.inc(state=state)
+
+    def _show(self, played, duration, title, position, artwork, hide_after, paused):
+        self._cancel_ticker()
+        if self._artwork:
+            # libosd keeps the last few posters decoded, so showing the OSD
+            # again over the same video doesn't read or decode it again
+            self._run('set_osd_image', (artwork,))
+        self._run('show_osd', (played, duration, title, int(paused)))
+        self._paused  = paused
+        self._shown   = (int(played), int(time.time()/60))
+        self._visible = True
+
+        if position is not None:
+            self._position = position
+            self._ticker   = loop.call_every(UPDATE_INTERVAL, self._tick)
+        if hide_after is not None:
+            self._hide_handle = loop.call_later(hide_after, self.hide)
+
+    def _hide(self):
+        self._cancel_ticker()
+        self._run('hide_osd', [])
+        self._visible = False
+
+    def _cancel_ticker(self):
+        if self._ticker:
+            self._ticker.cancel()
+            self._ticker   = None
+            self._position = None
+        if self._hide_handle:
+            self._hide_handle.cancel()
+            self._hide_handle = None
+
+    def _tick(self):
+        try:
+            played = int(self._position())
+        except Exception, e:
+            log.error("OSD::_tick unable to get the position: %s" % e)
+            self._cancel_ticker()
+            return
 
-osd = OSD()
+        # Only redraws while playing, or when the clocks change once a
+        # minute while paused
+        shown = (played, int(time.time()/60))
+        if shown != self._shown:
+            self._shown = shown
+            self._run('update_osd', (played, int(self._paused)))
 
+osd = Lazy(OSD)
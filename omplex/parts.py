@@ -0,0 +1,111 @@
+"""
+parts.py - Multi-part media on a single timeline
+
+Plex only gives the duration of a multi-part video as a whole, but omxplayer
+plays and reports positions one part at a time.  A ``PartIndex`` lays the
+parts of a video end to end so a position on the whole video can be mapped
+to a part and an offset into it and back.
+
+Part durations come from the part's own ``duration`` attribute when the
+server has one, otherwise the player backend probes them.  Probed
+durations are kept in ``durationCache``, which is written to disk so each
+part is only probed once:
+
+    durationCache.load("parts.dat")
+
+    index = PartIndex([1320.0, 1290.5, None])
+    index.locate(1500)          # (1, 180.0)
+    index.start(2)              # 2610.5
+"""
+import collections
+import logging
+import threading
+
+from picklefile import PickleFile
+
+# Parts remembered, the oldest are forgotten first
+MAX_ENTRIES     = 1000
+
+log = logging.getLogger("parts")
+
+class DurationCache(object):
+    """
+    Part durations in seconds keyed by part, kept on disk between runs.
+    """
+    def __init__(self):
+        self._durations     = collections.OrderedDict()
+        self._lock          = threading.RLock()
+        self._file          = PickleFile(self._snapshot)
+
+    def _snapshot(self):
+        with self._lock:
+            return collections.OrderedDict(self._durations)
+
+    def load(self, path):
+        try:
+            durations = self._file.load(path)
+        except Exception, e:
+            log.error("DurationCache::load error loading %s: %s" % (path, e))
+            return False
+        if durations is None:
+            return True
+
+        with self._lock:
+            self._durations.update(durations)
+        log.debug("DurationCache::load %d part durations" % len(durations))
+        return True
+
+    def get(self, key):
+        with self._lock:
+            return self._durations.get(key)
+
+    def set(self, key, duration):
+        with self._lock:
+            self._durations.pop(key, None)
+            self._durations[key] = duration
+            while len(self._durations) > MAX_ENTRIES:
+                self._durations.popitem(last=False)
+        self._file.save()
+
+    def flush(self):
+        """
+        Writes the cache now, instead of once the changes have settled.
+        """
+        return self._file.flush()
+
+class PartIndex(object):
+    """
+    The durations of a video's parts in seconds, None where one isn't known.
+    """
+    def __init__(self, durations):
+        self.durations = list(durations)
+
+    def __len__(self):
+        return len(self.durations)
+
+    @property
+    def complete(self):
+        return None not in self.durations
+
+    def start(self, part):
+        """
+        Returns where ``part`` starts on the whole video, or None if an
+        earlier part's duration isn't known.
+        """
+        earlier = self.durations[:part]
+        if None in earlier:
+            return None
+        return sum(earlier)
+
+    def locate(self, position):
+        """
+        Returns the part ``position`` falls in and the offset into it.  A
+        part of unknown duration is assumed to hold whatever is left.
+        """
+        for part, duration in enumerate(self.durations):
+            if duration is None or position < duration or part == len(self.durations)-1:
+                return part, max(0.0, position)
+            position -= duration
+        return 0, 0.0
+
+durationCache = DurationCache()
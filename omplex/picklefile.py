@@ -0,0 +1,94 @@
+"""
+picklefile.py - State kept on disk as a pickle
+
+The settings, the part durations and the transcode qualities are each kept
+in a pickle file.  Writes go to a temporary file that is synced and then
+renamed over the old one, so a crash mid-write never leaves a truncated file
+behind.  Changes are coalesced into a single write ``SAVE_DELAY`` seconds
+after the first, made on a worker off the loop thread.
+
+The owner hands over a function returning what to write, and calls ``save``
+whenever that changes.  The function is called on whichever thread writes,
+so it should take the owner's lock and return a copy:
+
+    store = PickleFile(lambda: dict(self._data))
+    data  = store.load("settings.dat")  # None if there's no file yet
+    store.save()
+    store.flush()                       # Write now, at shutdown
+"""
+import logging
+import os
+import threading
+import cPickle as pickle
+
+from loop import loop
+
+# Coalesce changes into a single write at most every second
+SAVE_DELAY = 1.0
+
+log = logging.getLogger("picklefile")
+
+class PickleFile(object):
+    def __init__(self, snapshot):
+        self.path       = None
+        self._snapshot  = snapshot
+        self._timer     = None
+
+        # Guards the timer, never held while taking the snapshot
+        self._lock      = threading.Lock()
+
+        # Keeps writes in the order their snapshots were taken
+        self._write_lock = threading.Lock()
+
+    def load(self, path):
+        """
+        Writes to ``path`` from now on and returns what it holds, or None if
+        it doesn't exist yet.  Raises if it can't be read.
+        """
+        self.path = path
+        if not os.path.exists(path):
+            return None
+
+        fh = open(path, "rb")
+        try:
+            return pickle.load(fh)
+        finally:
+            fh.close()
+
+    def save(self):
+        """
+        Schedules a write, unless one is already due.
+        """
+        with self._lock:
+            if self.path and self._timer is None:
+                self._timer = loop.call_later(SAVE_DELAY, loop.run_in_worker, self.flush)
+
+    def flush(self):
+        """
+        Writes the file now.  Returns False if there's nowhere to write it or
+        writing failed.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if not self.path:
+            return False
+
+        with self._write_lock:
+            tmp_path = "%s.tmp" % self.path
+            try:
+                fh = open(tmp_path, "wb")
+                try:
+                    pickle.dump(self._snapshot(), fh, pickle.HIGHEST_PROTOCOL)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                finally:
+                    fh.close()
+                os.rename(tmp_path, self.path)
+            except Exception, e:
+                log.error("PickleFile::flush error saving %s: %s" % (self.path, e))
+                return False
+
+        return True
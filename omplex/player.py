@@ -1,19 +1,30 @@
 """
 From: https://github.com/filmor/pyomxplayer
 """
+import collections
 import logging
 import math
 import os
 import pexpect
 import re
+import subprocess
 
-from threading import Thread, RLock
-from time import sleep
+from threading import Event, RLock
 
+from artwork import artworkCache
+from bandwidth import QUALITIES, qualityManager
+from backend import DEFAULT_BACKEND, PlayerBackend, get_backend
+from clock import Timer, clock, monotonic
 from conf import settings
 from display import display
-from osd import osd
-from utils import synchronous, Timer
+from lazy import Lazy
+from loop import loop
+from metrics import registry
+from mpris import Control, DBusError, bus_address
+from osd import ARTWORK_SIZE, SHOW_SECONDS, osd
+from trace import tracer, traced
+from utils import synchronous
+from watchdog import Watchdog
 
 # Scrobble progress to Plex server at most every 5 seconds
 SCROBBLE_INTERVAL = 5
@@ -21,11 +32,71 @@ SCROBBLE_INTERVAL = 5
 # Mark the item as watch when it is at 95% 
 COMPLETE_PERCENT  = 0.95
 
+# Stalling to buffer this many times within the watchdog's window lowers the
+# transcode quality
+STALLS_TO_LOWER   = 2
+
 log = logging.getLogger('player')
 
+PLAYER_STARTUP_SECONDS = registry.histogram("omplex_player_startup_seconds",
+                                            "Time from spawning omxplayer until its headers are parsed")
+PLAYER_SEEK_SECONDS    = registry.histogram("omplex_player_seek_seconds",
+                                            "Time taken to seek, including restarting omxplayer")
+OMXPLAYER_SPAWNS       = registry.counter("omplex_omxplayer_spawns_total",
+                                          "Number of omxplayer processes launched")
+OMXPLAYER_RESTARTS     = registry.counter("omplex_omxplayer_restarts_total",
+                                          "Number of times omxplayer was restarted to seek")
+OMXPLAYER_DBUS         = registry.counter("omplex_omxplayer_dbus_total",
+                                          "omxplayer launches by whether they could be controlled over D-Bus",
+                                          ("connected",))
+STREAM_SWITCH_SECONDS  = registry.histogram("omplex_stream_switch_seconds",
+                                            "Time taken to switch audio or subtitle streams", ("method",))
+PLAYER_RESPAWNS        = registry.counter("omplex_player_respawns_total",
+                                          "Times a stalled player was restarted at its last good position",
+                                          ("reason",))
+PLAYBACK_POSITION      = registry.gauge("omplex_playback_position_seconds",
+                                        "Position of the video being played, on the whole video")
+PLAYBACK_PLAYING       = registry.gauge("omplex_playback_playing",
+                                        "1 while a video is playing, 0 while paused or stopped")
+
+class PlaybackState(collections.namedtuple("PlaybackState",
+        "state position sampled_at media duration rating_key key guid "
+        "volume audio_idx subtitle_idx part")):
+    """
+    What ``PlayerManager`` is playing, as of its last change.  Never
+    modified, a new one replaces it instead, so it can be read from any
+    thread without taking the manager's lock.
+
+    ``position`` is in seconds on the whole video, as sampled at
+    ``sampled_at`` on omplex's clock.  ``duration`` is Plex's, a string in
+    milliseconds, or None when stopped.
+    """
+    __slots__ = ()
+
+    def position_at(self, now=None):
+        """
+        Returns the position extrapolated to ``now``, by default the current
+        time, assuming playback went on at normal speed since the sample.
+        """
+        if self.state != "playing":
+            return self.position
+
+        if now is None:
+            now = clock.now()
+        position = self.position + max(0.0, now-self.sampled_at)
+        try:
+            duration = float(self.duration)*1e-3
+        except (TypeError, ValueError):
+            return position
+        if duration > 0:
+            position = min(position, duration)
+        return position
+
+STOPPED = PlaybackState("stopped", 0.0, 0.0, None, None, None, None, None, None, None, None, None)
+
 class PlayerManager(object):
     """
-    Manages the relationship between a ``Player`` instance and a ``Media``
+    Manages the relationship between a player backend and a ``Media``
     item.  This is designed to be used as a singleton via the ``playerManager``
     instance in this module.  All communication between a caller and either the
     current ``player`` or ``media`` instance should be done through this class
@@ -36,22 +107,107 @@ class PlayerManager(object):
         self._player      = None
         self._video       = None
         self._lock        = RLock()
+        self._listeners   = []
         self.last_update = Timer()
 
-        self.__part      = 1
+        # Replaced as a whole on every change, see ``_publish``
+        self.state        = STOPPED
+
+        # Where each part of a multi-part video sits on the whole video
+        self._parts       = None
+
+        # The transcode's index into ``QUALITIES``, None when direct playing
+        self._quality     = None
+
+        # Notices the playing video stalling, a new one for each video
+        self._watchdog    = Watchdog()
+
+    def add_listener(self, callback):
+        """
+        Registers ``callback`` to be called, with no arguments, on the event
+        loop thread whenever playback starts or stops.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            loop.call_soon(callback)
+
+    def _publish(self, position=None):
+        """
+        Replaces ``state`` with a snapshot of what's playing now.  Called
+        with the lock held after every change, ``position`` saves asking
+        the player when the caller already knows it.
+        """
+        player, video = self._player, self._video
+        if not player or not video:
+            self.state = STOPPED
+            return
+
+        if position is None:
+            position = self._on_video(player.position)
+
+        try:
+            volume = player.get_volume()
+        except Exception, e:
+            log.debug("PlayerManager::_publish couldn't get the volume: %s" % e)
+            volume = self.state.volume
+
+        if player.paused:
+            state = "paused"
+        elif self._watchdog.state in ("buffering", "stalled"):
+            state = "buffering"
+        else:
+            state = "playing"
+
+        # A single assignment, readers see either the old state or this one
+        self.state = PlaybackState(state        = state,
+                                   position     = float(position),
+                                   sampled_at   = clock.now(),
+                                   media        = video.parent,
+                                   duration     = video.get_video_attr("duration", "0"),
+                                   rating_key   = video.get_video_attr("ratingKey"),
+                                   key          = video.get_video_attr("key"),
+                                   guid         = video.get_video_attr("guid"),
+                                   volume       = volume,
+                                   audio_idx    = video.get_audio_idx(),
+                                   subtitle_idx = video.get_subtitle_idx(),
+                                   part         = video._part)
 
     @synchronous('_lock')
     def update(self):
         if self._video and self._player:
             # Check to see if we need to turn the display on
-            if not display.is_on:
+            if not display.is_on and not display.powering_on:
                 log.debug("PlayerManager::update display is off, turning on")
                 self._player.pause()
-                display.power_on()
-
-            if self.last_update.elapsed() > SCROBBLE_INTERVAL and not self.is_paused():
+                display.power_on_async()
+
+            # Resample the position so readers don't drift from the player
+            offset   = self._player.query_position()
+            position = self._on_video(offset)
+            state    = self._watchdog.check(self._player, offset)
+            if not self._player.paused:
+                qualityManager.measure(self._video.parent.server_url)
+            self._publish(position)
+
+            if (state == "buffering" and self._quality is not None and
+                    self._watchdog.recent_stalls() >= STALLS_TO_LOWER):
+                self._lower_quality()
+                return
+            if state in ("buffering", "stalled"):
+                # Slow streams take a while to start, that's not a stall
+                if self._watchdog.reason == "starting":
+                    timeout = settings.start_timeout
+                else:
+                    timeout = settings.stall_timeout
+                if self._watchdog.stalled_for() >= timeout:
+                    self._respawn()
+                    return
+
+            if self.last_update.elapsed() > SCROBBLE_INTERVAL and not self._player.paused:
                 if not self._video.played:
-                    position = self._player.position * 1e3   # In ms
+                    position = position * 1e3   # In ms
                     duration = self._video.get_duration()
                     if float(position)/float(duration)  >= COMPLETE_PERCENT:
                         log.info("PlayerManager::update setting media as watched")
@@ -61,36 +217,184 @@ class PlayerManager(object):
                         self._video.update_position(position)
                 self.last_update.restart()
 
+    @traced("PlayerManager.play")
     @synchronous('_lock')
     def play(self, video, offset=0):
+        """
+        Plays ``video`` from ``offset`` seconds, counted across all of its
+        parts if it has more than one.
+        """
+        parts = None
+        if video.is_multipart():
+            parts = video.get_part_index()
+            if offset and not parts.complete:
+                # Resuming needs to know where the parts start, this only
+                # takes a while the first time the video is played
+                with tracer.span("probe parts"):
+                    video.probe_part_durations(self._backend().probe_duration)
+                parts = video.get_part_index()
+            elif not parts.complete:
+                loop.run_in_worker(self._probe_parts, video)
+
+            part, offset = parts.locate(offset)
+            log.debug("PlayerManager::play starting part %d at %ss" % (part, offset))
+            video.select_part(part)
+
+        self._watchdog = Watchdog()
+        self._start(video, offset, parts)
+
+    def _backend(self):
+        """
+        Returns the backend class picked in the settings, or the default
+        one if that can't be used here.
+        """
+        try:
+            backend = get_backend(settings.player_backend)
+        except ValueError, e:
+            log.error("PlayerManager::_backend %s, using %s" % (e, DEFAULT_BACKEND))
+            return get_backend(DEFAULT_BACKEND)
+
+        if not backend.available():
+            log.error("PlayerManager::_backend %s isn't available, using %s" % (backend.name, DEFAULT_BACKEND))
+            return get_backend(DEFAULT_BACKEND)
+        return backend
+
+    def _start(self, video, offset, parts, quality=None):
+        """
+        Starts playing ``video``'s selected part, ``offset`` seconds in.
+        Transcodes are started at ``quality``, by default the one that suits
+        the server and network.
+        """
         self.stop()
 
-        args = []
-        if offset > 0:
-            args.extend(("-l", str(offset)))
-
-        audio_idx = video.get_audio_idx()
-        if audio_idx is not None:
-            log.debug("PlayerManager::play selecting audio stream index=%s" % audio_idx)
-            args.extend(["-n", audio_idx])
-
-        sub_idx = video.get_subtitle_idx()
-        if sub_idx is not None:
-            log.debug("PlayerManager::play selecting subtitle index=%s" % sub_idx)
-            args.extend(["-t", sub_idx])
+        # Wake the display while the player starts instead of before
+        if not display.is_on:
+            log.debug("PlayerManager::_start display is off, turning on")
+            display.power_on_async()
+
+        qualityManager.playback_started()
+        if video.is_transcode_suggested():
+            if quality is None:
+                quality = qualityManager.initial(video.parent.server_url)
+            bitrate, width, height = QUALITIES[quality]
+            url = video.get_playback_url(direct_play=False, video_bitrate=bitrate,
+                                         video_width=width, video_height=height)
         else:
-            # No subtitles -- this is pretty hacky
-            log.debug("PlayerManager::play disabling subtitles")
-            args.extend(["--subtitles", "/dev/null"])
-
-        # TODO: Check settings for transcode settings...
-        url = video.get_playback_url()
+            quality = None
+            url     = video.get_playback_url(direct_play=True)
         if not url:
-            log.error("PlayerManager::play no URL found")
+            log.error("PlayerManager::_start no URL found")
+            tracer.mark("no playback url")
             return
             
-        self._player = Player(mediafile=url, args=args, start_playback=True, finished_callback=self.finished_callback)
+        backend = self._backend()
+        try:
+            self._player = backend(url, offset=offset, audio_idx=video.get_audio_idx(),
+                                   subtitle_idx=video.get_subtitle_idx(),
+                                   finished_callback=self.finished_callback)
+        except Exception, e:
+            log.error("PlayerManager::_start unable to start %s: %s" % (backend.name, e))
+            tracer.mark("player failed to start")
+            return
         self._video  = video
+        self._parts  = parts
+        self._quality = quality
+        self._watchdog.reset(offset)
+        self._publish(self._on_video(offset))
+        self._notify()
+
+    def _lower_quality(self):
+        """
+        Restarts the transcode where it is, at a lower quality.
+        """
+        server  = self._video.parent.server_url
+        quality = qualityManager.lower(server, self._quality)
+        if quality is None:
+            log.warning("PlayerManager::_lower_quality already at the lowest quality")
+            self._watchdog.stalls = []
+            return
+
+        log.info("PlayerManager::_lower_quality restarting at %d kbps" % QUALITIES[quality][0])
+        self._watchdog.stalls = []
+        self._start(self._video, int(self._player.query_position()), self._parts, quality)
+
+    def _respawn(self):
+        """
+        Restarts a player that has been stalled for ``stall_timeout``
+        seconds, or has been starting for ``start_timeout``, where it last
+        played from at the same quality.
+        """
+        reason = self._watchdog.reason
+        offset = self._watchdog.last_good or 0
+        log.warning("PlayerManager::_respawn %s for %ds, restarting at %ss" %
+                    (reason, self._watchdog.stalled_for(), offset))
+        PLAYER_RESPAWNS.inc(reason=reason)
+        self._start(self._video, int(offset), self._parts, self._quality)
+
+    def _probe_parts(self, video):
+        """
+        Finds the durations of ``video``'s parts that aren't known yet.
+        Runs on a worker, as each part takes a launch of the player.
+        """
+        if not video.probe_part_durations(self._backend().probe_duration):
+            return
+        with self._lock:
+            if self._video is video:
+                self._parts = video.get_part_index()
+                log.debug("PlayerManager::_probe_parts part durations %s" % self._parts.durations)
+                self._publish()
+
+    @synchronous('_lock')
+    def set_streams(self, audio_id=None, subtitle_id=None):
+        """
+        Switches to the audio and subtitle streams with the given Plex
+        stream ids, a ``subtitle_id`` of "0" turns subtitles off.  The player
+        switches in place when it can, otherwise it's restarted at the
+        current position.  The choice is saved to the server either way.
+        """
+        if not self._video or not self._player:
+            return
+
+        if audio_id is not None and not self._video.select_stream(2, audio_id):
+            audio_id = None
+        if subtitle_id is not None and not self._video.select_stream(3, subtitle_id):
+            subtitle_id = None
+        if audio_id is None and subtitle_id is None:
+            return
+
+        started = monotonic()
+        if self._video.is_transcode_suggested():
+            # The transcoder picks the streams, so it has to know about them
+            # before it's asked for a new stream
+            log.debug("PlayerManager::set_streams restarting the transcode")
+            self._video.save_streams(audio_id, subtitle_id)
+            self._start(self._video, int(self._player.query_position()), self._parts, self._quality)
+            method = "transcode"
+        else:
+            if self._switch_streams(audio_id, subtitle_id):
+                method = "switch"
+            else:
+                log.debug("PlayerManager::set_streams restarting the player")
+                self._start(self._video, int(self._player.query_position()), self._parts)
+                method = "restart"
+            loop.run_in_worker(self._video.save_streams, audio_id, subtitle_id)
+        self._publish()
+        STREAM_SWITCH_SECONDS.observe(monotonic()-started, method=method)
+
+    def _switch_streams(self, audio_id, subtitle_id):
+        """
+        Tries switching streams without restarting the player, returns
+        whether it worked.
+        """
+        try:
+            if audio_id is not None and not self._player.set_audiochannel(self._video.get_audio_idx()):
+                return False
+            if subtitle_id is not None and not self._player.set_subtitles(self._video.get_subtitle_idx()):
+                return False
+        except NotImplementedError:
+            log.debug("PlayerManager::_switch_streams %s can't switch in place" % self._player.name)
+            return False
+        return True
 
     @synchronous('_lock')
     def stop(self):
@@ -102,78 +406,129 @@ class PlayerManager(object):
         osd.hide()
 
         self._player.stop()
+        qualityManager.playback_stopped()
 
-        self._player = None
-        self._video  = None
+        self._player  = None
+        self._video   = None
+        self._parts   = None
+        self._quality = None
+        self._watchdog.reset()
+        self._publish()
+        self._notify()
 
-    @synchronous('_lock')
-    def get_volume(self, percent=False):
-        if self._player:
-            if not percent:
-                return self._player._volume
-            return self._player._VOLUME_STEPS.index(self._player._volume)/float(len(self._player._VOLUME_STEPS))
+    def get_volume(self):
+        """
+        Returns the volume between 0 and 1, or None when stopped.
+        """
+        return self.state.volume
 
     @synchronous('_lock')
     def toggle_pause(self):
         if self._player:
             self._player.toggle_pause()
-            if self.is_paused() and self._video:
+            self._publish()
+            if self._player.paused:
                 log.debug("PlayerManager::toggle_pause showing OSD")
-                try:
-                    duration = int(int(self._video.get_duration())*1e-3)
-                except:
-                    duration = 0
-                osd.show(int(self._player.position), duration, self._video.get_proper_title())
+                self._show_osd()
             else:
-                log.debug("PlayerManager::toggle_pause hiding OSD")
-                osd.hide()
+                log.debug("PlayerManager::toggle_pause showing OSD until it hides itself")
+                self._show_osd(hide_after=SHOW_SECONDS)
+
+    def _show_osd(self, hide_after=None):
+        """
+        Shows the OSD over the playing video, ticking along with it until
+        hidden, or for ``hide_after`` seconds.
+        """
+        if not self._video or not self._player:
+            return
+        try:
+            duration = int(int(self._video.get_duration())*1e-3)
+        except:
+            duration = 0
+        osd.show(int(self.get_position()), duration, self._video.get_proper_title(),
+                 position=self.get_position, artwork=artworkCache.get(self._video, ARTWORK_SIZE),
+                 hide_after=hide_after, paused=self._player.paused)
+
+    def get_position(self):
+        """
+        Returns the current position in seconds, on the whole video for
+        multi-part ones.  Not synchronized, so it can be polled from the
+        event loop without waiting on a seek.
+        """
+        player = self._player
+        if player:
+            return self._on_video(player.position)
+        return 0
+
+    def query_position(self):
+        """
+        Like ``get_position``, but asks the player when it can.
+        """
+        player = self._player
+        if player:
+            return self._on_video(player.query_position())
+        return 0
+
+    def _on_video(self, position):
+        """
+        Turns a position in the playing part into one on the whole video.
+        """
+        parts, video = self._parts, self._video
+        if parts and video:
+            # Unknown until the earlier parts have been probed
+            start = parts.start(video._part)
+            if start:
+                position += start
+        return position
 
     @synchronous('_lock')
     def seek(self, offset):
         """
-        Seek to ``offset`` seconds
+        Seek to ``offset`` seconds, on the whole video for multi-part ones.
         """
         if self._player:
-            osd.hide()
-            self._player.seek(offset)
+            if self._parts:
+                part, offset = self._parts.locate(offset)
+                if part != self._video._part:
+                    log.debug("PlayerManager::seek switching to part %d at %ss" % (part, offset))
+                    self._video.select_part(part)
+                    self._start(self._video, int(offset), self._parts, self._quality)
+                    self._show_osd(hide_after=SHOW_SECONDS)
+                    return
+            self._player.seek(int(offset))
+            self._publish(self._on_video(int(offset)))
+            self._show_osd(hide_after=SHOW_SECONDS)
 
     @synchronous('_lock')
     def set_volume(self, pct):
         if self._player:
             self._player.set_volume(pct)
+            self._publish()
 
-    @synchronous('_lock')
     def get_state(self):
-        if not self._player:
-            return "stopped"
-
-        if self._player._paused:
-            return "paused"
-
-        return "playing"
+        return self.state.state
     
-    @synchronous('_lock')
     def is_paused(self):
-        if self._player:
-            return self._player._paused
-        return False
+        return self.state.state == "paused"
 
     @synchronous('_lock')
     def finished_callback(self):
-        if not self._video:
+        # The callback runs on a worker, playback may have moved on since
+        if not self._video or not self._player or not self._player.finished:
             return
-        
+
         if self._video.is_multipart():
             log.debug("PlayerManager::finished_callback media is multi-part, checking for next part")
             # Try to select the next part
-            next_part = self.__part+1
-            if self._video.select_part(next_part):
-                self.__part = next_part
+            if self._video.select_part(self._video._part+1):
                 log.debug("PlayerManager::finished_callback starting next part")
-                self.play(self._video)
+                self._start(self._video, 0, self._parts, self._quality)
+                return
 
             log.debug("PlayerManager::finished_callback no more parts found")
 
+        self.stop()
+
     @synchronous('_lock')
     def get_video_attr(self, attr, default=None):
         if self._video:
@@ -181,7 +536,8 @@ class PlayerManager(object):
         return default
 
 
-_OMXPLAYER_EXECUTABLE = "/usr/bin/omxplayer"
+# Can be overridden to run against a different build or a fake player
+_OMXPLAYER_EXECUTABLE = os.environ.get("OMPLEX_OMXPLAYER", "/usr/bin/omxplayer")
 
 def is_omxplayer_available():
     """
@@ -190,15 +546,26 @@ def is_omxplayer_available():
     return os.access(_OMXPLAYER_EXECUTABLE, os.X_OK)
 
 def omxplayer_parameter_exists(parameter_string):
-    return bool(re.search(b"\s%s\s" % parameter_string.strip(), os.popen("/usr/bin/omxplayer").read()))
+    return bool(re.search(b"\s%s\s" % parameter_string.strip(), os.popen(_OMXPLAYER_EXECUTABLE).read()))
 
-class Player(object):
+class OMXPlayerError(Exception):
+    pass
+
+class Player(PlayerBackend):
+    """
+    The omxplayer backend.  omxplayer is driven through keystrokes on its
+    terminal, or over D-Bus once it turns up there, and its position is read
+    from its status lines.
+    """
+    name = "omxplayer"
 
     _FILEPROP_REXP = re.compile(r".*audio streams (\d+) video streams (\d+) chapters (\d+) subtitles (\d+).*")
     _VIDEOPROP_REXP = re.compile(r".*Video codec ([\w-]+) width (\d+) height (\d+) profile (-?\d+) fps ([\d.]+).*", flags=re.MULTILINE)
     _AUDIOPROP_REXP = re.compile(r".*Audio codec (\w+) channels (\d+) samplerate (\d+) bitspersample (\d+).*", flags=re.MULTILINE)
-    _STATUS_REXP = re.compile(r"(M:|V :)\s*([\d.]+).*")
+    _STATUS_REXP = re.compile(r"(M:|V :)\s*([\d.]+)")
+    _BUFFER_REXP = re.compile(r"V:\s*([\d.]+)s\s.*?A:\s*([\d.]+)\s")
     _DONE_REXP = re.compile(r"have a nice day.*")
+    _DURATION_REXP = re.compile(r"Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)")
 
     _LAUNCH_CMD = _OMXPLAYER_EXECUTABLE + " -s %s \"%s\""
 
@@ -226,8 +593,60 @@ class Player(object):
     FAST_SPEED = 1
     VFAST_SPEED = 2
 
-    def __init__(self, mediafile, args=[], start_playback=False, fullscreen=True, finished_callback=None):
-        self.mediafile = mediafile
+    @classmethod
+    def available(cls):
+        return is_omxplayer_available()
+
+    @classmethod
+    def probe_duration(cls, url):
+        """
+        Asks ``omxplayer -i`` for the duration of ``url``.
+        """
+        try:
+            process = subprocess.Popen([_OMXPLAYER_EXECUTABLE, "-i", url], stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output  = process.communicate()[0]
+        except OSError, e:
+            log.error("Player::probe_duration couldn't run omxplayer: %s" % e)
+            return
+
+        match = cls._DURATION_REXP.search(output)
+        if not match:
+            log.warning("Player::probe_duration no duration found for %s" % url)
+            return
+
+        hours, minutes, seconds = match.groups()
+        return int(hours)*3600 + int(minutes)*60 + float(seconds)
+
+    @classmethod
+    def _launch_args(cls, offset, audio_idx, subtitle_idx):
+        args = []
+        if offset > 0:
+            args.extend(("-l", str(offset)))
+
+        if audio_idx is not None:
+            log.debug("Player::_launch_args selecting audio stream index=%s" % audio_idx)
+            args.extend(["-n", audio_idx])
+
+        if subtitle_idx is not None:
+            log.debug("Player::_launch_args selecting subtitle index=%s" % subtitle_idx)
+            args.extend(["-t", subtitle_idx])
+        else:
+            # No subtitles -- this is pretty hacky
+            log.debug("Player::_launch_args disabling subtitles")
+            args.extend(["--subtitles", "/dev/null"])
+        return args
+
+    def __init__(self, mediafile, offset=0, audio_idx=None, subtitle_idx=None, finished_callback=None,
+                 args=None, start_playback=False, fullscreen=True):
+        """
+        ``args`` are passed to omxplayer in place of those for ``offset``,
+        ``audio_idx`` and ``subtitle_idx``.
+        """
+        super(Player, self).__init__(mediafile, offset, audio_idx, subtitle_idx, finished_callback)
+
+        if args is None:
+            args = self._launch_args(offset, audio_idx, subtitle_idx)
 
         if fullscreen and "-r" not in args:
             args.append("-r")
@@ -240,27 +659,40 @@ class Player(object):
             if adev in ["hdmi", "local", "both"]:
                 args.extend(["-o", adev])
 
-        
-        self.finished_callback = finished_callback
+
         self.args = args
             
         cmd = self._LAUNCH_CMD % (" ".join([str(s) for s in self.args]), mediafile)
         log.debug("Player::__init__ launch command: %s" % cmd)
-        
-        self._process = pexpect.spawn(cmd)
+
+        # The playback session this player belongs to, if it's traced
+        self._trace = tracer.current()
+
+        started = monotonic()
+        with tracer.span("spawn omxplayer"):
+            self._process = pexpect.spawn(cmd)
+        OMXPLAYER_SPAWNS.inc()
 
         self._paused = False
         self._subtitles_visible = True
         self._volume = 0 # dB
         self._speed = self.NORMAL_SPEED
-        self.position = 0.0
+        self.position = float(offset)
         
         self.video = dict()
         self.audio = dict()
 
         headers = b""
-        while b"Video" not in headers or b"Audio" not in headers:
-            headers += self._process.readline()
+        with tracer.span("read headers"):
+            while b"Video" not in headers or b"Audio" not in headers:
+                line = self._process.readline()
+                if not line:
+                    # Gone before printing its headers, readline would
+                    # return nothing forever
+                    self._process.close(force=True)
+                    raise OMXPlayerError("omxplayer exited before playing, status %s: %s" %
+                                         (self._process.exitstatus, headers.strip()[-200:]))
+                headers += line
 
         # Get video properties
         video_props = self._VIDEOPROP_REXP.search(headers).groups()
@@ -275,6 +707,8 @@ class Player(object):
         (self.audio['channels'], self.audio['rate'],
          self.audio['bps']) = [int(x) for x in audio_props[1:]]
 
+        PLAYER_STARTUP_SECONDS.observe(monotonic()-started)
+
         # Get file properties
         #file_props = self._FILEPROP_REXP.match(self._process.readline()).groups()
         #(self.audio['streams'], self.video['streams'],
@@ -286,44 +720,129 @@ class Player(object):
 
         self.finished = False
         self.stopped  = False
-        self.position = 0
 
-        self._position_thread = Thread(target=self._get_position)
-        self._position_thread.start()
+        # Number of status lines parsed since launch, and when the last one
+        # was, counting the launch as one
+        self.status_lines = 0
+        self.last_status  = clock.now()
+
+        # Output read after the last complete status line, and set once
+        # omxplayer has exited
+        self._output = b""
+        self._exited = Event()
+        self._control = None
+
+        # Whatever pexpect read past the headers is still in its buffer
+        output = self._process.buffer
+        self._process.buffer = b""
+        self._parse_output(output)
+
+        if not self._exited.is_set():
+            loop.add_reader(self._process.child_fd, self._on_output)
+
+        # Newer omxplayer builds can be controlled over D-Bus, until that's
+        # connected (or if it never is) keystrokes are used
+        if not self._exited.is_set() and bus_address():
+            loop.run_in_worker(self._connect_control)
 
         if start_playback:
             self.play()
         #self.toggle_subtitles()
         
+    def _on_output(self):
+        """
+        Called on the event loop thread whenever omxplayer has written
+        something.
+        """
+        try:
+            data = self._process.read_nonblocking(4096, 0)
+        except pexpect.TIMEOUT:
+            return
+        except pexpect.EOF:
+            self._finish()
+            return
 
-    def _get_position(self):
-        
-        while not self.finished or not self.stopped:            
-            index = self._process.expect([
-                self._STATUS_REXP,
-                pexpect.TIMEOUT,
-                pexpect.EOF,
-                self._DONE_REXP
-            ])
-            
-            if index == 1: # on timeout, keep going
-                continue
-            elif index in (2, 3): # EOF or finished
-                if not self.stopped:
-                    log.debug("Player::_get_position player reached end of video")
-                    self.finished = True
-                    if callable(self.finished_callback):
-                        # Only fire the callback if the video ended normally and
-                        # was **not** stopped
-                        log.debug("Player::_get_position firing callback")
-                        self.finished_callback()
-                break
-            elif index == 0:
-                self.position = float(self._process.match.group(2).strip()) / 1000000
-        
-            sleep(0.1)
-            
-            # print "POS: %0.2f" % self.position
+        self._parse_output(data)
+
+    def _parse_output(self, data):
+        output = self._output + data
+
+        # Status lines are terminated by a carriage return, only parse up to
+        # the last complete one
+        end = max(output.rfind(b"\r"), output.rfind(b"\n"))
+        if end < 0:
+            self._output = output[-4096:]
+            return
+        lines, self._output = output[:end+1], output[end+1:]
+
+        matches = self._STATUS_REXP.findall(lines)
+        if matches:
+            self.position = float(matches[-1][1].strip()) / 1000000
+            if not self.status_lines and self._trace:
+                self._trace.finish("first status line", position=self.position)
+            self.status_lines += len(matches)
+            self.last_status   = clock.now()
+
+            # The seconds of video and audio omxplayer has queued up, both
+            # run dry when it's waiting on the network
+            buffers = self._BUFFER_REXP.findall(lines)
+            if buffers:
+                self.buffered = min(float(b) for b in buffers[-1])
+
+        if self._DONE_REXP.search(lines):
+            self._finish()
+
+    def _connect_control(self):
+        control = Control.connect()
+        OMXPLAYER_DBUS.inc(connected=str(control is not None).lower())
+        if control is None:
+            log.debug("Player::_connect_control omxplayer isn't on D-Bus, using keystrokes")
+            return
+        if self._exited.is_set() or self.stopped:
+            control.close()
+            return
+        log.debug("Player::_connect_control controlling omxplayer over D-Bus")
+        self._control = control
+
+    def _close_control(self):
+        control, self._control = self._control, None
+        if control:
+            control.close()
+
+    def query_position(self):
+        """
+        Returns the position in seconds, asking omxplayer over D-Bus when
+        possible rather than relying on the last status line.
+        """
+        control = self._control
+        if control:
+            try:
+                self.position = control.position()
+            except DBusError, e:
+                log.warning("Player::query_position D-Bus failed, using status lines: %s" % e)
+                self._close_control()
+        return self.position
+
+    def _finish(self):
+        if self._exited.is_set():
+            return
+
+        self._close_control()
+
+        loop.remove_reader(self._process.child_fd)
+        if self._trace:
+            self._trace.finish("omxplayer exited")
+
+        self._ended()
+        self._exited.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until omxplayer has exited.  Returns ``False`` if it was
+        still running after ``timeout`` seconds.
+        """
+        self._exited.wait(timeout)
+        return self._exited.is_set()
 
     def pause(self):
         if not self._paused:
@@ -342,9 +861,12 @@ class Player(object):
             self._subtitles_visible = not self._subtitles_visible
 
     def stop(self):
+        # Flag the stop first so the exit isn't mistaken for the end of the
+        # video
+        self.stopped = True
+        self._close_control()
         self._process.send(self._QUIT_CMD)
         self._process.terminate(force=True)
-        self.stopped = True
 
     def decrease_speed(self):
         """
@@ -378,14 +900,45 @@ class Player(object):
         self._speed = speed
 
     def set_audiochannel(self, channel_idx):
-        raise NotImplementedError
+        """
+        Selects an audio stream, counting from 1 like omxplayer's ``-n``.
+        Only possible over D-Bus.
+        """
+        if not self._control:
+            raise NotImplementedError
+        try:
+            return self._control.select_audio(channel_idx-1)
+        except DBusError, e:
+            log.warning("Player::set_audiochannel D-Bus failed: %s" % e)
+            self._close_control()
+            return False
 
     def set_subtitles(self, sub_idx):
-        raise NotImplementedError
+        """
+        Selects a subtitle stream, counting from 1 like omxplayer's ``-t``,
+        or hides subtitles if ``sub_idx`` is None.  Only possible over D-Bus.
+        """
+        if not self._control:
+            raise NotImplementedError
+        try:
+            if sub_idx is None:
+                self._control.hide_subtitles()
+                self._subtitles_visible = False
+                return True
+            self._subtitles_visible = self._control.select_subtitle(sub_idx-1)
+        except DBusError, e:
+            log.warning("Player::set_subtitles D-Bus failed: %s" % e)
+            self._close_control()
+            return False
+        return self._subtitles_visible
 
     def set_chapter(self, chapter_idx):
+        # MPRIS has no way to pick a chapter either
         raise NotImplementedError
 
+    def get_volume(self):
+        return self._VOLUME_STEPS.index(self._volume)/float(len(self._VOLUME_STEPS))
+
     def set_volume(self, pct):
         """
         Set volume to ``pct`` which should be a percentage:
@@ -408,6 +961,18 @@ class Player(object):
 
         log.info("Setting volume to %.2f%% (%d dB)" % (pct, target_volume))
 
+        control = self._control
+        if control:
+            # Land on a step, as the keystrokes would, so they can take over
+            target_volume = min(target_volume, self._VOLUME_STEPS[-1])
+            try:
+                control.set_volume(target_volume)
+                self._volume = target_volume
+                return
+            except DBusError, e:
+                log.warning("Player::set_volume D-Bus failed, using keystrokes: %s" % e)
+                self._close_control()
+
         if target_volume > self._volume:
             for i in self._VOLUME_STEPS[volume_index+1:]:
                 if i > target_volume:
@@ -422,12 +987,37 @@ class Player(object):
 
     def seek(self, offset):
         """
+        Seeks to ``offset`` seconds over D-Bus, otherwise falls back to
         mountainpenguin's hack:
         stop player, and restart at a specific point using the -l flag (position)
         """
+        started = monotonic()
+        control = self._control
+        if control:
+            try:
+                control.set_position(offset)
+                self.position = float(offset)
+                PLAYER_SEEK_SECONDS.observe(monotonic()-started)
+                return
+            except DBusError, e:
+                log.warning("Player::seek D-Bus failed, restarting omxplayer: %s" % e)
+                self._close_control()
+
+        OMXPLAYER_RESTARTS.inc()
+        self.restart(offset)
+        PLAYER_SEEK_SECONDS.observe(monotonic()-started)
+        return
+
+    def restart(self, offset):
+        """
+        Restarts omxplayer at ``offset`` seconds.
+        """
         log.info("Stopping omxplayer")
         self.stop()
 
+        # Make sure the old process is gone before the new one starts
+        self.wait()
+
         offset = str(offset)
 
         # Look to see if the "start position" argument was provided previously
@@ -443,8 +1033,8 @@ class Player(object):
             self.args.extend(("-l", offset))
 
         log.info("Restarting at offset %s" % offset)
-        self.__init__(mediafile=self.mediafile, args=self.args)
-        return
+        self.__init__(mediafile=self.mediafile, offset=float(offset), args=self.args,
+                      finished_callback=self.finished_callback)
     
     @classmethod
     def _calculate_num_seeks(cls, curr_offset, target_offset):
@@ -514,5 +1104,8 @@ class Player(object):
         self._volume += self._VOLUME_INCREMENT
         self._process.send(self._INCREASE_VOLUME_CMD)
 
-playerManager = PlayerManager()
+playerManager = Lazy(PlayerManager)
+
+PLAYBACK_POSITION.set_function(lambda: playerManager.state.position_at())
+PLAYBACK_PLAYING.set_function(lambda: int(playerManager.state.state == "playing"))
 
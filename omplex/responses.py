@@ -0,0 +1,92 @@
+"""
+responses.py - Pre-encoded XML replies for the HTTP control server
+
+Almost every command sent by a controller is answered with the same
+``<Response code="200" status="OK" />`` document, so the fixed replies are
+encoded once and served as byte strings.  Dynamic documents, such as
+timelines, are written out by ``serialize`` which skips the ElementTree and
+StringIO round trip.
+"""
+import time
+
+from email.utils import formatdate
+
+XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>\n"
+
+# Limit how many distinct error replies get cached
+_MAX_CACHED_RESPONSES = 64
+
+_standard_responses = {}
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def _escape_attr(value):
+    return (_encode(value).replace("&", "&amp;").replace("<", "&lt;")
+                          .replace(">", "&gt;").replace('"', "&quot;")
+                          .replace("\n", "&#10;"))
+
+def _escape_text(value):
+    return _encode(value).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def standard_response(code=200, status="OK"):
+    """
+    Returns the encoded ``<Response>`` document for ``code`` and ``status``.
+    """
+    key  = (code, status)
+    data = _standard_responses.get(key)
+    if data is None:
+        data = '%s<Response code="%s" status="%s" />' % (XML_DECLARATION,
+                                                         _escape_attr(code),
+                                                         _escape_attr(status))
+        if len(_standard_responses) < _MAX_CACHED_RESPONSES:
+            _standard_responses[key] = data
+    return data
+
+OK_RESPONSE = standard_response()
+
+def _write(element, out):
+    out.append("<%s" % element.tag)
+    for key, value in element.items():
+        out.append(' %s="%s"' % (key, _escape_attr(value)))
+
+    children = list(element)
+    if not children and not element.text:
+        out.append(" />")
+    else:
+        out.append(">")
+        if element.text:
+            out.append(_escape_text(element.text))
+        for child in children:
+            _write(child, out)
+        out.append("</%s>" % element.tag)
+
+    if element.tail:
+        out.append(_escape_text(element.tail))
+
+def serialize(element):
+    """
+    Encodes ``element`` as a UTF-8 XML document, including the declaration.
+    """
+    out = [XML_DECLARATION]
+    if element is not None:
+        _write(element, out)
+    return "".join(out)
+
+_date_cache = (0, "")
+
+def http_date():
+    """
+    Returns the current time formatted for the HTTP ``Date`` header.  The
+    string is only rebuilt once per second.
+    """
+    global _date_cache
+
+    now = int(time.time())
+    cached_at, value = _date_cache
+    if cached_at != now:
+        value = formatdate(now, usegmt=True)
+        _date_cache = (now, value)
+    return value
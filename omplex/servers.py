@@ -0,0 +1,328 @@
+"""
+servers.py - Known Plex Media Servers and their health
+
+``serverRegistry`` holds the servers found by GDM, keyed by their
+Resource-Identifier.  Discovery feeds it one response at a time and it
+tells its listeners which servers were added, updated or removed, so
+nobody has to rescan the whole list.  Servers that stop answering are aged
+out after a few discovery rounds.
+
+``serverTracker`` keeps a smoothed round-trip time and error rate for every
+known server (or one contacted by a controller) and ranks them, so
+registration checks and fallbacks try the fastest healthy server first.
+
+Every server gets its own keep-alive ``requests.Session``.  Probes go out in
+parallel on the event loop's workers and leave a connection open in that
+session, so the first real request to a server, such as fetching metadata
+after a ``playMedia``, doesn't pay for the TCP handshake.
+
+Example usage:
+
+    from servers import serverRegistry, serverTracker
+
+    serverRegistry.add_listener(on_server_event)    # (event, info)
+    for server in serverTracker.ranked():
+        ...
+    response = serverTracker.request("http://10.0.0.2:32400/library/metadata/1")
+"""
+import logging
+import threading
+import urlparse
+
+from clock import clock, monotonic
+from loop import loop
+from metrics import registry
+
+# Smoothing factors of the round-trip time and error rate averages
+RTT_ALPHA       = 0.3
+ERROR_ALPHA     = 0.2
+
+# Seconds added to a server's score for an error rate of 1, so a fast but
+# flaky server ranks below a slower reliable one
+ERROR_PENALTY   = 1.0
+
+# Timeouts of health probes and of regular requests
+PROBE_TIMEOUT   = 2
+REQUEST_TIMEOUT = 30
+
+# Re-probe the preferred server on controller activity when its connection
+# has been idle this long, before the server drops it
+WARM_AFTER      = 10
+
+# Forget a server after it missed this many discovery rounds in a row
+MAX_MISSED_ROUNDS = 2
+
+# GDM response headers and the server info keys they're stored under
+GDM_HEADERS = {
+    "Content-Type":         "content-type",
+    "Resource-Identifier":  "uuid",
+    "Name":                 "serverName",
+    "Port":                 "port",
+    "Updated-At":           "updated",
+    "Version":              "version",
+    "Server-Class":         "class",
+}
+
+log = logging.getLogger("servers")
+
+def parse_gdm_response(data, address):
+    """
+    Turns a GDM discovery response from ``address`` into a server info
+    dict, or returns None if it wasn't a positive response.
+    """
+    lines = data.splitlines()
+    if not lines or "200 OK" not in lines[0]:
+        return None
+
+    info = { 'server' : address,
+             'discovery' : "auto",
+             'owned' : '1',
+             'master' : 1,
+             'role' : 'master',
+             'class' : None }
+
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        key = GDM_HEADERS.get(name.strip())
+        if sep and key:
+            info[key] = value.strip()
+
+    return info
+
+class ServerRegistry(object):
+    """
+    Servers found by discovery, keyed by Resource-Identifier (or address
+    for servers that don't send one).  Listeners are called on the event
+    loop thread as ``callback(event, info)`` where ``event`` is one of
+    ``"add"``, ``"update"`` or ``"remove"``.
+    """
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._servers   = {}
+        self._missed    = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self, event, info):
+        for callback in self._listeners:
+            loop.call_soon(callback, event, info)
+
+    @staticmethod
+    def key(info):
+        return info.get("uuid") or "%s:%s" % (info["server"], info.get("port"))
+
+    def servers(self):
+        with self._lock:
+            return self._servers.values()
+
+    def get(self, key):
+        return self._servers.get(key)
+
+    def __len__(self):
+        return len(self._servers)
+
+    def seen(self, info):
+        """
+        Records a discovery response, returns the server's key.
+        """
+        key = self.key(info)
+        with self._lock:
+            current = self._servers.get(key)
+            self._missed[key] = 0
+            if current == info:
+                return key
+            self._servers[key] = info
+
+        if current is None:
+            log.debug("ServerRegistry::seen added %s (%s)" % (info.get("serverName"), key))
+            self._notify("add", info)
+        else:
+            log.debug("ServerRegistry::seen updated %s (%s)" % (info.get("serverName"), key))
+            self._notify("update", info)
+        return key
+
+    def end_round(self, seen):
+        """
+        Called after a discovery round with the keys of the servers that
+        answered.  Servers that have been quiet for too long are removed.
+        """
+        removed = []
+        with self._lock:
+            for key in self._servers.keys():
+                if key in seen:
+                    continue
+                self._missed[key] = self._missed.get(key, 0) + 1
+                if self._missed[key] >= MAX_MISSED_ROUNDS:
+                    removed.append(self._servers.pop(key))
+                    self._missed.pop(key)
+
+        for info in removed:
+            log.debug("ServerRegistry::end_round removed %s (%s)" % (info.get("serverName"), self.key(info)))
+            self._notify("remove", info)
+
+class ServerHealth(object):
+    def __init__(self, host, port):
+        self.host       = host
+        self.port       = int(port)
+        self.info       = {}
+        self.rtt        = None
+        self.error_rate = 0.0
+        self.probes     = 0
+        self.last_used  = 0
+        self.session    = None
+
+    def open(self):
+        """
+        Creates the server's session on first use.  ``requests`` takes a
+        while to import, so that's left until a server is actually used.
+        """
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        return self.session
+
+    def __repr__(self):
+        return "<ServerHealth: %s:%s rtt=%s errors=%.2f>" % (self.host, self.port, self.rtt, self.error_rate)
+
+    @property
+    def url(self):
+        return "http://%s:%s" % (self.host, self.port)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+    def score(self):
+        """
+        Lower is better.  Servers that were never reached sort last.
+        """
+        if self.rtt is None:
+            return float("inf")
+        return self.rtt + self.error_rate * ERROR_PENALTY
+
+    def record(self, ok, rtt=None):
+        self.error_rate += ERROR_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if rtt is not None:
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                self.rtt += RTT_ALPHA * (rtt - self.rtt)
+
+class ServerTracker(object):
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._servers   = {}
+
+    def _get(self, host, port, create=True):
+        key = (host, int(port))
+        with self._lock:
+            server = self._servers.get(key)
+            if server is None and create:
+                server = self._servers[key] = ServerHealth(host, port)
+            return server
+
+    def _forget(self, info):
+        key = ServerRegistry.key(info)
+        with self._lock:
+            for address, server in self._servers.items():
+                if server.info and ServerRegistry.key(server.info) == key:
+                    self._servers.pop(address).close()
+
+    def server_event(self, event, info):
+        """
+        Follows ``serverRegistry``; new servers and servers that moved are
+        probed right away.
+        """
+        if event == "remove":
+            self._forget(info)
+            return
+
+        server = self._get(info["server"], info.get("port", 32400), create=False)
+        if server is None:
+            self._forget(info)
+            server = self._get(info["server"], info.get("port", 32400))
+            loop.run_in_worker(self.probe, server)
+        server.info = info
+
+    def probe_all(self):
+        with self._lock:
+            servers = self._servers.values()
+        for server in servers:
+            loop.run_in_worker(self.probe, server)
+
+    def probe(self, server):
+        import requests
+
+        started = monotonic()
+        try:
+            response = server.open().get("%s/identity" % server.url, timeout=PROBE_TIMEOUT)
+            ok = response.status_code == 200
+        except requests.RequestException, e:
+            log.debug("ServerTracker::probe %s failed: %s" % (server.url, e))
+            ok = False
+
+        server.probes   += 1
+        server.last_used = clock.now()
+        server.record(ok, monotonic()-started if ok else None)
+        log.debug("ServerTracker::probe %r" % server)
+
+    def ranked(self):
+        """
+        Returns the tracked servers, best first.
+        """
+        with self._lock:
+            servers = self._servers.values()
+        return sorted(servers, key=lambda s: s.score())
+
+    def preferred(self):
+        servers = self.ranked()
+        if servers:
+            return servers[0]
+
+    def warm(self):
+        """
+        Makes sure the preferred server's connection is still open.  Called
+        when a controller shows up, as that's usually followed by playback.
+        """
+        server = self.preferred()
+        if server and clock.now()-server.last_used > WARM_AFTER:
+            loop.run_in_worker(self.probe, server)
+
+    def request(self, url, timeout=REQUEST_TIMEOUT, method="GET"):
+        """
+        Requests ``url`` over the keep-alive session of the server it points
+        to and returns the ``requests`` response.
+        """
+        import requests
+
+        parts  = urlparse.urlparse(url)
+        server = self._get(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        try:
+            response = server.open().request(method, url, timeout=timeout)
+        except requests.RequestException:
+            server.record(False)
+            raise
+        finally:
+            server.last_used = clock.now()
+
+        server.record(response.status_code < 500)
+        return response
+
+serverRegistry = ServerRegistry()
+serverTracker  = ServerTracker()
+serverRegistry.add_listener(serverTracker.server_event)
+
+SERVER_RTT = registry.gauge("omplex_server_rtt_seconds",
+                            "Smoothed round-trip time of health probes", ("server",))
+SERVER_RTT.set_function(lambda: dict([((s.url,), s.rtt) for s in serverTracker.ranked() if s.rtt is not None]))
+
+SERVER_ERROR_RATE = registry.gauge("omplex_server_error_rate",
+                                   "Smoothed fraction of failed requests", ("server",))
+SERVER_ERROR_RATE.set_function(lambda: dict([((s.url,), s.error_rate) for s in serverTracker.ranked()]))
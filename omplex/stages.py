@@ -0,0 +1,170 @@
+"""
+stages.py - Startup as a dependency graph
+
+Each service is a stage that names the stages it needs.  Stages run on the
+event loop's workers as soon as everything they need is up, so independent
+services start at the same time.  omplex is "ready" once every required
+stage is done; deferred stages, such as server discovery, only start after
+that so they don't compete with getting controllable.
+
+A stage that fails is logged and everything that needs it is skipped, the
+rest of omplex still starts.  Once every stage has finished the startup
+timeline is logged.
+
+Example usage:
+
+    pipeline = StartupPipeline()
+    pipeline.add("settings", load_settings)
+    pipeline.add("http", start_http, requires=("settings",))
+    pipeline.add("login", login, requires=("settings",), required=False, thread=True)
+    pipeline.add("osd", osd.start, defer=True)
+
+    pipeline.run()      # returns once omplex is ready
+"""
+import logging
+import threading
+import time
+
+from clock import monotonic
+from loop import loop
+from startup import profile
+
+log = logging.getLogger("stages")
+
+class Stage(object):
+    def __init__(self, name, start, requires, required, defer, thread):
+        self.name       = name
+        self.start      = start
+        self.requires   = requires
+        self.required   = required and not defer
+        self.defer      = defer
+        self.thread     = thread
+
+        # One of "waiting", "running", "done", "failed" or "skipped"
+        self.state      = "waiting"
+        self.started    = None
+        self.elapsed    = None
+        self.ran_on     = None
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed", "skipped")
+
+class StartupPipeline(object):
+    def __init__(self):
+        self._stages    = []
+        self._by_name   = {}
+        self._lock      = threading.Lock()
+        self._ready     = threading.Event()
+        self._started   = None
+        self._logged    = False
+        self.ready_at   = None
+
+    def add(self, name, start, requires=(), required=True, defer=False, thread=False):
+        """
+        Adds a stage which runs ``start()`` once the stages in ``requires``
+        are done.  Ready doesn't wait for stages that aren't ``required``,
+        ``defer`` holds a stage back until ready and ``thread`` runs it on a
+        thread of its own rather than a worker, for stages that may block
+        for a long time.
+        """
+        for requirement in requires:
+            if requirement not in self._by_name:
+                raise ValueError("Stage '%s' requires unknown stage '%s'" % (name, requirement))
+        stage = Stage(name, start, tuple(requires), required, defer, thread)
+        self._stages.append(stage)
+        self._by_name[name] = stage
+        return stage
+
+    def run(self):
+        """
+        Starts the stages and blocks until omplex is ready.  Returns the
+        number of seconds that took.
+        """
+        self._started = monotonic()
+        self._dispatch()
+
+        # Waiting with a timeout keeps the main thread interruptible
+        while not self._ready.wait(1):
+            pass
+        return self.ready_at
+
+    def _dispatch(self):
+        runnable = []
+        became_ready = False
+        with self._lock:
+            changed = True
+            while changed:
+                changed = False
+                for stage in self._stages:
+                    if stage.state != "waiting":
+                        continue
+                    if stage.defer and not self._ready.is_set():
+                        continue
+
+                    states = [self._by_name[r].state for r in stage.requires]
+                    if "failed" in states or "skipped" in states:
+                        log.warning("StartupPipeline::_dispatch skipping %s" % stage.name)
+                        stage.state = "skipped"
+                        changed     = True
+                    elif all([state == "done" for state in states]):
+                        stage.state = "running"
+                        runnable.append(stage)
+
+                if not self._ready.is_set() and all([s.finished for s in self._stages if s.required]):
+                    self.ready_at = monotonic()-self._started
+                    self._ready.set()
+                    became_ready = True
+                    changed      = True
+
+            log_timeline = not self._logged and all([s.finished for s in self._stages])
+            if log_timeline:
+                self._logged = True
+
+        if became_ready:
+            failed = [s.name for s in self._stages if s.required and s.state != "done"]
+            # profile.started is taken when omplex is first imported
+            log.info("Ready after %.1fms, %.1fms since launch%s" % (self.ready_at*1e3,
+                     (time.time()-profile.started)*1e3, failed and " (without %s)" % ", ".join(failed) or ""))
+
+        for stage in runnable:
+            if stage.thread:
+                thread = threading.Thread(target=self._run_stage, args=(stage,), name="Stage %s" % stage.name)
+                thread.daemon = True
+                thread.start()
+            else:
+                loop.run_in_worker(self._run_stage, stage)
+
+        if log_timeline:
+            for line in self.timeline():
+                log.info(line)
+
+    def _run_stage(self, stage):
+        stage.ran_on  = threading.current_thread().name
+        stage.started = monotonic()
+        try:
+            with profile.measure("start %s" % stage.name):
+                stage.start()
+            state = "done"
+        except Exception, e:
+            log.exception("StartupPipeline::_run_stage %s failed: %s" % (stage.name, e))
+            state = "failed"
+
+        stage.elapsed = monotonic()-stage.started
+        with self._lock:
+            stage.state = state
+        self._dispatch()
+
+    def timeline(self):
+        """
+        Returns the startup timeline as a list of lines.
+        """
+        lines = ["Startup timeline, ready after %.1fms" % ((self.ready_at or 0)*1e3)]
+        lines.append("    %-20s %9s %9s  %-8s %s" % ("stage", "at ms", "took ms", "state", "thread"))
+        for stage in sorted(self._stages, key=lambda s: s.started or float("inf")):
+            if stage.started is None:
+                lines.append("    %-20s %9s %9s  %-8s" % (stage.name, "-", "-", stage.state))
+                continue
+            lines.append("    %-20s %9.1f %9.1f  %-8s %s" % (stage.name, (stage.started-self._started)*1e3,
+                                                          stage.elapsed*1e3, stage.state, stage.ran_on))
+        return lines
@@ -0,0 +1,120 @@
+"""
+startup.py - Startup profiling
+
+Run omplex with ``OMPLEX_PROFILE_STARTUP=1`` in the environment to record
+how long every module takes to import and every service takes to create
+and start.  The report is logged once omplex is up:
+
+    OMPLEX_PROFILE_STARTUP=1 omplex
+
+Example usage:
+
+    from startup import profile
+
+    with profile.measure("start http"):
+        server.start()
+"""
+import __builtin__
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Number of modules listed in the report
+REPORT_MODULES = 25
+
+class StartupProfile(object):
+    def __init__(self):
+        self.started    = time.time()
+        self.enabled    = False
+        self.imports    = []
+        self.steps      = []
+        self._stack     = []
+        self._import    = None
+        self._thread    = None
+
+    def install(self):
+        """
+        Starts timing imports made by the current thread.
+        """
+        if self.enabled:
+            return
+        self.enabled    = True
+        self._thread    = threading.current_thread()
+        self._import    = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._import is not None:
+            __builtin__.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, *args, **kwargs):
+        if threading.current_thread() is not self._thread:
+            return self._import(name, *args, **kwargs)
+
+        before  = len(sys.modules)
+        started = time.time()
+        self._stack.append(0.0)
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed  = time.time()-started
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if len(sys.modules) > before:
+                globals = args[0] if args else kwargs.get("globals")
+                self.imports.append((self._resolve(name, globals), elapsed-children, elapsed))
+
+    def _resolve(self, name, globals):
+        # Implicit relative imports ("from conf import settings") load the
+        # module under the importer's package
+        globals = globals or {}
+        package = globals.get("__package__")
+        if not package and "__name__" in globals:
+            package = globals["__name__"] if "__path__" in globals else globals["__name__"].rpartition(".")[0]
+        # A failed relative lookup leaves None in sys.modules
+        if package and sys.modules.get("%s.%s" % (package, name)) is not None:
+            return "%s.%s" % (package, name)
+        return name
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Records how long the body takes under ``name`` when profiling.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.steps.append((name, started-self.started, time.time()-started))
+
+    def report(self):
+        """
+        Returns the report as a list of lines.
+        """
+        lines = ["Startup profile, %.1fms since the first import" % ((time.time()-self.started)*1e3)]
+
+        total = sum([own for name, own, cumulative in self.imports])
+        lines.append("  imports: %d modules, %.1fms" % (len(self.imports), total*1e3))
+        lines.append("    %-32s %9s %9s" % ("module", "self ms", "cum ms"))
+        for name, own, cumulative in sorted(self.imports, key=lambda i: -i[1])[:REPORT_MODULES]:
+            lines.append("    %-32s %9.1f %9.1f" % (name, own*1e3, cumulative*1e3))
+
+        lines.append("  init and start:")
+        lines.append("    %-32s %9s %9s" % ("step", "at ms", "took ms"))
+        for name, at, elapsed in self.steps:
+            lines.append("    %-32s %9.1f %9.1f" % (name, at*1e3, elapsed*1e3))
+        return lines
+
+profile = StartupProfile()
+
+if os.environ.get("OMPLEX_PROFILE_STARTUP"):
+    profile.install()
@@ -6,7 +6,9 @@ Modeled after Plex Home Theater Remote implementation:
 """
 import logging
 
-from utils import Timer
+from clock import Timer
+from loop import loop
+from metrics import registry
 
 # give clients 90 seconds before we time them out
 SUBSCRIBER_REMOVE_INTERVAL = 90
@@ -23,8 +25,22 @@ class RemoteSubscriberManager(object):
         else:
             log.debug("RemoteSubscriberManager::addSubscriber added %s [%s]" % (subscriber.url, subscriber.uuid))
             self.subscribers[subscriber.uuid] = subscriber
-
-        # timer.SetTimeout(PLEX_REMOTE_SUBSCRIBER_CHECK_INTERVAL * 1000, this);
+            loop.call_later(SUBSCRIBER_REMOVE_INTERVAL, self.checkSubscriber, subscriber.uuid)
+
+    def checkSubscriber(self, uuid):
+        """
+        Removes the subscriber if it hasn't been heard from in a while,
+        otherwise checks again once it could have expired.
+        """
+        subscriber = self.subscribers.get(uuid)
+        if subscriber is None:
+            return
+
+        if subscriber.shouldRemove():
+            self.removeSubscriber(subscriber)
+        else:
+            remaining = SUBSCRIBER_REMOVE_INTERVAL - subscriber.lastUpdated.elapsed()
+            loop.call_later(max(remaining, 0) + 1, self.checkSubscriber, uuid)
 
     def updateSubscriberCommandID(self, subscriber):
         if self.subscribers.has_key(subscriber.uuid):
@@ -60,7 +76,8 @@ class RemoteSubscriber(object):
     def refresh(self, sub):
         log.debug("RemoteSubscriber::refresh %s (cid=%s)" % (self.uuid, sub.commandID))
 
-        if sub.url != self.url:
+        # Pollers don't send an address, so keep the one we already have
+        if sub.url and sub.url != self.url:
             log.debug("RemoteSubscriber::refresh new url %s", sub.url)
             self.url = sub.url
 
@@ -72,10 +89,13 @@ class RemoteSubscriber(object):
 
     def shouldRemove(self):
         if self.lastUpdated.elapsed() > SUBSCRIBER_REMOVE_INTERVAL:
-            log.debug("RemoteSubscriber::shouldRemove removing %s because elapsed: %lld" % (self.uuid, self.lastUpdated.elapsed()))
+            log.debug("RemoteSubscriber::shouldRemove removing %s because elapsed: %d" % (self.uuid, self.lastUpdated.elapsed()))
             return True
 
-        log.debug("RemoteSubscriber::shouldRemove will not remove %s because elapsed: %lld" % (self.uuid, self.lastUpdated.elapsed()))
+        log.debug("RemoteSubscriber::shouldRemove will not remove %s because elapsed: %d" % (self.uuid, self.lastUpdated.elapsed()))
         return False
 
-remoteSubscriberManager = RemoteSubscriberManager()
\ No newline at end of file
+remoteSubscriberManager = RemoteSubscriberManager()
+
+SUBSCRIBERS = registry.gauge("omplex_subscribers", "Number of remote timeline subscribers")
+SUBSCRIBERS.set_function(lambda: len(remoteSubscriberManager.subscribers))
\ No newline at end of file
@@ -1,27 +1,36 @@
 import logging
-import requests
-import threading
-import time
 
 try:
     from xml.etree import cElementTree as et
 except:
     from xml.etree import ElementTree as et
 
-try:
-    from cStringIO import cStringIO
-except:
-    from StringIO import StringIO
-
+from clock import Timer, monotonic
 from conf import settings
 from display import display
+from lazy import Lazy
+from loop import loop
+from metrics import registry
 from player import playerManager
+from responses import serialize
 from subscribers import remoteSubscriberManager
-from utils import Timer
+
+# Seconds to wait on a subscriber before giving up on a push
+PUSH_TIMEOUT = 3
 
 log = logging.getLogger("timeline")
 
-class TimelineManager(threading.Thread):
+TIMELINE_PUSH_SECONDS = registry.histogram("omplex_timeline_push_seconds",
+                                           "Time taken to push a timeline to a subscriber")
+TIMELINE_PUSH_FAILURES = registry.counter("omplex_timeline_push_failures_total",
+                                          "Timeline pushes that failed")
+
+class TimelineManager(object):
+    """
+    Pushes timelines to subscribers and updates the player once a second
+    while something is playing.  Nothing is scheduled while idle apart from
+    the display sleep timer.
+    """
     def __init__(self):
         self.currentItems   = {}
         self.currentStates  = {}
@@ -31,26 +40,75 @@ class TimelineManager(threading.Thread):
         self.stopped        = False
         self.halt           = False
 
-        threading.Thread.__init__(self)
+        self._tick_handle   = None
+        self._sleep_handle  = None
+        self._updating      = False
+
+    def start(self):
+        self.halt = False
+        playerManager.add_listener(self.playback_changed)
+        settings.add_listener(self.settings_changed)
+        loop.call_soon(self.playback_changed)
 
     def stop(self):
         self.halt = True
-        self.join()
-
-    def run(self):
-        while not self.halt:
-            if playerManager._player and playerManager._video:
-                if not playerManager.is_paused():
+        self._cancel_tick()
+        self._cancel_sleep()
+
+    def _cancel_tick(self):
+        if self._tick_handle:
+            self._tick_handle.cancel()
+            self._tick_handle = None
+
+    def _cancel_sleep(self):
+        if self._sleep_handle:
+            self._sleep_handle.cancel()
+            self._sleep_handle = None
+
+    def playback_changed(self):
+        if self.halt:
+            return
+
+        if playerManager.state.state != "stopped":
+            self._cancel_sleep()
+            if not self._tick_handle:
+                self._tick_handle = loop.call_every(1, self.tick)
+                self.tick()
+        else:
+            self._cancel_tick()
+            self.idleTimer.restart()
+            if settings.display_sleep > 0 and not self._sleep_handle:
+                self._sleep_handle = loop.call_later(settings.display_sleep, self.display_sleep)
+
+    def settings_changed(self, changes):
+        if "display_sleep" in changes:
+            self._cancel_sleep()
+            self.playback_changed()
+
+    def tick(self):
+        # Pushing timelines blocks on the network, so do it on a worker and
+        # skip this tick if the last one is still going
+        if self._updating:
+            return
+        self._updating = True
+        loop.run_in_worker(self.update)
+
+    def update(self):
+        try:
+            state = playerManager.state
+            if state.state != "stopped":
+                if state.state != "paused":
                     self.SendTimelineToSubscribers()
                 playerManager.update()
                 self.idleTimer.restart()
-            else:
-                if settings.display_sleep > 0 and self.idleTimer.elapsed() >= settings.display_sleep:
-                    if display.is_on:
-                        log.debug("TimelineManager::run putting display to sleep")
-                        display.power_off()
+        finally:
+            self._updating = False
 
-            time.sleep(1)
+    def display_sleep(self):
+        self._sleep_handle = None
+        if display.is_on:
+            log.debug("TimelineManager::display_sleep putting display to sleep")
+            loop.run_in_worker(display.power_off)
 
     def SendTimelineToSubscribers(self):
         log.debug("TimelineManager::SendTimelineToSubscribers updating all subscribers")
@@ -63,20 +121,24 @@ class TimelineManager(threading.Thread):
 
         log.debug("TimelineManager::SendTimelineToSubscriber sending timeline to %s" % url)
 
-        tree = et.ElementTree(timelineXML)
-        tmp  = StringIO()
-        tree.write(tmp, encoding="utf-8", xml_declaration=True)
+        xmlData = serialize(timelineXML)
 
-        tmp.seek(0)
-        xmlData = tmp.read()
+        import requests
 
         # TODO: Abstract this into a utility function and add other X-Plex-XXX fields
-        requests.post(url, data=xmlData, headers={
-            "Content-Type":             "application/x-www-form-urlencoded",
-            "Connection":               "keep-alive",
-            "Content-Range":            "bytes 0-/-1",
-            "X-Plex-Client-Identifier": settings.client_uuid
-        })
+        started = monotonic()
+        try:
+            requests.post(url, data=xmlData, headers={
+                "Content-Type":             "application/x-www-form-urlencoded",
+                "Connection":               "keep-alive",
+                "Content-Range":            "bytes 0-/-1",
+                "X-Plex-Client-Identifier": settings.client_uuid
+            }, timeout=PUSH_TIMEOUT)
+        except Exception, e:
+            log.error("TimelineManager::SendTimelineToSubscriber error sending timeline to %s: %s" % (url, e))
+            TIMELINE_PUSH_FAILURES.inc()
+        finally:
+            TIMELINE_PUSH_SECONDS.observe(monotonic()-started)
 
     def WaitForTimeline(self, subscriber):
         log.info("TimelineManager::WaitForTimeline not implemented...")
@@ -101,28 +163,28 @@ class TimelineManager(threading.Thread):
 
     def GetCurrentTimeline(self):
         # https://github.com/plexinc/plex-home-theater-public/blob/pht-frodo/plex/Client/PlexTimelineManager.cpp#L142
+        # Read from the published state, never the player, so a timeline
+        # doesn't wait on a play or seek that's holding the player's lock
+        state = playerManager.state
         options = {
             "location": "navigation",
-            "state":    playerManager.get_state(),
+            "state":    state.state,
             "type":     "video"
         }
         controllable = []
 
-        video  = playerManager._video
-        player = playerManager._player
-
-        if video and player:
-            media = playerManager._video.parent
+        if state.state != "stopped":
+            media = state.media
 
             options["location"]          = "fullScreenVideo"
 
-            options["time"]              = player.position * 1e3
+            options["time"]              = state.position_at() * 1e3
             
-            options["ratingKey"]         = video.get_video_attr("ratingKey")
-            options["key"]               = video.get_video_attr("key")
-            options["containerKey"]      = video.get_video_attr("key")
-            options["guid"]              = video.get_video_attr("guid")
-            options["duration"]          = video.get_video_attr("duration", "0")
+            options["ratingKey"]         = state.rating_key
+            options["key"]               = state.key
+            options["containerKey"]      = state.key
+            options["guid"]              = state.guid
+            options["duration"]          = state.duration
             options["address"]           = media.path.hostname
             options["protocol"]          = media.path.scheme
             options["port"]              = media.path.port
@@ -148,7 +210,7 @@ class TimelineManager(threading.Thread):
             # the volume even if the output is hdmi...
             if settings.audio_output != "hdmi":
                 controllable.append("volume")
-                options["volume"] = str(playerManager.get_volume(percent=True)*100 or 0)
+                options["volume"] = str((state.volume or 0)*100)
 
             options["controllable"] = ",".join(controllable)
         else:
@@ -157,4 +219,4 @@ class TimelineManager(threading.Thread):
         return options
 
 
-timelineManager = TimelineManager()
+timelineManager = Lazy(TimelineManager)
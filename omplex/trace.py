@@ -0,0 +1,211 @@
+"""
+trace.py - Playback session tracing
+
+Every ``playMedia`` starts a trace that follows the request from the
+metadata fetch through transcode negotiation, display power-on and the
+omxplayer launch up to the first status line, across whichever threads the
+work runs on.  The last few traces are kept in memory and served from the
+``/debug/trace`` HTTP route in the Chrome trace format, ready to be loaded
+into ``chrome://tracing`` or Perfetto, so a slow start can be picked apart
+after the fact.
+
+Spans are recorded against the trace active on the calling thread, and are
+free when there is none.  Work handed to another thread takes the trace
+with it:
+
+    with tracer.session("playMedia", key=key):
+        with tracer.span("fetch metadata"):
+            ...
+        trace = tracer.current()
+
+    # on another thread
+    with tracer.activate(trace), tracer.span("power on"):
+        ...
+    trace.finish("first status line")
+"""
+import collections
+import itertools
+import json
+import os
+import threading
+
+from contextlib import contextmanager
+from functools import wraps
+
+from clock import monotonic
+
+# Number of traces kept
+TRACE_SESSIONS  = 20
+
+# Events kept per trace, so one that never finishes can't grow forever
+MAX_EVENTS      = 256
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Trace(object):
+    def __init__(self, id, name, args):
+        self.id         = id
+        self.name       = name
+        self.args       = args
+        self.started    = monotonic()
+        self.finished   = None
+        self.events     = []
+        self._lock      = threading.Lock()
+
+    def __repr__(self):
+        return "<Trace %d: %s %s>" % (self.id, self.name, self.args)
+
+    def _add(self, name, started, duration, args):
+        thread = threading.current_thread()
+        with self._lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append((name, started, duration, thread.ident, thread.name, args))
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Records how long the body takes.
+        """
+        started = monotonic()
+        try:
+            yield self
+        finally:
+            self._add(name, started, monotonic()-started, args)
+
+    def mark(self, name, **args):
+        """
+        Records a point in time.
+        """
+        self._add(name, monotonic(), None, args)
+
+    def finish(self, name=None, **args):
+        """
+        Marks the trace as complete, with an optional closing mark.  Only the
+        first call counts.
+        """
+        with self._lock:
+            if self.finished is not None:
+                return
+            self.finished = monotonic()
+        if name:
+            self.mark(name, **args)
+
+    @property
+    def duration(self):
+        if self.finished is None:
+            return None
+        return self.finished-self.started
+
+    def chrome_events(self):
+        """
+        Returns the trace as Chrome trace events, with the trace as the
+        "process" and each thread that worked on it as a "thread".
+        """
+        title  = " ".join([self.name] + ["%s=%s" % item for item in sorted(self.args.items())])
+        events = [{"name": "process_name", "ph": "M", "pid": self.id, "args": {"name": "#%d %s" % (self.id, title)}}]
+
+        with self._lock:
+            recorded = list(self.events)
+
+        threads = {}
+        for name, started, duration, tid, thread, args in recorded:
+            threads[tid] = thread
+            event = {"name": name, "cat": self.name, "pid": self.id, "tid": tid,
+                     "ts": started*1e6, "args": args}
+            if duration is None:
+                event.update(ph="i", s="t")
+            else:
+                event.update(ph="X", dur=duration*1e6)
+            events.append(event)
+
+        for tid, thread in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": self.id, "tid": tid, "args": {"name": thread}})
+        return events
+
+class Tracer(object):
+    def __init__(self, size=TRACE_SESSIONS):
+        self._traces    = collections.deque(maxlen=size)
+        self._ids       = itertools.count(1)
+        self._local     = threading.local()
+
+    def start(self, name, **args):
+        """
+        Starts a new trace and keeps it, dropping the oldest one if the
+        buffer is full.
+        """
+        trace = Trace(next(self._ids), name, args)
+        self._traces.append(trace)
+        return trace
+
+    def current(self):
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def activate(self, trace):
+        """
+        Makes ``trace`` the calling thread's trace for the body.
+        """
+        previous = self.current()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    @contextmanager
+    def session(self, name, **args):
+        """
+        Starts a trace, activates it and records the body as its first span.
+        """
+        trace = self.start(name, **args)
+        with self.activate(trace):
+            with trace.span(name):
+                yield trace
+
+    def span(self, name, **args):
+        """
+        Records the body as a span of the calling thread's trace, if any.
+        """
+        trace = self.current()
+        if trace is None:
+            return _NULL_SPAN
+        return trace.span(name, **args)
+
+    def mark(self, name, **args):
+        trace = self.current()
+        if trace is not None:
+            trace.mark(name, **args)
+
+    def traces(self):
+        return list(self._traces)
+
+    def export(self):
+        """
+        Returns the kept traces as Chrome trace JSON.
+        """
+        events = []
+        for trace in self.traces():
+            events.extend(trace.chrome_events())
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms",
+                           "otherData": {"pid": os.getpid()}})
+
+def traced(name):
+    """
+    Decorator recording every call as a span of the caller's trace.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+tracer = Tracer()
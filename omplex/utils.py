@@ -4,23 +4,15 @@ import urllib
 
 from __init__ import __version__
 from conf import settings
-from datetime import datetime
 from functools import wraps
+from metrics import registry
+from servers import serverTracker
+from trace import tracer
 
 log = logging.getLogger("utils")
 
-class Timer(object):
-    def __init__(self):
-        self.restart()
-
-    def restart(self):
-        self.started = datetime.now()
-
-    def elapsedMs(self):
-        return  self.elapsed() * 1e3
-
-    def elapsed(self):
-        return (datetime.now()-self.started).total_seconds()
+PLEX_REQUEST_SECONDS = registry.histogram("omplex_plex_request_seconds",
+                                          "Latency of requests made to Plex Media Servers", ("endpoint",))
 
 def synchronous(tlockname):
     """
@@ -71,7 +63,17 @@ def get_plex_url(url, data={}):
 
     return url
 
-def safe_urlopen(url, data={}):
+def plex_urlopen(url, endpoint="other", method="GET"):
+    """
+    Opens a url on a Plex server, recording the request latency under
+    ``endpoint`` in the ``omplex_plex_request_seconds`` histogram.  The
+    request reuses the server's keep-alive connection and a ``requests``
+    response is returned.
+    """
+    with PLEX_REQUEST_SECONDS.time(endpoint=endpoint), tracer.span("plex %s" % endpoint):
+        return serverTracker.request(url, method=method)
+
+def safe_urlopen(url, data={}, endpoint="other", method="GET"):
     """
     Opens a url and returns True if an HTTP 200 code is returned,
     otherwise returns False.
@@ -79,11 +81,11 @@ def safe_urlopen(url, data={}):
     url = get_plex_url(url, data)
 
     try:
-        page = urllib.urlopen(url)
-        if page.code == 200:
+        page = plex_urlopen(url, endpoint, method)
+        if page.status_code == 200:
             return True
         log.error("Error opening URL '%s': page returned %d" % (url,
-                                                                page.code))
+                                                                page.status_code))
     except Exception, e:
         log.error("Error opening URL '%s':  %s" % (url, e))
 
@@ -0,0 +1,149 @@
+"""
+watchdog.py - Notices playback that has stopped moving
+
+``PlayerManager`` hands the watchdog the player's position about once a
+second.  Playback that hasn't moved for ``STALL_GRACE`` seconds while not
+paused has stalled, and what the backend reports tells why:
+
+    hung        no status line for ``HANG_SECONDS``, the player is stuck
+    buffering   its buffers ran dry, it's waiting on the network
+    decoder     it's still reporting and has data, but doesn't play it
+
+Backends that report neither status lines nor buffer levels are taken to be
+buffering.  Until playback first moves it's starting up, whatever the
+backend reports.  That shows as buffering but isn't counted as a stall, and
+callers give it a longer timeout than a stall.
+
+Example usage:
+
+    watchdog = Watchdog()
+    state    = watchdog.check(player, player.query_position())
+    if watchdog.reason == "starting":
+        timeout = settings.start_timeout
+    if watchdog.stalled_for() > timeout:
+        ...     # Restart the player at watchdog.last_good
+"""
+import logging
+
+from clock import clock
+from metrics import registry
+
+# Seconds the position may stand still before playback has stalled
+STALL_GRACE     = 2
+
+# Seconds without a status line before a player is taken to be hung
+HANG_SECONDS    = 5
+
+# Seconds of buffered media below which a player is waiting for data
+LOW_BUFFER      = 0.1
+
+# Stalls are remembered for this many seconds
+STALL_WINDOW    = 60
+
+log = logging.getLogger("watchdog")
+
+PLAYBACK_STALLS         = registry.counter("omplex_playback_stalls_total",
+                                           "Times playback stopped moving while not paused", ("reason",))
+PLAYBACK_STALL_SECONDS  = registry.histogram("omplex_playback_stall_seconds",
+                                             "How long playback stayed stalled", ("reason",))
+
+class Watchdog(object):
+    """
+    Tracks the progress of one video.  ``state`` is one of "playing",
+    "paused", "buffering", "stalled" or "finished", ``stalls`` holds when
+    the stalls of the last ``STALL_WINDOW`` seconds started.
+    """
+    def __init__(self):
+        self.stalls = []
+        self.reason = None
+        self.reset()
+
+    def reset(self, position=None):
+        """
+        Starts over at ``position``, as when the player is (re)started.  An
+        ongoing stall ends, the recent stalls are kept.
+        """
+        self.end_stall()
+        self.state          = "playing"
+        self.reason         = None
+        self.last_good      = position
+        self._position      = None
+        self._moved         = False
+        self._still_since   = None
+
+    def check(self, player, position):
+        """
+        Updates the state from ``player`` now being at ``position``, and
+        returns it.
+        """
+        now = clock.now()
+        if player.finished:
+            # The video ended, standing still at the end isn't a stall
+            self.end_stall()
+            self._still_since = None
+            self.state        = "finished"
+            return self.state
+
+        if player.paused or position != self._position:
+            # The first position seen after a reset isn't a move
+            moved             = self._position is not None
+            self.end_stall()
+            self._position    = position
+            self._still_since = None
+            if player.paused:
+                self.state = "paused"
+            else:
+                self.state      = "playing"
+                self.last_good  = position
+                self._moved     = self._moved or moved
+            return self.state
+
+        if self._still_since is None:
+            self._still_since = now
+        if now-self._still_since < STALL_GRACE:
+            return self.state
+
+        reason = self._diagnose(player, now)
+        if self.reason is None and self._moved:
+            log.warning("Watchdog::check playback stalled at %ss, %s" % (position, reason))
+            PLAYBACK_STALLS.inc(reason=reason)
+            self.stalls = [t for t in self.stalls if now-t < STALL_WINDOW] + [now]
+        self.reason = reason
+        self.state  = "buffering" if reason in ("buffering", "starting") else "stalled"
+        return self.state
+
+    def _diagnose(self, player, now):
+        if not self._moved:
+            return "starting"
+        if player.last_status is not None and now-player.last_status >= HANG_SECONDS:
+            return "hung"
+        if player.buffered is None or player.buffered < LOW_BUFFER:
+            return "buffering"
+        return "decoder"
+
+    def stalled_for(self):
+        """
+        Returns the seconds playback has been stalled, or starting up
+        without moving, 0 if it's neither.
+        """
+        if self.reason is None:
+            return 0
+        return clock.now()-self._still_since
+
+    def recent_stalls(self):
+        """
+        Returns how many times playback stalled in the last ``STALL_WINDOW``
+        seconds.
+        """
+        now = clock.now()
+        return len([t for t in self.stalls if now-t < STALL_WINDOW])
+
+    def end_stall(self):
+        """
+        Records how long the current stall, if any, lasted.
+        """
+        if self.reason is None:
+            return
+        if self._moved:
+            PLAYBACK_STALL_SECONDS.observe(clock.now()-self._still_since, reason=self.reason)
+        self.reason = None
@@ -15,11 +15,14 @@
 
         import ctypes
         libosd = ctypes.cdll.LoadLibrary("./libosd.so")
-        libosd.show_osd(23,100, "Test Title (2014)")
+        libosd.set_osd_image("poster.jpg")
+        libosd.show_osd(23,100, "Test Title (2014)", 1)
+        libosd.update_osd(24, 1)
         libosd.hide_osd()
 
     Author: Weston Nielson <wnielson@github>
 */
+#include <setjmp.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -27,6 +30,7 @@
 #include <time.h>
 #include <VG/openvg.h>
 #include <VG/vgu.h>
+#include <jpeglib.h>
 
 #include "fontinfo.h"
 #include "shapes.h"
@@ -45,16 +49,64 @@ typedef struct
     char  pos_end[10];
     
     char* title;
+    int   title_x;
+    int   title_width;
     
     int   duration;
     int   played;
+    int   progress;
+    int   paused;
 
     int   width;
     int   height;
 } OSD;
 
+// Regions redrawn by ``update_osd``: the progress bar with the position
+// text below the header, and the clocks at either end of the header.
+#define PROGRESS_Y      94
+#define PROGRESS_HEIGHT 26
+#define CLOCK_Y         156
+#define CLOCK_HEIGHT    24
+#define CLOCK_WIDTH     220
+
+// The "PAUSED" label above the header, only drawn while paused
+#define LABEL_X         22
+#define LABEL_Y         214
+#define LABEL_WIDTH     160
+#define LABEL_HEIGHT    30
+
 static OSD* MAIN_OSD = NULL;
 
+// The poster is drawn above the OSD's top left corner.  Omplex fetches
+// posters at this size, larger ones are scaled down while decoding.
+#define ART_X           22
+#define ART_Y           248
+#define ART_WIDTH       120
+#define ART_HEIGHT      180
+
+// Decoded posters are kept, so showing the OSD again for the same video
+// doesn't read or decode its poster again
+#define POSTER_CACHE_SIZE 4
+
+typedef struct
+{
+    char*          path;
+    int            width;
+    int            height;
+    unsigned char* data;
+    unsigned long  used;
+} Poster;
+
+static Poster        POSTERS[POSTER_CACHE_SIZE];
+static Poster*       CURRENT_POSTER = NULL;
+static unsigned long POSTER_CLOCK   = 0;
+
+typedef struct
+{
+    struct jpeg_error_mgr mgr;
+    jmp_buf               jump;
+} PosterError;
+
 void get_time(char* output, int seconds)
 {
     time_t     rawtime;
@@ -105,6 +157,133 @@ void seconds_to_str(char* output, int total_seconds)
     }
 };
 
+static void poster_error_exit(j_common_ptr jdc)
+{
+    // libjpeg's default exits the process, give up on the poster instead
+    longjmp(((PosterError*)jdc->err)->jump, 1);
+}
+
+/*
+    Decodes the JPEG at ``path`` into ``poster`` as bottom-up RGBA rows, the
+    way ``makeimage`` wants them.  Returns 0 if it couldn't be read.
+*/
+static int decode_poster(const char* path, Poster* poster)
+{
+    struct jpeg_decompress_struct jdc;
+    PosterError                   jerr;
+    JSAMPARRAY                    buffer;
+    unsigned char* volatile       data = NULL;
+    unsigned char                 *brow, *drow;
+    int                           x, width, height;
+    FILE*                         infile;
+
+    infile = fopen(path, "rb");
+    if (infile == NULL)
+    {
+        return 0;
+    }
+
+    jdc.err = jpeg_std_error(&jerr.mgr);
+    jerr.mgr.error_exit = poster_error_exit;
+    if (setjmp(jerr.jump))
+    {
+        jpeg_destroy_decompress(&jdc);
+        fclose(infile);
+        free(data);
+        return 0;
+    }
+
+    jpeg_create_decompress(&jdc);
+    jpeg_stdio_src(&jdc, infile);
+    jpeg_read_header(&jdc, TRUE);
+
+    // Never decode a big image at full size, libjpeg can scale by up to 1/8
+    // for next to nothing while decoding
+    jdc.scale_num   = 1;
+    jdc.scale_denom = 1;
+    while (jdc.scale_denom < 8 && (jdc.image_width/jdc.scale_denom > ART_WIDTH ||
+                                   jdc.image_height/jdc.scale_denom > ART_HEIGHT))
+    {
+        jdc.scale_denom *= 2;
+    }
+    jdc.out_color_space = JCS_RGB;
+
+    jpeg_start_decompress(&jdc);
+    width  = jdc.output_width;
+    height = jdc.output_height;
+    buffer = (*jdc.mem->alloc_sarray)((j_common_ptr)&jdc, JPOOL_IMAGE, width*3, 1);
+    data   = (unsigned char*)malloc(width*height*4);
+
+    while (jdc.output_scanline < jdc.output_height)
+    {
+        jpeg_read_scanlines(&jdc, buffer, 1);
+        drow = data + (height-jdc.output_scanline)*width*4;
+        brow = buffer[0];
+        for (x = 0; x < width; x++, drow += 4, brow += 3)
+        {
+            drow[0] = brow[0];
+            drow[1] = brow[1];
+            drow[2] = brow[2];
+            drow[3] = 255;
+        }
+    }
+
+    jpeg_finish_decompress(&jdc);
+    jpeg_destroy_decompress(&jdc);
+    fclose(infile);
+
+    poster->data   = data;
+    poster->width  = width;
+    poster->height = height;
+    return 1;
+}
+
+/*
+    Sets the poster drawn by the next ``show_osd``, a JPEG file that should
+    be ``ART_WIDTH`` by ``ART_HEIGHT`` at most.  NULL shows none.  Returns 0
+    if the poster couldn't be read, the OSD is then shown without one.
+*/
+int set_osd_image(const char* path)
+{
+    int     i;
+    Poster* slot = &POSTERS[0];
+
+    CURRENT_POSTER = NULL;
+    if (path == NULL)
+    {
+        return 1;
+    }
+
+    for (i = 0; i < POSTER_CACHE_SIZE; i++)
+    {
+        if (POSTERS[i].path != NULL && strcmp(POSTERS[i].path, path) == 0)
+        {
+            POSTERS[i].used = ++POSTER_CLOCK;
+            CURRENT_POSTER  = &POSTERS[i];
+            return 1;
+        }
+
+        // Empty slots were never used, so they go first
+        if (POSTERS[i].used < slot->used)
+        {
+            slot = &POSTERS[i];
+        }
+    }
+
+    free(slot->path);
+    free(slot->data);
+    memset(slot, 0, sizeof(Poster));
+    if (!decode_poster(path, slot))
+    {
+        return 0;
+    }
+
+    slot->path     = strdup(path);
+    slot->used     = ++POSTER_CLOCK;
+    CURRENT_POSTER = slot;
+    return 1;
+}
+
 void init_osd()
 {
     if (MAIN_OSD != NULL)
@@ -112,7 +291,7 @@ void init_osd()
         return;
     }
 
-    MAIN_OSD = (OSD*)malloc(sizeof(OSD));
+    MAIN_OSD = (OSD*)calloc(1, sizeof(OSD));
 
     init(&MAIN_OSD->width, &MAIN_OSD->height);
 
@@ -146,38 +325,14 @@ void destroy_osd()
     unloadfont(OpenSansSemiBold.Glyphs, OpenSansSemiBold.Count);
 
     finish();
+    free(MAIN_OSD->title);
     free(MAIN_OSD);
 
     MAIN_OSD = NULL;
 };
 
-void show_osd(int played, int duration, char* title)
+static void draw_background(OSD* osd)
 {
-    if (MAIN_OSD == NULL)
-    {
-        // Calling ``init_osd`` everytime seems wasteful, but it is needed to
-        // ensure that the OSD is visible.  The main issue is that if the player
-        // is stopped and then restarted, the graphics library needs to be
-        // reinitalized, otherwise the OSD is not drawn ontop of the video.
-        init_osd();
-    }
-
-    OSD* osd = MAIN_OSD;
-
-    if (played > duration)
-    {
-        played = duration;
-    }
-
-    osd->duration   = duration;
-    osd->played     = played;
-    osd->title      = title;
-
-    Start(osd->width, osd->height);
-
-    Fill(255,255,255,1);
-    Text(32, 120+82+20, "PAUSED", OpenSansBold, 16);
-
     // Main OSD background
     Fill(0, 0, 0, 0.5);
     Roundrect(22, 82, osd->width-44, 120, 15, 15);
@@ -188,59 +343,187 @@ void show_osd(int played, int duration, char* title)
     Fill(0, 0, 0, 1);
     Roundrect(22, 120+82-20, osd->width-44, 20, 15, 15);  // Top of the header
     Rect(22, 120+82-(54+10), osd->width-44, 54);          // Bottom of header
+}
+
+static void draw_label(OSD* osd)
+{
+    if (osd->paused)
+    {
+        Fill(255,255,255,1);
+        Text(32, 120+82+20, "PAUSED", OpenSansBold, 16);
+    }
+}
+
+static void draw_title(OSD* osd)
+{
+    Fill(255, 255, 255, 1);
+    Text(osd->title_x, 162, osd->title, OpenSansSemiBold, 20);
+}
 
+static void draw_clock(OSD* osd)
+{
     // Current time
-    get_time(osd->time_now, 0);
     Fill(102, 102, 102, 1);
     Text(46, 162, osd->time_now, OpenSansSemiBold, 14);
 
     // End time
-    if (duration > 0)
+    if (osd->duration > 0)
     {
-        get_time(osd->time_end, osd->duration-osd->played);
         TextEnd(osd->width-46, 162, osd->time_end, OpenSansSemiBold, 14);
     }
+}
 
-    // Title text
-    Fill(255, 255, 255, 1);
-    int title_width = TextWidth(osd->title, OpenSansSemiBold, 20);
-    Text((osd->width/2)-(title_width/2), 162, osd->title, OpenSansSemiBold, 20);
+static void draw_progress(OSD* osd)
+{
+    if (osd->duration <= 0)
+    {
+        return;
+    }
+
+    int pbar_width = osd->width-288;
+    Fill(255, 255, 255, 0.2);                               // Transparent bg
+    Roundrect(142, 102, pbar_width, 12, 10, 10);            // Centered
+
+    Fill(209, 125, 30, 1);                                  // Orange bar (progress)
+    Roundrect(142, 102, osd->progress, 12, 10, 10);         // Left justified
 
+    // Text shadow
+    Fill(0, 0, 0, 1);
+    Text(46-1, 102-1, osd->pos_now, OpenSansSemiBold, 12);
+    TextEnd(osd->width-46-1, 102-1, osd->pos_end, OpenSansSemiBold, 12);
+
+    // Actual text
+    Fill(255,255,255,1);
+    Text(46, 102, osd->pos_now, OpenSansSemiBold, 12);
+    TextEnd(osd->width-46, 102, osd->pos_end, OpenSansSemiBold, 12);
+}
 
-    ///////////////////////////////////////////////////////////////////////////
+/*
+    Works out the text and progress bar width for ``played``.  Returns 1 if
+    any of it differs from what's on screen.
+*/
+static int set_played(OSD* osd, int played)
+{
+    char time_now[10], time_end[10], pos_now[10], pos_end[10];
+    int  progress = 0;
 
-    ///////////////////////////////////////////////////////////////////////////
-    // Progress Bar
-    ///////////////////////////////////////////////////////////////////////////
-    if (duration > 0)
+    if (played > osd->duration)
     {
-        int   pbar_width = osd->width-288;
-        float pct_player = (float)played/duration;
-        Fill(255, 255, 255, 0.2);                               // Transparent bg
-        Roundrect(142, 102, pbar_width, 12, 10, 10);            // Centered
+        played = osd->duration;
+    }
 
-        Fill(209, 125, 30, 1);                                  // Orange bar (progress)
-        Roundrect(142, 102, pbar_width*pct_player, 12, 10, 10); // Left justified
+    get_time(time_now, 0);
+    time_end[0] = pos_now[0] = pos_end[0] = '\0';
+    if (osd->duration > 0)
+    {
+        get_time(time_end, osd->duration-played);
+        seconds_to_str(pos_now, played);
+        seconds_to_str(pos_end, osd->duration-played);
+        progress = (int)((osd->width-288)*((float)played/osd->duration));
+    }
 
-        // Progress text
-        seconds_to_str(osd->pos_now, osd->played);
-        seconds_to_str(osd->pos_end, osd->duration-osd->played);
+    int changed = strcmp(time_now, osd->time_now) || strcmp(time_end, osd->time_end) ||
+                  strcmp(pos_now, osd->pos_now)   || strcmp(pos_end, osd->pos_end)   ||
+                  progress != osd->progress;
+
+    osd->played   = played;
+    osd->progress = progress;
+    strcpy(osd->time_now, time_now);
+    strcpy(osd->time_end, time_end);
+    strcpy(osd->pos_now, pos_now);
+    strcpy(osd->pos_end, pos_end);
+    return changed;
+}
 
-        // Text shadow
-        Fill(0, 0, 0, 1);
-        Text(46-1, 102-1, osd->pos_now, OpenSansSemiBold, 12);
-        TextEnd(osd->width-46-1, 102-1, osd->pos_end, OpenSansSemiBold, 12);
+void show_osd(int played, int duration, char* title, int paused)
+{
+    if (MAIN_OSD == NULL)
+    {
+        // Calling ``init_osd`` everytime seems wasteful, but it is needed to
+        // ensure that the OSD is visible.  The main issue is that if the player
+        // is stopped and then restarted, the graphics library needs to be
+        // reinitalized, otherwise the OSD is not drawn ontop of the video.
+        init_osd();
+    }
 
-        // Actual text
-        Fill(255,255,255,1);
-        Text(46, 102, osd->pos_now, OpenSansSemiBold, 12);
-        TextEnd(osd->width-46, 102, osd->pos_end, OpenSansSemiBold, 12);
+    OSD* osd = MAIN_OSD;
+
+    // The caller's string may not outlive this call
+    free(osd->title);
+    osd->title       = strdup(title);
+    osd->title_width = TextWidth(osd->title, OpenSansSemiBold, 20);
+    osd->title_x     = (osd->width/2)-(osd->title_width/2);
+    osd->duration    = duration;
+    osd->paused      = paused;
+    set_played(osd, played);
+
+    Start(osd->width, osd->height);
+
+    draw_label(osd);
+    draw_background(osd);
+    draw_clock(osd);
+    draw_title(osd);
+    draw_progress(osd);
+
+    if (CURRENT_POSTER != NULL)
+    {
+        makeimage(ART_X, ART_Y, CURRENT_POSTER->width, CURRENT_POSTER->height, CURRENT_POSTER->data);
     }
-    //////////////////////////////////////////////////////////////////////
 
     End();
 }
 
+/*
+    Moves the progress bar and clocks of the OSD currently shown by
+    ``show_osd`` to ``played`` seconds, and shows or removes the "PAUSED"
+    label.  Only those regions are redrawn, the rest of the (preserved)
+    surface is left alone, and nothing is drawn at all when nothing visible
+    changed.
+*/
+void update_osd(int played, int paused)
+{
+    if (MAIN_OSD == NULL)
+    {
+        return;
+    }
+
+    OSD* osd = MAIN_OSD;
+    int label_changed = (paused != 0) != (osd->paused != 0);
+    osd->paused = paused;
+    if (!set_played(osd, played) && !label_changed)
+    {
+        return;
+    }
+
+    VGint rects[16] = {
+        22,                         PROGRESS_Y, osd->width-44,  PROGRESS_HEIGHT,
+        22,                         CLOCK_Y,    CLOCK_WIDTH,    CLOCK_HEIGHT,
+        osd->width-22-CLOCK_WIDTH,  CLOCK_Y,    CLOCK_WIDTH,    CLOCK_HEIGHT,
+        LABEL_X,                    LABEL_Y,    LABEL_WIDTH,    LABEL_HEIGHT
+    };
+    VGfloat clear[4] = { 255, 255, 255, 0 };
+
+    vgSetiv(VG_SCISSOR_RECTS, label_changed ? 16 : 12, rects);
+    vgSeti(VG_SCISSORING, VG_TRUE);
+
+    // Clearing and drawing are clipped to the scissor rectangles
+    vgSetfv(VG_CLEAR_COLOR, 4, clear);
+    vgClear(0, 0, osd->width, osd->height);
+
+    draw_label(osd);
+    draw_background(osd);
+    draw_clock(osd);
+    if (osd->title_x < 22+CLOCK_WIDTH || osd->title_x+osd->title_width > osd->width-22-CLOCK_WIDTH)
+    {
+        // A long title runs into the clock regions
+        draw_title(osd);
+    }
+    draw_progress(osd);
+
+    vgSeti(VG_SCISSORING, VG_FALSE);
+    End();
+}
+
 void hide_osd()
 {
     if (MAIN_OSD == NULL)
@@ -257,7 +540,9 @@ void hide_osd()
 int main()
 {
     char tmp[5];
-    show_osd(1023, 2503, "Test Title(2014)");
+    show_osd(1023, 2503, "Test Title(2014)", 1);
+    gets(tmp);
+    update_osd(1024, 0);
     gets(tmp);
     hide_osd();
     return 0;